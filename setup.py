@@ -113,7 +113,8 @@ class TestCommand(TestBaseCommand):
         for t in glob.glob(os.path.join(self._dir, 'tests', '*.py')):
             if (t.endswith('__init__.py') or
                 t.endswith("urltest.py") or
-                t.endswith("clitest.py")):
+                t.endswith("clitest.py") or
+                t.endswith("bench.py")):
                 continue
 
             base = os.path.basename(t)
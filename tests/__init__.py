@@ -52,3 +52,7 @@ import virtconvtest
 import interface
 import xmlparse
 import support
+import mediacache
+import treecache
+import cpiotest
+import isoreader
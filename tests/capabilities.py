@@ -18,6 +18,8 @@ import os.path
 import unittest
 import virtinst.CapabilitiesParser as capabilities
 
+import utils
+
 def build_host_feature_dict(feature_list):
     fdict = {}
     for f in feature_list:
@@ -260,5 +262,17 @@ class TestCapabilities(unittest.TestCase):
             'pse36', 'sep', 'sse', 'sse2', 'tsc', 'vme']
         test_single_cpu(cpu_64, "athlon", "AMD", athlon_features)
 
+    def testConnCaps(self):
+        conn = utils.open_testkvmdriver()
+        caps = capabilities.get_conn_caps(conn)
+
+        avoided = capabilities.caps_fetches_avoided
+        self.assertTrue(caps is capabilities.get_conn_caps(conn))
+        self.assertEquals(avoided + 1, capabilities.caps_fetches_avoided)
+
+        newcaps = capabilities.get_conn_caps(conn, refresh=True)
+        self.assertTrue(caps is not newcaps)
+        self.assertTrue(newcaps is capabilities.get_conn_caps(conn))
+
 if __name__ == "__main__":
     unittest.main()
@@ -16,11 +16,16 @@
 
 import unittest
 import os
+import errno
 import logging
 
+import urlgrabber.progress as progress
+
 import utils
 
 from virtinst import CloneManager
+from virtinst import VirtualDisk
+from virtinst import _filecopy
 CloneDesign = CloneManager.CloneDesign
 
 ORIG_NAME  = "clone-orig"
@@ -230,3 +235,167 @@ class TestClone(unittest.TestCase):
                                  "failure.")
         except (ValueError, RuntimeError), e:
             logging.debug("Received expected exception: %s" % str(e))
+
+    def testCloneLocalSparse(self):
+        """
+        Local file clone should only copy data and preserve holes
+        """
+        src = "/tmp/__virtinst_sparse_src.img"
+        dst = "/tmp/__virtinst_sparse_dst.img"
+        size = 20 * 1024 * 1024
+        try:
+            f = open(src, "w")
+            f.truncate(size)
+            f.seek(5 * 1024 * 1024)
+            f.write("x" * 5000)
+            f.seek(12 * 1024 * 1024 + 100)
+            f.write("\0" * 8192 + "y" * 10)
+            f.close()
+
+            for workers in [1, 4]:
+                if os.path.exists(dst):
+                    os.unlink(dst)
+                disk = VirtualDisk(conn=conn, path=dst,
+                                   size=float(size) / (1024 * 1024 * 1024))
+                disk.clone_path = src
+                disk.copy_workers = workers
+                disk.setup()
+
+                self.assertEquals(os.path.getsize(dst), size)
+                self.assertEquals(file(src).read(), file(dst).read())
+                self.assertTrue(os.stat(dst).st_blocks * 512 < size / 2)
+        finally:
+            for path in [src, dst]:
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    def testCloneLocalPreallocated(self):
+        """
+        Sparse clone of a source without holes should still leave its
+        zero blocks as holes
+        """
+        src = "/tmp/__virtinst_prealloc_src.img"
+        dst = "/tmp/__virtinst_prealloc_dst.img"
+        size = 8 * 1024 * 1024
+
+        def noreflink(ignore1, ignore2):
+            raise OSError(errno.EOPNOTSUPP, "reflink disabled")
+        origreflink = _filecopy.reflink
+        _filecopy.reflink = noreflink
+        try:
+            f = open(src, "w")
+            f.write("x" * 5000)
+            f.write("\0" * (size - 5000))
+            f.close()
+
+            for workers in [1, 4]:
+                if os.path.exists(dst):
+                    os.unlink(dst)
+                _filecopy.copy_file_parallel(src, dst, None, workers)
+
+                self.assertEquals(file(src).read(), file(dst).read())
+                self.assertTrue(os.stat(dst).st_blocks * 512 < size / 2)
+        finally:
+            _filecopy.reflink = origreflink
+            for path in [src, dst]:
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    def testCloneLocalReflink(self):
+        """
+        Local file clones should try a reflink first, sparse or not
+        """
+        src = "/tmp/__virtinst_reflink_src.img"
+        dst = "/tmp/__virtinst_reflink_dst.img"
+
+        calls = []
+        def fakereflink(src_fd, dst_fd):
+            calls.append((src_fd, dst_fd))
+            os.lseek(src_fd, 0, 0)
+            os.write(dst_fd, os.read(src_fd, 4096))
+        origreflink = _filecopy.reflink
+        _filecopy.reflink = fakereflink
+        try:
+            open(src, "w").write("x" * 4096)
+
+            for sparse in [True, False]:
+                for workers in [1, 4]:
+                    if os.path.exists(dst):
+                        os.unlink(dst)
+                    del(calls[:])
+                    _filecopy.copy_file_parallel(src, dst, None, workers,
+                                                 sparse=sparse)
+
+                    self.assertEquals(len(calls), 1)
+                    self.assertEquals(file(src).read(), file(dst).read())
+        finally:
+            _filecopy.reflink = origreflink
+            for path in [src, dst]:
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    def testCloneCancel(self):
+        """
+        Cancelled parallel clones should stop local copies, but not raise
+        from Storage's allocation progress thread
+        """
+        agg = CloneManager._AggregateMeter(progress.BaseMeter(), 0, "")
+        meter = agg.disk_meter()
+        agg.cancel((None, None, None))
+        meter.start(size=100)
+        meter.update(50)
+
+        src = "/tmp/__virtinst_cancel_src.img"
+        dst = "/tmp/__virtinst_cancel_dst.img"
+        try:
+            open(src, "w").write("x" * 4096)
+            disk = VirtualDisk(conn=conn, path=dst,
+                               size=4096.0 / (1024 * 1024 * 1024))
+            disk.clone_path = src
+            self.assertRaises(CloneManager._CloneCancelled, disk.setup, meter)
+        finally:
+            for path in [src, dst]:
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    def testCloneParallelDisks(self):
+        """
+        Parallel disk clone should copy everything, and remove all
+        partial output if any disk fails
+        """
+        size = 4 * 1024 * 1024
+        srcs = ["/tmp/__virtinst_par_src%d.img" % i for i in range(3)]
+        dsts = ["/tmp/__virtinst_par_dst%d.img" % i for i in range(3)]
+
+        def make_disks():
+            disks = []
+            for src, dst in zip(srcs, dsts):
+                disk = VirtualDisk(conn=conn, path=dst,
+                                   size=float(size) / (1024 * 1024 * 1024))
+                disk.clone_path = src
+                disks.append(disk)
+            return disks
+
+        try:
+            for src in srcs:
+                f = open(src, "w")
+                f.write(os.path.basename(src) * 1000)
+                f.truncate(size)
+                f.close()
+
+            CloneManager._do_duplicate_parallel(make_disks(), 2,
+                                                progress.BaseMeter())
+            for src, dst in zip(srcs, dsts):
+                self.assertEquals(file(src).read(), file(dst).read())
+                os.unlink(dst)
+
+            os.unlink(srcs[1])
+            self.assertRaises(RuntimeError,
+                              CloneManager._do_duplicate_parallel,
+                              make_disks(), 3, progress.BaseMeter())
+            for dst in dsts:
+                self.assertFalse(os.path.exists(dst))
+        finally:
+            for path in srcs + dsts:
+                if os.path.exists(path):
+                    os.unlink(path)
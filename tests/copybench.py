@@ -0,0 +1,92 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+"""
+Benchmark of _filecopy.copy_file_parallel by worker count.
+
+Usage: python tests/copybench.py [size-MiB] [dir] [worker counts...]
+
+A test image, 3/4 data and 1/4 holes, is created in dir (default /tmp)
+and copied with each worker count. Unless caches are dropped between
+runs the source is read from the page cache, so this mostly measures
+write and CPU scaling. Reflinks are disabled, since on btrfs or XFS they
+would skip the copy entirely.
+"""
+
+import os
+import errno
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from virtinst import _filecopy
+
+def make_image(path, size):
+    chunk = 4 * 1024 * 1024
+    data = os.urandom(chunk)
+    f = open(path, "w")
+    try:
+        f.truncate(size)
+        offset = 0
+        while offset < size:
+            # Leave every fourth chunk as a hole
+            if (offset / chunk) % 4 != 3:
+                f.seek(offset)
+                f.write(data[:min(chunk, size - offset)])
+            offset += chunk
+    finally:
+        f.close()
+
+def no_reflink(ignore1, ignore2):
+    raise OSError(errno.EOPNOTSUPP, "reflink disabled for benchmarking")
+
+def run(src, dst, size, workers):
+    if os.path.exists(dst):
+        os.unlink(dst)
+
+    start = time.time()
+    _filecopy.copy_file_parallel(src, dst, size, workers)
+    fd = os.open(dst, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return time.time() - start
+
+def main():
+    args = sys.argv[1:]
+    size = int(args and args.pop(0) or 1024) * 1024 * 1024
+    tmpdir = args and args.pop(0) or "/tmp"
+    counts = [int(a) for a in args] or [1, 2, 4, 8]
+
+    _filecopy.reflink = no_reflink
+
+    src = os.path.join(tmpdir, "virtinst-copybench-src.img")
+    dst = os.path.join(tmpdir, "virtinst-copybench-dst.img")
+    try:
+        make_image(src, size)
+        print "%-8s %10s %10s" % ("workers", "seconds", "MiB/s")
+        for workers in counts:
+            secs = run(src, dst, size, workers)
+            print "%-8d %10.2f %10.1f" % (workers, secs,
+                                          size / 1024.0 / 1024.0 / secs)
+    finally:
+        for path in [src, dst]:
+            if os.path.exists(path):
+                os.unlink(path)
+
+if __name__ == "__main__":
+    main()
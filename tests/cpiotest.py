@@ -0,0 +1,190 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+import os
+import gzip
+import shutil
+import struct
+import tempfile
+import unittest
+import StringIO
+
+import urlgrabber.progress as progress
+
+from virtinst import _cpio
+from virtinst import _rpm
+from virtinst import OSDistro
+
+def _parse_newc(data):
+    """
+    Return a list of (name, mode, contents) for a newc cpio archive
+    """
+    ret = []
+    idx = 0
+    while True:
+        fields = [int(data[idx + 6 + 8 * i:idx + 14 + 8 * i], 16)
+                  for i in range(13)]
+        namesize = fields[11]
+        size = fields[6]
+        name = data[idx + 110:idx + 110 + namesize - 1]
+        idx = (idx + 110 + namesize + 3) & ~3
+        contents = data[idx:idx + size]
+        idx = (idx + size + 3) & ~3
+        if name == "TRAILER!!!":
+            return ret
+        ret.append((name, fields[1], contents))
+
+class TestCpio(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="virtinst-cpio")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _make_file(self, name, content, mode):
+        path = os.path.join(self.tmpdir, name)
+        open(path, "w").write(content)
+        os.chmod(path, mode)
+        return path
+
+    def testAppendInjections(self):
+        files = [self._make_file("ks.cfg", "install\n" * 100, 0640),
+                 self._make_file("odd", "abc", 0755)]
+        initrds = []
+        for name in ["initrd1", "initrd2"]:
+            initrd = self._make_file(name, "", 0644)
+            _cpio.append_injections(initrd, files)
+            initrds.append(initrd)
+
+        self.assertEquals(file(initrds[0]).read(), file(initrds[1]).read())
+        self.assertEquals(_parse_newc(gzip.open(initrds[0]).read()),
+                          [(".", 040775, ""),
+                           ("ks.cfg", 0100640, "install\n" * 100),
+                           ("odd", 0100755, "abc")])
+
+    def _make_rpm(self, compressor, payload):
+        """
+        Write a minimal package with the given payload
+        """
+        store = "cpio\0" + compressor + "\0"
+        index = struct.pack(">IIII", _rpm.RPMTAG_PAYLOADFORMAT, 6, 0, 1)
+        index += struct.pack(">IIII", _rpm.RPMTAG_PAYLOADCOMPRESSOR, 6, 5, 1)
+
+        data = "\xed\xab\xee\xdb" + "\0" * 92
+        data += struct.pack(">4s4xII", "\x8e\xad\xe8\x01", 0, 0)
+        data += struct.pack(">4s4xII", "\x8e\xad\xe8\x01", 2, len(store))
+        data += index + store + payload
+        return self._make_file("test-%s.rpm" % compressor, data, 0644)
+
+    def _read_rpm(self, path):
+        payload = _rpm.RPMPayload(path)
+        try:
+            return [(entry.name, entry.read()) for entry in payload.entries()]
+        finally:
+            payload.close()
+
+    def testRPMPayload(self):
+        buf = StringIO.StringIO()
+        cpio = _cpio.CpioWriter(buf)
+        cpio.add_data("./boot/System.map", "symbols")
+        cpio.add_data("./boot/vmlinuz", "kernel")
+        cpio.finish()
+        archive = buf.getvalue()
+        members = [("./boot/System.map", "symbols"),
+                   ("./boot/vmlinuz", "kernel")]
+
+        buf = StringIO.StringIO()
+        gz = _cpio.GzipWriter(buf)
+        gz.write(archive)
+        gz.close()
+        self.assertEquals(self._read_rpm(self._make_rpm("gzip",
+                                                        buf.getvalue())),
+                          members)
+
+        # Payloads we can't decompress are read through rpm2cpio
+        rpm = self._make_rpm("xz", "not decoded in process")
+        self._make_file(os.path.basename(rpm) + ".cpio", archive, 0644)
+        self._make_file("rpm2cpio", "#!/bin/sh\nexec cat \"$1.cpio\"\n",
+                        0755)
+        oldpath = os.environ.get("PATH", "")
+        os.environ["PATH"] = self.tmpdir + ":" + oldpath
+        try:
+            self.assertEquals(self._read_rpm(rpm), members)
+        finally:
+            os.environ["PATH"] = oldpath
+
+    def _make_payload_rpm(self, name, members):
+        """
+        Write a gzip compressed package holding the (name, data) members
+        """
+        buf = StringIO.StringIO()
+        gz = _cpio.GzipWriter(buf)
+        cpio = _cpio.CpioWriter(gz)
+        for member, data in members:
+            cpio.add_data(member, data)
+        cpio.finish()
+        gz.close()
+        path = self._make_rpm("gzip", buf.getvalue())
+        os.rename(path, os.path.join(self.tmpdir, name))
+        return os.path.join(self.tmpdir, name)
+
+    def testSuseKernelInitrd(self):
+        version = "2.6.16-21-xen"
+        moddir = "./lib/modules/%s/kernel/drivers/xen/" % version
+        kernelrpm = self._make_payload_rpm("kernel-xen.rpm", [
+            ("./boot/System.map-" + version, "symbols"),
+            ("./boot/vmlinuz-" + version, "kernel"),
+            (moddir + "xenblk.ko", "blk"),
+            (moddir + "unwanted.ko", "unwanted")])
+
+        buf = StringIO.StringIO()
+        cpio = _cpio.CpioWriter(buf)
+        cpio.add_data("init", "base init")
+        cpio.finish()
+        base = StringIO.StringIO()
+        gz = gzip.GzipFile(fileobj=base, mode="w")
+        gz.write(buf.getvalue())
+        gz.close()
+        initrddir = "./usr/lib/install-initrd/"
+        initrdrpm = self._make_payload_rpm("install-initrd.rpm", [
+            (initrddir + "initrd-base.gz", base.getvalue()),
+            (initrddir + "xen/module.list", "xenblk.ko\n"),
+            (initrddir + "xen/module.config", "config")])
+
+        scratch = os.path.join(self.tmpdir, "scratch")
+        os.mkdir(scratch)
+        fetcher = OSDistro._fetcherForURI(self.tmpdir, scratch)
+        store = OSDistro.SuseDistro(self.tmpdir, "x86_64", "xen", scratch)
+        kernel, initrd, args = store._buildKernelInitrd(fetcher, kernelrpm,
+                                                        initrdrpm,
+                                                        progress.BaseMeter())
+        self.assertEquals(args, "install=" + self.tmpdir)
+        self.assertEquals(file(kernel).read(), "kernel")
+
+        members = {}
+        for name, ignore, contents in _parse_newc(gzip.open(initrd).read()):
+            members[name] = contents
+        modpath = "lib/modules/2.6.16-override-xen/initrd/"
+        self.assertEquals(members["init"], "base init")
+        self.assertEquals(members[modpath + "xenblk.ko"], "blk")
+        self.assertEquals(members[modpath + "module.config"], "config")
+        self.assertFalse(modpath + "unwanted.ko" in members)
+
+        # Only the built kernel and initrd are left in scratch
+        self.assertEquals(sorted(os.listdir(scratch)),
+                          sorted([os.path.basename(kernel),
+                                  os.path.basename(initrd)]))
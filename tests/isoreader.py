@@ -0,0 +1,252 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from virtinst import isoreader
+
+_sector = isoreader.SECTOR_SIZE
+_flag_dir = 0x02
+_flag_multi_extent = 0x80
+
+def _both16(val):
+    return struct.pack("<H", val) + struct.pack(">H", val)
+
+def _both32(val):
+    return struct.pack("<I", val) + struct.pack(">I", val)
+
+def _susp(sig, data):
+    return sig + chr(4 + len(data)) + chr(1) + data
+
+def _record(name, lba, length, flags=0, sysuse=""):
+    """
+    Return an ISO9660 directory record
+    """
+    rec = (chr(0) + _both32(lba) + _both32(length) + "\0" * 7 +
+           chr(flags) + "\0\0" + _both16(1) +
+           chr(len(name)) + name + "\0" * ((len(name) + 1) % 2) + sysuse)
+    if len(rec) % 2 == 0:
+        rec += "\0"
+    return chr(len(rec) + 1) + rec
+
+class _ISOBuilder(object):
+    """
+    Lay out a small ISO9660 image sector by sector. Directories take
+    a single sector each.
+    """
+    def __init__(self):
+        self.sectors = {}
+        self.descriptors = []
+        self.next_lba = 20
+
+    def alloc(self, count=1):
+        lba = self.next_lba
+        self.next_lba += count
+        return lba
+
+    def add_data(self, data):
+        lba = self.alloc(max(1, (len(data) + _sector - 1) / _sector))
+        self.sectors[lba] = data
+        return lba
+
+    def add_dir(self, lba, records, dotsysuse=""):
+        data = (_record("\0", lba, _sector, _flag_dir, dotsysuse) +
+                _record("\1", lba, _sector, _flag_dir) +
+                "".join(records))
+        assert len(data) <= _sector
+        self.sectors[lba] = data
+
+    def add_descriptor(self, vdtype, rootlba, escapes=""):
+        vd = chr(vdtype) + "CD001" + chr(1)
+        vd += "\0" * (88 - len(vd)) + escapes
+        vd += "\0" * (128 - len(vd)) + _both16(_sector)
+        vd += "\0" * (156 - len(vd))
+        vd += _record("\0", rootlba, _sector, _flag_dir)
+        self.descriptors.append(vd)
+
+    def write(self, path):
+        fd = open(path, "w")
+        fd.truncate(self.next_lba * _sector)
+        for idx, vd in enumerate(self.descriptors + [chr(255) + "CD001"]):
+            fd.seek((16 + idx) * _sector)
+            fd.write(vd)
+        for lba, data in self.sectors.items():
+            fd.seek(lba * _sector)
+            fd.write(data)
+        fd.close()
+
+class TestISOReader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="virtinst-isoreader")
+        self.path = os.path.join(self.tmpdir, "test.iso")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _read(self, iso, path, size=-1):
+        f = iso.open(path)
+        try:
+            ret = []
+            while True:
+                buf = f.read(size)
+                if not buf:
+                    break
+                ret.append(buf)
+                if size < 0:
+                    break
+            return "".join(ret)
+        finally:
+            f.close()
+
+    def testPlain(self):
+        b = _ISOBuilder()
+        kernel = b.add_data("kernel")
+        initrd = b.add_data("initrd" * 1000)
+        first = b.add_data("a" * _sector)
+        second = b.add_data("b" * 100)
+
+        subdir = b.alloc()
+        b.add_dir(subdir, [
+            _record("INITRD.IMG;1", initrd, 6000),
+            _record("VMLINUZ.;1", kernel, 6)])
+        root = b.alloc()
+        b.add_dir(root, [
+            _record("BIG.BIN;1", first, _sector, _flag_multi_extent),
+            _record("BIG.BIN;1", second, 100),
+            _record("ISOLINUX", subdir, _sector, _flag_dir)])
+        b.add_descriptor(1, root)
+        b.write(self.path)
+
+        self.assertTrue(isoreader.is_iso(self.path))
+        iso = isoreader.ISOImage(self.path)
+        try:
+            self.assertFalse(iso.rock_ridge)
+            self.assertFalse(iso.joliet)
+
+            self.assertEquals(self._read(iso, "/ISOLINUX/VMLINUZ"), "kernel")
+            self.assertEquals(self._read(iso, "ISOLINUX/INITRD.IMG"),
+                              "initrd" * 1000)
+
+            # Case insensitive fallback
+            self.assertEquals(self._read(iso, "isolinux/vmlinuz"), "kernel")
+            self.assertEquals(iso.lookup("isolinux/VMLINUZ;1"), None)
+            self.assertEquals(iso.lookup("isolinux/missing"), None)
+            self.assertEquals(iso.lookup("isolinux/vmlinuz/x"), None)
+            self.assertRaises(isoreader.ISOError, iso.open, "isolinux")
+
+            # Multi-extent file, read whole and across the extent boundary
+            entry = iso.lookup("big.bin")
+            self.assertEquals(entry.size, _sector + 100)
+            expect = "a" * _sector + "b" * 100
+            self.assertEquals(self._read(iso, "big.bin"), expect)
+            self.assertEquals(self._read(iso, "big.bin", 1000), expect)
+        finally:
+            iso.close()
+
+    def testRockRidge(self):
+        b = _ISOBuilder()
+        kernel = b.add_data("kernel")
+        initrd = b.add_data("initrd")
+        deepfile = b.add_data("deep")
+
+        # The rest of the initrd's NM entry is in a continuation area
+        tail = _susp("NM", chr(0) + "-long-name.img")
+        cont = b.add_data(tail)
+        initrd_sysuse = (_susp("NM", chr(isoreader._nm_continue) + "initrd") +
+                         _susp("CE", _both32(cont) + _both32(0) +
+                                     _both32(len(tail))))
+
+        # 'deep' is relocated to rr_moved, with a CL link in its place
+        moved = b.alloc()
+        deep = b.alloc()
+        root = b.alloc()
+        b.add_dir(deep, [
+            _record("FILE.TXT;1", deepfile, 4, 0,
+                    _susp("NM", chr(0) + "file.txt"))])
+        b.add_dir(moved, [
+            _record("DEEP", deep, _sector, _flag_dir,
+                    _susp("NM", chr(0) + "deep") + _susp("RE", ""))])
+        b.add_dir(root, [
+            _record("DEEP", 0, 0, 0,
+                    _susp("NM", chr(0) + "deep") + _susp("CL", _both32(deep))),
+            _record("INITRD_L.IMG;1", initrd, 6, 0, initrd_sysuse),
+            _record("RR_MOVED", moved, _sector, _flag_dir,
+                    _susp("NM", chr(0) + "rr_moved")),
+            _record("VMLINUZ.;1", kernel, 6, 0,
+                    _susp("NM", chr(0) + "vmlinuz"))],
+            dotsysuse=_susp("SP", "\xbe\xef" + chr(0)))
+        b.add_descriptor(1, root)
+        b.write(self.path)
+
+        iso = isoreader.ISOImage(self.path)
+        try:
+            self.assertTrue(iso.rock_ridge)
+            self.assertEquals(self._read(iso, "vmlinuz"), "kernel")
+            self.assertEquals(iso.lookup("VMLINUZ").name, "vmlinuz")
+            self.assertEquals(self._read(iso, "initrd-long-name.img"),
+                              "initrd")
+            self.assertEquals(iso.lookup("INITRD_L.IMG"), None)
+
+            self.assertTrue(iso.lookup("deep").is_dir)
+            self.assertEquals(self._read(iso, "deep/file.txt"), "deep")
+            self.assertEquals(iso.lookup("rr_moved/deep"), None)
+        finally:
+            iso.close()
+
+    def testJoliet(self):
+        b = _ISOBuilder()
+        kernel = b.add_data("kernel")
+        readme = b.add_data("readme")
+
+        plainroot = b.alloc()
+        b.add_dir(plainroot, [
+            _record("README_A.TXT;1", readme, 6),
+            _record("VMLINUZ.;1", kernel, 6)])
+        jolietroot = b.alloc()
+        b.add_dir(jolietroot, [
+            _record("Read Me.txt".encode("utf-16-be"), readme, 6),
+            _record("vmlinuz".encode("utf-16-be"), kernel, 6)])
+        b.add_descriptor(1, plainroot)
+        b.add_descriptor(2, jolietroot, escapes="%/E")
+        b.write(self.path)
+
+        iso = isoreader.ISOImage(self.path)
+        try:
+            self.assertTrue(iso.joliet)
+            self.assertEquals(self._read(iso, "Read Me.txt"), "readme")
+            self.assertEquals(self._read(iso, "read me.TXT"), "readme")
+            self.assertEquals(self._read(iso, "vmlinuz"), "kernel")
+            self.assertEquals(iso.lookup("README_A.TXT"), None)
+        finally:
+            iso.close()
+
+    def testNotISO(self):
+        open(self.path, "w").write("\0" * (_sector * 40))
+        self.assertFalse(isoreader.is_iso(self.path))
+
+        open(self.path, "w").write("not an iso")
+        self.assertFalse(isoreader.is_iso(self.path))
+        self.assertRaises(isoreader.ISOError, isoreader.ISOImage, self.path)
+
+        self.assertFalse(isoreader.is_iso(os.path.join(self.tmpdir, "nope")))
+
+if __name__ == "__main__":
+    unittest.main()
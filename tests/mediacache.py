@@ -0,0 +1,122 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from virtinst import mediacache
+
+class TestMediaCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="virtinst-mediacache")
+        self.cachedir = os.path.join(self.tmpdir, "cache")
+        self.scratch = os.path.join(self.tmpdir, "scratch")
+        self.fetches = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _fetcher(self, content):
+        def fetch(dirname):
+            self.fetches.append(content)
+            path = os.path.join(dirname, "download")
+            open(path, "w").write(content)
+            return path
+        return fetch
+
+    def _acquire(self, cache, url, validator, content):
+        path = cache.acquire(url, validator, self._fetcher(content),
+                             self.scratch, os.path.basename(url) + ".")
+        self.assertEquals(file(path).read(), content)
+        return path
+
+    def testCacheHits(self):
+        cache = mediacache.MediaCache(self.cachedir)
+        url = "http://example.com/tree/vmlinuz"
+
+        path1 = self._acquire(cache, url, "etag=1", "kernel")
+        path2 = self._acquire(cache, url, "etag=1", "kernel")
+        self.assertNotEquals(path1, path2)
+        self.assertEquals(self.fetches, ["kernel"])
+
+        # New validator means a new download
+        self._acquire(cache, url, "etag=2", "kernel2")
+        self.assertEquals(self.fetches, ["kernel", "kernel2"])
+        self.assertEquals((cache.hits, cache.misses), (1, 2))
+
+        # Scratch files don't share an inode with the cache entry, so
+        # relabeling or modifying them doesn't touch the cache
+        entry = cache._entry_path(url, "etag=1")
+        self.assertEquals(os.stat(path1).st_nlink, 1)
+        self.assertNotEquals(os.stat(path1).st_ino, os.stat(entry).st_ino)
+        mode = os.stat(entry).st_mode & 0777
+        os.chmod(path1, mode ^ 0040)
+        open(path1, "a").write("appended")
+        self.assertEquals(os.stat(entry).st_mode & 0777, mode)
+        self._acquire(cache, url, "etag=1", "kernel")
+
+    def testCacheEviction(self):
+        cache = mediacache.MediaCache(self.cachedir, max_size=250)
+
+        self._acquire(cache, "http://example.com/a", "v", "a" * 100)
+        self._acquire(cache, "http://example.com/b", "v", "b" * 100)
+        time.sleep(1.1)
+        # Make 'a' the most recently used
+        self._acquire(cache, "http://example.com/a", "v", "a" * 100)
+        self._acquire(cache, "http://example.com/c", "v", "c" * 100)
+        self.assertEquals(cache.evictions, 1)
+
+        self._acquire(cache, "http://example.com/a", "v", "a" * 100)
+        self._acquire(cache, "http://example.com/b", "v", "b" * 100)
+        self.assertEquals(self.fetches.count("b" * 100), 2)
+        self.assertEquals(self.fetches.count("a" * 100), 1)
+
+    def testEvictionLocking(self):
+        cache = mediacache.MediaCache(self.cachedir, max_size=150)
+        self._acquire(cache, "http://example.com/a", "v", "a" * 100)
+        entry = cache._entry_path("http://example.com/a", "v")
+        os.utime(entry, (1, 1))
+
+        # Entries locked by a lookup in another process aren't evicted
+        lock = mediacache._FileLock(entry + ".lock")
+        lock.acquire()
+        try:
+            self._acquire(cache, "http://example.com/b", "v", "b" * 100)
+        finally:
+            lock.release()
+        self.assertTrue(os.path.exists(entry))
+        self.assertEquals(cache.evictions, 0)
+
+        # Evicting an entry removes its lock file
+        self._acquire(cache, "http://example.com/c", "v", "c" * 100)
+        self.assertEquals(cache.evictions, 2)
+        self.assertFalse(os.path.exists(entry))
+        self.assertFalse(os.path.exists(entry + ".lock"))
+
+        # So does the next eviction for failed downloads
+        def fail(ignore):
+            raise IOError("Download failed")
+        self.assertRaises(IOError, cache.acquire, "http://example.com/d",
+                          "v", fail, self.scratch, "d.")
+        self._acquire(cache, "http://example.com/e", "v", "e" * 100)
+        locks = [name for name in os.listdir(self.cachedir)
+                 if name.endswith(".lock") and name != ".lock"]
+        self.assertEquals(locks, [os.path.basename(
+            cache._entry_path("http://example.com/e", "v")) + ".lock"])
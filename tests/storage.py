@@ -19,6 +19,7 @@ import unittest
 
 import virtinst.Storage
 from virtinst.Storage import StoragePool, StorageVolume
+from virtinst.DistroInstaller import _stream_file
 import utils
 
 import libvirt
@@ -225,5 +226,35 @@ class TestStorage(unittest.TestCase):
                                                  host=host)
         self.assertTrue(len(lst) == 0)
 
+    def testStreamFile(self):
+        """
+        Upload streaming should handle partial sends and holes
+        """
+        from urlgrabber.progress import BaseMeter
+
+        src = "/tmp/__virtinst_upload_src.img"
+        dst = "/tmp/__virtinst_upload_dst.img"
+        size = 3 * 1024 * 1024
+        try:
+            f = open(src, "w")
+            f.write("kernel" * 1000)
+            f.truncate(size)
+            f.seek(2 * 1024 * 1024)
+            f.write("initrd" * 1000)
+            f.close()
+
+            for sparse, sendall in [(False, False), (True, False),
+                                    (False, True)]:
+                stream = utils.LocalStream(dst, max_send=1000)
+                _stream_file(stream, BaseMeter(), src,
+                             chunk_size=256 * 1024, sparse=sparse,
+                             use_sendall=sendall)
+                stream.finish()
+                self.assertEquals(file(src).read(), file(dst).read())
+        finally:
+            for path in [src, dst]:
+                if os.path.exists(path):
+                    os.unlink(path)
+
 if __name__ == "__main__":
     unittest.main()
@@ -15,8 +15,12 @@
 # MA 02110-1301 USA.
 
 import unittest
+import shutil
+import tempfile
 
 from virtinst import support
+from virtinst import conncache
+from virtinst import CapabilitiesParser
 
 import utils
 
@@ -46,5 +50,84 @@ class TestSupport(unittest.TestCase):
 
             valdict[supportname] = checkval
 
+    def testSupportCache(self):
+        """
+        Verify support results are cached per connection until invalidated
+        """
+        kvmconn = utils.open_plainkvm(connver=11000)
+        feature = support.SUPPORT_CONN_KEYMAP_AUTODETECT
+        self.assertTrue(support.check_conn_support(kvmconn, feature))
+
+        kvmconn.getVersion = lambda: 10000
+        self.assertTrue(support.check_conn_support(kvmconn, feature))
+
+        support.invalidate_support_cache(kvmconn)
+        self.assertFalse(support.check_conn_support(kvmconn, feature))
+
+        support.prime_support_cache(conn)
+        cache = support._get_support_cache(conn)
+        misses = cache.misses
+        support.check_conn_support(conn, support.SUPPORT_CONN_STORAGE)
+        self.assertEquals(misses, cache.misses)
+
+        # unicode hv names share the str results
+        feature = support.SUPPORT_CONN_HV_VIRTIO
+        support.check_conn_hv_support(conn, feature, "kvm")
+        misses = cache.misses
+        support.check_conn_hv_support(conn, feature, u"kvm")
+        self.assertEquals(misses, cache.misses)
+
+        # Object checks are remembered per object
+        feature = support.SUPPORT_DOMAIN_GETVCPUS
+        dom1 = conn.lookupByName("test")
+        dom2 = conn.lookupByName("test-for-clone")
+        support.check_domain_support(dom1, feature)
+        misses = cache.misses
+        support.check_domain_support(dom1, feature)
+        self.assertEquals(misses, cache.misses)
+        support.check_domain_support(dom2, feature)
+        self.assertEquals(misses + 1, cache.misses)
+
+    def testConnCache(self):
+        """
+        Verify a saved connection cache entry is used by a new connection
+        """
+        cachedir = tempfile.mkdtemp()
+        try:
+            conn1 = utils.open_testkvmdriver()
+            self.assertFalse(conncache.setup_conn(conn1, utils._kvmuri,
+                                                  cachedir=cachedir))
+            origcaps = CapabilitiesParser.get_conn_caps(conn1)
+
+            def nofetch():
+                raise AssertionError("Capabilities fetched despite cache")
+            conn2 = utils.open_testkvmdriver()
+            conn2.getCapabilities = nofetch
+            self.assertTrue(conncache.setup_conn(conn2, utils._kvmuri,
+                                                 cachedir=cachedir))
+            caps = CapabilitiesParser.get_conn_caps(conn2)
+            self.assertEquals(origcaps.host.arch, caps.host.arch)
+            self.assertEquals(len(origcaps.guests), len(caps.guests))
+
+            cache = support._get_support_cache(conn2)
+            misses = cache.misses
+            support.check_conn_support(conn2, support.SUPPORT_CONN_STORAGE)
+            self.assertEquals(misses, cache.misses)
+
+            # Expired entries are ignored
+            entry = conncache.ConnCache(utils.open_testkvmdriver(),
+                                        utils._kvmuri, cachedir=cachedir,
+                                        ttl=0)
+            self.assertFalse(entry.load())
+
+            # So are entries for a different host behind the same URI
+            conn3 = utils.open_testkvmdriver()
+            conn3.getHostname = lambda: "some-other-host"
+            entry = conncache.ConnCache(conn3, utils._kvmuri,
+                                        cachedir=cachedir)
+            self.assertFalse(entry.load())
+        finally:
+            shutil.rmtree(cachedir)
+
 if __name__ == "__main__":
     unittest.main()
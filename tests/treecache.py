@@ -0,0 +1,85 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from virtinst import OSDistro
+from virtinst import treecache
+
+class TestTreeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="virtinst-treecache")
+        self.cachedir = os.path.join(self.tmpdir, "cache")
+        self.tree = os.path.join(self.tmpdir, "tree")
+        os.makedirs(os.path.join(self.tree, "images", "pxeboot"))
+        for name in ["vmlinuz", "initrd.img"]:
+            open(os.path.join(self.tree, "images", "pxeboot", name),
+                 "w").write(name)
+
+        self.oldenv = os.environ.get(treecache.ENV_VAR)
+        os.environ[treecache.ENV_VAR] = "yes"
+
+    def tearDown(self):
+        if self.oldenv is None:
+            del(os.environ[treecache.ENV_VAR])
+        else:
+            os.environ[treecache.ENV_VAR] = self.oldenv
+        shutil.rmtree(self.tmpdir)
+
+    def _load(self, fetcher):
+        return treecache.load(fetcher, self.tree + "/", "x86_64", "hvm",
+                              cachedir=self.cachedir)
+
+    def testTreeCache(self):
+        fetcher = OSDistro._fetcherForURI(self.tree, self.tmpdir)
+        fetcher.prepareLocation()
+        try:
+            store = OSDistro.GenericDistro(self.tree, "x86_64", "hvm",
+                                           self.tmpdir)
+            self.assertTrue(store.isValidStore(fetcher, None))
+            store.unrelated = "not cached"
+            treecache.save(fetcher, store, self.tree, "x86_64", "hvm",
+                           cachedir=self.cachedir)
+
+            classname, attrs, treeinfo = self._load(fetcher)
+            self.assertEquals(classname, "GenericDistro")
+            self.assertEquals(attrs["_valid_kernel_path"],
+                              store._valid_kernel_path)
+            self.assertEquals(treeinfo, None)
+            self.assertFalse("unrelated" in attrs)
+
+            # Different guest type is a different entry
+            self.assertEquals(treecache.load(fetcher, self.tree, "x86_64",
+                                             "xen", cachedir=self.cachedir),
+                              None)
+
+            # So is a different distro hint
+            self.assertEquals(treecache.load(fetcher, self.tree, "x86_64",
+                                             "hvm", distro="suse",
+                                             cachedir=self.cachedir),
+                              None)
+
+            # Touching the kernel invalidates the entry
+            kernel = os.path.join(self.tree, "images", "pxeboot", "vmlinuz")
+            os.utime(kernel, (time.time() + 10, time.time() + 10))
+            self.assertEquals(self._load(fetcher), None)
+        finally:
+            fetcher.cleanupLocation()
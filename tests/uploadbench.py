@@ -0,0 +1,74 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+"""
+Benchmark of DistroInstaller media upload streaming by chunk size, using
+a local file as the stream.
+
+Usage: python tests/uploadbench.py [size-MiB] [chunk-KiB...]
+
+Run from the top of the source tree.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.getcwd())
+import utils
+from virtinst.DistroInstaller import _stream_file
+from urlgrabber.progress import BaseMeter
+
+def run(src, dst, chunk_size, sendall):
+    stream = utils.LocalStream(dst)
+    start = time.time()
+    try:
+        _stream_file(stream, BaseMeter(), src,
+                     chunk_size=chunk_size,
+                     use_sendall=sendall)
+    finally:
+        stream.finish()
+    return time.time() - start
+
+def main():
+    args = sys.argv[1:]
+    size = int(args and args.pop(0) or 256) * 1024 * 1024
+    chunks = [int(a) * 1024 for a in args] or [1024, 64 * 1024,
+                                                1024 * 1024,
+                                                4 * 1024 * 1024]
+
+    src = "/tmp/virtinst-uploadbench-src.img"
+    dst = "/tmp/virtinst-uploadbench-dst.img"
+    try:
+        f = open(src, "w")
+        for ignore in range(size / (1024 * 1024)):
+            f.write(os.urandom(1024 * 1024))
+        f.close()
+
+        print "%-10s %-8s %10s %10s" % ("chunk", "sendAll", "seconds",
+                                        "MiB/s")
+        for chunk in chunks:
+            for sendall in [False, True]:
+                secs = run(src, dst, chunk, sendall)
+                print "%-10d %-8s %10.2f %10.1f" % (chunk, sendall, secs,
+                                                    size / 1048576.0 / secs)
+    finally:
+        for path in [src, dst]:
+            if os.path.exists(path):
+                os.unlink(path)
+
+if __name__ == "__main__":
+    main()
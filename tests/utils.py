@@ -219,3 +219,40 @@ def get_virtual_network():
     dev.type = virtinst.VirtualNetworkInterface.TYPE_VIRTUAL
     dev.network = "default"
     return dev
+
+class LocalStream(object):
+    """
+    Stand-in for a libvirt upload stream that writes to a local file.
+    max_send limits the bytes accepted per send() call, to exercise
+    partial sends.
+    """
+    def __init__(self, path, max_send=None):
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        self.max_send = max_send
+        self.sends = 0
+        self.holes = 0
+
+    def send(self, data):
+        data = str(data[:self.max_send or len(data)])
+        self.sends += 1
+        return os.write(self.fd, data)
+
+    def sendHole(self, length, flags):
+        ignore = flags
+        self.holes += 1
+        os.lseek(self.fd, length, 1)
+        os.ftruncate(self.fd, os.lseek(self.fd, 0, 1))
+
+    def sendAll(self, handler, opaque, nbytes=65536):
+        while True:
+            got = handler(self, nbytes, opaque)
+            if not got:
+                break
+            assert len(got) <= nbytes, \
+                   "handler returned %d bytes, asked for %d" % (len(got),
+                                                                nbytes)
+            while got:
+                got = got[self.send(got):]
+
+    def finish(self):
+        os.close(self.fd)
@@ -154,6 +154,13 @@ args = {
     'invalid': [ None, 1234 ],
     'valid': [ True, False ]
   },
+
+  'preallocation' : {
+    'invalid': [ None, "", "invalid" ],
+    'valid': [ VirtualDisk.PREALLOC_AUTO, VirtualDisk.PREALLOC_FALLOCATE,
+               VirtualDisk.PREALLOC_POSIX_FALLOCATE,
+               VirtualDisk.PREALLOC_ZERO ]
+  },
 },
 
 'installer' : {
@@ -586,5 +593,59 @@ class TestValidation(unittest.TestCase):
             iobj = iclass()
             self._testArgs(iobj, iclass, label, manual_dict=custom_dict)
 
+    def testGuestInventory(self):
+        inv = virtinst.GuestInventory.get_inventory(testconn)
+        self.assertTrue(inv is
+                        virtinst.GuestInventory.get_inventory(testconn))
+
+        collide = "/default-pool/collidevol1.img"
+        share = "/default-pool/sharevol.img"
+        self.assertEquals(VirtualDisk.path_in_use_by(testconn, collide),
+                          ["test-for-clone"])
+        self.assertEquals(VirtualDisk.path_in_use_by(testconn, share),
+                          ["test-for-clone"])
+        self.assertEquals(VirtualDisk.path_in_use_by(testconn, share,
+                                                     check_conflict=True),
+                          [])
+
+        active, inactive = inv.mac_in_use_by("11:22:33:12:34:ab")
+        self.assertEquals(active + inactive, ["test-for-clone"])
+        self.assertTrue(virtinst._util.vm_uuid_collision(testconn,
+                                "12345678-1234-1234-1234-12345678ffff"))
+        self.assertFalse(virtinst._util.vm_uuid_collision(testconn,
+                                "00000000-1234-1234-1234-12345678ffff"))
+
+
+        # Repeated checks shouldn't reparse unchanged domain XML
+        parses = inv.xml_parses
+        VirtualDisk.path_in_use_by(testconn, collide)
+        inv.mac_in_use_by("11:11:11:11:11:11")
+        self.assertEquals(parses, inv.xml_parses)
+
+    def testGuestInventoryRedefine(self):
+        # Private connection, since we redefine one of its guests
+        conn = utils.open_testdriver()
+        inv = virtinst.GuestInventory.get_inventory(conn)
+
+        newpath = "/default-pool/default-vol"
+        self.assertEquals(VirtualDisk.path_in_use_by(conn, newpath), [])
+        self.assertEquals(inv.mac_in_use_by("22:22:33:44:55:66"), ([], []))
+
+        # Edit the guest in place, like 'virsh edit' would
+        vm = conn.lookupByName("test-for-clone")
+        xml = vm.XMLDesc(0)
+        xml = xml.replace("/default-pool/collidevol1.img", newpath)
+        for mac in ["11:22:33:12:34:ab", "11:22:33:12:34:AB"]:
+            xml = xml.replace(mac, "22:22:33:44:55:66")
+        conn.defineXML(xml)
+
+        self.assertEquals(VirtualDisk.path_in_use_by(conn, newpath),
+                          ["test-for-clone"])
+        self.assertEquals(VirtualDisk.path_in_use_by(conn,
+                                            "/default-pool/collidevol1.img"),
+                          [])
+        active, inactive = inv.mac_in_use_by("22:22:33:44:55:66")
+        self.assertEquals(active + inactive, ["test-for-clone"])
+
 if __name__ == "__main__":
     unittest.main()
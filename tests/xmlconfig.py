@@ -16,6 +16,8 @@
 
 import unittest
 import os
+import shutil
+import tempfile
 import logging
 
 import libvirt
@@ -31,6 +33,7 @@ from virtinst import VirtualVideoDevice
 from virtinst import VirtualController
 from virtinst import VirtualWatchdog
 from virtinst import VirtualInputDevice
+from virtinst.XMLBuilderDomain import _max_xml_overlay
 import utils
 
 _testconn = utils.open_testdriver()
@@ -877,6 +880,35 @@ class TestXMLConfig(unittest.TestCase):
         finally:
             setattr(i, "_get_system_scratchdir", origscratch)
 
+    def testOriginalMediaCleanup(self):
+        utils.set_conn(_plainkvm)
+        tmpdir = tempfile.mkdtemp(prefix="virtinst-origmedia")
+        try:
+            # Kernel is a symlink to a file outside of the tree
+            tree = os.path.join(tmpdir, "tree")
+            bootdir = os.path.join(tree, "images", "pxeboot")
+            os.makedirs(bootdir)
+            outside = os.path.join(tmpdir, "vmlinuz-outside")
+            open(outside, "w").write("kernel")
+            kernel = os.path.join(bootdir, "vmlinuz")
+            os.symlink(outside, kernel)
+            initrd = os.path.join(bootdir, "initrd.img")
+            open(initrd, "w").write("initrd")
+
+            i = utils.make_distro_installer(location=tree, gtype="kvm")
+            i.use_original_media = True
+            g = utils.get_basic_fullyvirt_guest("kvm", installer=i)
+            setattr(i, "_get_system_scratchdir", lambda: i.scratchdir)
+
+            i._prepare_kernel_and_initrd(g, progress.BaseMeter())
+            self.assertEquals(i.boot, {"kernel": kernel, "initrd": initrd})
+
+            i.cleanup()
+            for path in [kernel, outside, initrd]:
+                self.assertTrue(os.path.exists(path))
+        finally:
+            shutil.rmtree(tmpdir)
+
     def testFullKVMWinxp(self):
         utils.set_conn(_plainkvm)
         g = utils.build_win_kvm("/default-pool/winxp.img")
@@ -955,5 +987,61 @@ class TestXMLConfig(unittest.TestCase):
                           virtinst.Guest.cpuset_str_to_tuple,
                           conn, "16")
 
+    def testXMLBuffer(self):
+        frags = ["", "<foo>", "", "  <bar/>\n", "", "</foo>\n"]
+        for start in ["", "<top>"]:
+            orig = start
+            buf = virtinst._util.XMLBuffer(start)
+            for frag in frags:
+                orig = virtinst._util.xml_append(orig, frag)
+                buf.append(frag)
+            self.assertEquals(buf.getvalue(), orig)
+
+        self.assertEquals(virtinst.XMLBuilderDomain.indent("a\n b\n", 2),
+                          "  a\n   b\n")
+        self.assertEquals(virtinst.XMLBuilderDomain.indent("", 2), "")
+
+    def testDeviceXMLCache(self):
+        utils.set_conn(_plainkvm)
+        g = utils.build_win_kvm("/default-pool/winxp.img")
+        VirtualDevice = virtinst.VirtualDevice
+
+        g._prepare_install(progress.BaseMeter())
+        try:
+            xml = g.get_config_xml(install=False)
+            built = VirtualDevice.fragments_built
+            reused = VirtualDevice.fragments_reused
+
+            # Nothing changed, every device fragment is reused
+            self.assertEquals(g.get_config_xml(install=False), xml)
+            self.assertEquals(VirtualDevice.fragments_built, built)
+            self.assertTrue(VirtualDevice.fragments_reused > reused)
+
+            # Only the changed disk is rebuilt
+            g.disks[0].driver_cache = VirtualDisk.CACHE_MODE_NONE
+            newxml = g.get_config_xml(install=False)
+            self.assertEquals(VirtualDevice.fragments_built, built + 1)
+            self.assertTrue("cache='none'" in newxml)
+            self.assertFalse("cache='none'" in xml)
+        finally:
+            g._cleanup_install()
+
+    def testXMLStateTracking(self):
+        g = utils.get_basic_fullyvirt_guest()
+        # Only device XML is cached, other objects aren't tracked
+        self.assertNotEquals(g._xml_state(), g._xml_state())
+
+        dev = VirtualAudio("es1370", conn=g.conn)
+        devcopy = dev.copy()
+        self.assertEquals(dev._xml_state(), devcopy._xml_state())
+
+        # Copies log what is set on them, up to a limit
+        state = devcopy._xml_state()
+        for ignore in range(100):
+            devcopy.model = "sb16"
+        self.assertTrue(len(devcopy._xml_overlay) <= _max_xml_overlay)
+        self.assertNotEquals(devcopy._xml_state(), state)
+        self.assertEquals(devcopy._xml_state(), devcopy._xml_state())
+
 if __name__ == "__main__":
     unittest.main()
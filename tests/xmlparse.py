@@ -16,9 +16,11 @@
 
 import unittest
 import glob
+import gc
 import traceback
 
 import virtinst
+from virtinst.XMLBuilderDomain import _xml_refs, _xml_handles
 
 import utils
 
@@ -754,5 +756,71 @@ class XMLParseTest(unittest.TestCase):
 
         self._alter_compare(guest.get_config_xml(), outfile)
 
+    def testXMLPathCache(self):
+        xml = file("tests/xmlparse-xml/change-disk-in.xml").read()
+        cache = virtinst._util._xml_doc_cache
+        cache.clear()
+
+        parses = cache.parses
+        name, uuid = virtinst._util.get_xml_paths(xml, ["/domain/name",
+                                                        "/domain/uuid"])
+        self.assertEquals(name, virtinst.util.get_xml_path(xml,
+                                                           "/domain/name"))
+        self.assertEquals(uuid, virtinst.util.get_xml_path(xml,
+                                                           "/domain/uuid"))
+        self.assertEquals(cache.parses, parses + 1)
+
+        # Filling the cache evicts the least recently used document
+        for i in range(cache.maxsize):
+            virtinst.util.get_xml_path("<foo><bar>%d</bar></foo>" % i,
+                                       "/foo/bar")
+        self.assertEquals(virtinst.util.get_xml_path(xml, "/domain/name"),
+                          name)
+        self.assertEquals(cache.parses, parses + cache.maxsize + 2)
+
+    def testDocRefs(self):
+        xml = file("tests/xmlparse-xml/change-addr-in.xml").read()
+        gc.collect()
+        startrefs = len(_xml_refs)
+        starthandles = len(_xml_handles)
+
+        guests = [virtinst.Guest(conn=conn, parsexml=xml) for i in range(20)]
+        self.assertEquals(len(_xml_refs), startrefs + 20)
+
+        # Devices keep the document alive after the guest goes away
+        dev = guests[0].get_devices("disk")[0]
+        # All objects backed by a document share its xpath context
+        self.assertTrue(dev._xml_ctx is guests[0]._xml_ctx)
+        del(guests)
+        gc.collect()
+        self.assertEquals(len(_xml_refs), startrefs + 1)
+        self.assertTrue(dev.get_xml_config())
+
+        del(dev)
+        gc.collect()
+        self.assertEquals(len(_xml_refs), startrefs)
+        self.assertEquals(len(_xml_handles), starthandles)
+
+    def testXPathLookupCache(self):
+        xml = file("tests/xmlparse-xml/change-guest-in.xml").read()
+        guest = virtinst.Guest(conn=conn, parsexml=xml)
+
+        # Lookups are remembered, and forgotten when nodes come and go
+        self.assertEquals(guest.description, None)
+        guest.description = "foo"
+        self.assertEquals(guest.description, "foo")
+        guest.description = None
+        self.assertEquals(guest.description, None)
+        guest.description = "bar"
+        self.assertEquals(guest.description, "bar")
+
+        # Removing nodes forgets earlier lookups under them
+        xml = file("tests/xmlparse-xml/change-addr-in.xml").read()
+        guest = virtinst.Guest(conn=conn, parsexml=xml)
+        disk = guest.get_devices("disk")[0]
+        self.assertEquals(disk.address.type, "drive")
+        disk.address.clear()
+        self.assertEquals(disk.address.type, None)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,87 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+"""
+Stress test of Guest(parsexml=...) document lifetimes.
+
+Usage: python tests/xmlparsebench.py [count] [batch] [xml file]
+
+Run from the top of the source tree. Parses count (default 10000)
+domain XMLs, keeping the last batch (default 1000) guests alive, and
+prints the time per parse for each batch along with the number of live
+libxml2 documents and bytes allocated by libxml2. Per parse cost should
+stay flat. Exits non-zero if any document is still allocated once all
+guests are gone.
+"""
+
+import gc
+import os
+import sys
+import time
+
+import libxml2
+# Must come before libxml2 allocates anything
+libxml2.debugMemory(1)
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import virtinst
+import virtinst.cli
+from virtinst.XMLBuilderDomain import _xml_refs
+
+_testuri = "test:///%s/tests/testdriver.xml" % os.getcwd()
+
+def main():
+    args = sys.argv[1:]
+    count = int(args and args.pop(0) or 10000)
+    batch = int(args and args.pop(0) or 1000)
+    xmlfile = args and args.pop(0) or "tests/xmlparse-xml/change-addr-in.xml"
+
+    conn = virtinst.cli.getConnection(_testuri)
+    xml = file(xmlfile).read()
+
+    gc.collect()
+    startdocs = len(_xml_refs)
+    startmem = libxml2.debugMemory(1)
+
+    print "%-8s %10s %10s %10s %12s" % ("parsed", "seconds", "ms/parse",
+                                        "live docs", "libxml2 mem")
+    guests = []
+    done = 0
+    while done < count:
+        num = min(batch, count - done)
+        start = time.time()
+        for i in range(num):
+            guests.append(virtinst.Guest(conn=conn, parsexml=xml))
+            if len(guests) > batch:
+                guests.pop(0)
+        secs = time.time() - start
+        done += num
+
+        print "%-8d %10.2f %10.3f %10d %12d" % (
+            done, secs, secs * 1000 / num,
+            len(_xml_refs) - startdocs,
+            libxml2.debugMemory(1) - startmem)
+
+    del(guests)
+    gc.collect()
+    leaked = len(_xml_refs) - startdocs
+    print "leaked documents: %d, leaked libxml2 memory: %d bytes" % (
+          leaked, libxml2.debugMemory(1) - startmem)
+    if leaked:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+"""
+Benchmark of property get/set on parsed guests, with and without the
+per document xpath lookup cache.
+
+Usage: python tests/xmlpropbench.py [iterations]
+
+Run from the top of the source tree. Each iteration reads and writes a
+mix of Guest, Clock, Seclabel, Installer and DomainFeatures properties,
+like the edits in tests/xmlparse.py.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import virtinst
+import virtinst.cli
+
+_testuri = "test:///%s/tests/testdriver.xml" % os.getcwd()
+_xmlfile = "tests/xmlparse-xml/change-guest-in.xml"
+
+def run(guest, iterations):
+    gets = 0
+    sets = 0
+    start = time.time()
+    for i in range(iterations):
+        for obj, prop in [(guest, "name"), (guest, "description"),
+                          (guest, "vcpus"), (guest, "memory"),
+                          (guest, "uuid"), (guest.clock, "offset"),
+                          (guest.seclabel, "model"),
+                          (guest.installer, "os_type"),
+                          (guest.features, "acpi")]:
+            getattr(obj, prop)
+            gets += 1
+
+        guest.name = "bench%d" % (i % 2)
+        guest.vcpus = i % 2 + 1
+        guest.memory = 200 + i % 2
+        guest.clock.offset = ["utc", "localtime"][i % 2]
+        guest.seclabel.label = "label%d" % (i % 2)
+        sets += 5
+    return time.time() - start, gets + sets
+
+def main():
+    args = sys.argv[1:]
+    iterations = int(args and args.pop(0) or 5000)
+
+    conn = virtinst.cli.getConnection(_testuri)
+    xml = file(_xmlfile).read()
+
+    print "%-10s %10s %12s" % ("cache", "seconds", "ops/s")
+    for cache in [False, True]:
+        virtinst.XMLBuilderDomain._cache_nodes = cache
+        guest = virtinst.Guest(conn=conn, parsexml=xml)
+        secs, ops = run(guest, iterations)
+        print "%-10s %10.2f %12.0f" % (cache and "on" or "off", secs,
+                                       ops / secs)
+
+if __name__ == "__main__":
+    main()
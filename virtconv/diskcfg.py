@@ -19,7 +19,6 @@
 #
 
 import subprocess
-import shutil
 import errno
 import sys
 import os
@@ -27,6 +26,7 @@ import re
 import logging
 
 from virtconv import _gettext as _
+from virtinst import _filecopy
 
 DISK_FORMAT_NONE = 0
 DISK_FORMAT_RAW = 1
@@ -139,7 +139,7 @@ class disk(object):
         """Copy an individual file."""
         self.clean += [ outfile ]
         ensuredirs(outfile)
-        shutil.copy(infile, outfile)
+        _filecopy.copy_file(infile, outfile)
 
     def out_file(self, out_format):
         """Return the relative path of the output file."""
@@ -91,7 +91,7 @@ def host(conn=None):
     gives no indication of 32 vs 64 bitness.
     """
     if conn:
-        cap = CapabilitiesParser.parse(conn.getCapabilities())
+        cap = CapabilitiesParser.get_conn_caps(conn)
         if cap.host.arch == "i86pc":
             return "SunOS"
         else:
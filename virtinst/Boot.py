@@ -94,25 +94,24 @@ class Boot(XMLBuilderDomain.XMLBuilderDomain):
                                 xpath="./os/cmdline")
 
     def _get_xml_config(self):
-        xml = ""
+        xml = _util.XMLBuffer()
 
         if self.kernel:
-            xml = _util.xml_append(xml, "    <kernel>%s</kernel>" %
-                                   _util.xml_escape(self.kernel))
+            xml.append("    <kernel>%s</kernel>" %
+                       _util.xml_escape(self.kernel))
             if self.initrd:
-                xml = _util.xml_append(xml, "    <initrd>%s</initrd>" %
-                                       _util.xml_escape(self.initrd))
+                xml.append("    <initrd>%s</initrd>" %
+                           _util.xml_escape(self.initrd))
             if self.kernel_args:
-                xml = _util.xml_append(xml, "    <cmdline>%s</cmdline>" %
-                                       _util.xml_escape(self.kernel_args))
+                xml.append("    <cmdline>%s</cmdline>" %
+                           _util.xml_escape(self.kernel_args))
 
         else:
             for dev in self.bootorder:
-                xml = _util.xml_append(xml, "    <boot dev='%s'/>" % dev)
+                xml.append("    <boot dev='%s'/>" % dev)
 
             if self.enable_bootmenu in [True, False]:
                 val = self.enable_bootmenu and "yes" or "no"
-                xml = _util.xml_append(xml,
-                                       "    <bootmenu enable='%s'/>" % val)
+                xml.append("    <bootmenu enable='%s'/>" % val)
 
-        return xml
+        return xml.getvalue()
@@ -253,10 +253,8 @@ class CPU(XMLBuilderDomain.XMLBuilderDomain):
         return "    <topology%s/>\n" % xml
 
     def _get_feature_xml(self):
-        xml = ""
-        for feature in self._features:
-            xml += feature.get_xml_config() + "\n"
-        return xml
+        return "".join([feature.get_xml_config() + "\n"
+                        for feature in self._features])
 
     def _get_xml_config(self):
         top_xml = self._get_topology_xml()
@@ -678,6 +678,44 @@ def parse(xml):
                                    Capabilities,
                                    CapabilitiesParserException)
 
+# Name of the shared Capabilities in _util.get_conn_cache
+_conn_cache_name = "caps"
+
+# Number of capabilities fetches made, and avoided, by get_conn_caps
+caps_fetches = 0
+caps_fetches_avoided = 0
+
+def get_conn_caps(conn, refresh=False):
+    """
+    Return the Capabilities instance shared by all users of the passed
+    connection. Capabilities are only fetched and parsed on first use,
+    or when refresh is requested.
+
+    @param conn: virConnect instance
+    @param refresh: Refetch capabilities from the connection
+    """
+    global caps_fetches, caps_fetches_avoided
+
+    caps = _util.get_conn_cache(conn, _conn_cache_name)
+    if caps is not None and not refresh:
+        caps_fetches_avoided += 1
+        return caps
+
+    caps = parse(conn.getCapabilities())
+    caps_fetches += 1
+    set_conn_caps(conn, caps)
+    return caps
+
+def set_conn_caps(conn, caps):
+    """
+    Set the Capabilities instance returned by get_conn_caps for conn
+    """
+    _util.set_conn_cache(conn, _conn_cache_name, caps)
+
+def stats_string():
+    return ("Capabilities: %d fetches, %d fetches avoided" %
+            (caps_fetches, caps_fetches_avoided))
+
 def guest_lookup(conn, caps=None, os_type=None, arch=None, type=None,
                  accelerated=False, machine=None):
     """
@@ -716,7 +754,7 @@ def guest_lookup(conn, caps=None, os_type=None, arch=None, type=None,
     """
 
     if not caps:
-        caps = parse(conn.getCapabilities())
+        caps = get_conn_caps(conn)
 
     guest = caps.guestForOSType(type=os_type, arch=arch)
     if not guest:
@@ -35,12 +35,16 @@ General workflow for cloning:
 import logging
 import re
 import os
+import sys
+import threading
+import Queue
 
 import libxml2
 import urlgrabber.progress as progress
 import libvirt
 
 import Guest
+import GuestInventory
 from VirtualNetworkInterface import VirtualNetworkInterface
 from VirtualDisk import VirtualDisk
 from virtinst import Storage
@@ -142,6 +146,7 @@ class CloneDesign(object):
         self._skip_target        = []
         self._preserve           = True
         self._clone_running      = False
+        self._max_parallel_disks = 1
 
         # Default clone policy for back compat: don't clone readonly,
         # shareable, or empty disks
@@ -383,6 +388,23 @@ class CloneDesign(object):
                                  "domain state is not checked before "
                                  "cloning.")
 
+    def get_max_parallel_disks(self):
+        return self._max_parallel_disks
+    def set_max_parallel_disks(self, val):
+        try:
+            val = int(val)
+        except (ValueError, TypeError):
+            raise ValueError(_("Max parallel disks must be an integer."))
+        if val < 1:
+            raise ValueError(_("Max parallel disks must be at least 1."))
+        self._max_parallel_disks = val
+    max_parallel_disks = property(get_max_parallel_disks,
+                                  set_max_parallel_disks,
+                                  doc="Maximum number of disks to clone at "
+                                      "the same time. If any disk fails, "
+                                      "the other clones are cancelled and "
+                                      "their partial output removed.")
+
     def _get_replace(self):
         return self._valid_guest.replace
     def _set_replace(self, val):
@@ -623,11 +645,13 @@ class CloneDesign(object):
     # Cloning policy based on 'clone_policy', 'force_target' and 'skip_target'
     def _do_we_clone_device(self, xml, i):
         base_path = "/domain/devices/disk[%d]" % i
-        source  = _util.get_xml_path(xml, "%s/source/@dev | %s/source/@file" %
-                                     (base_path, base_path))
-        target  = _util.get_xml_path(xml, base_path + "/target/@dev")
-        ro      = _util.get_xml_path(xml, "count(%s/readonly)" % base_path)
-        share   = _util.get_xml_path(xml, "count(%s/shareable)" % base_path)
+        (source, target,
+         ro, share) = _util.get_xml_paths(xml,
+                        ["%s/source/@dev | %s/source/@file" %
+                         (base_path, base_path),
+                         base_path + "/target/@dev",
+                         "count(%s/readonly)" % base_path,
+                         "count(%s/shareable)" % base_path])
 
         if not target:
             raise ValueError("XML has no 'dev' attribute in disk target")
@@ -678,6 +702,7 @@ def start_duplicate(design, meter=None):
 
         # Define domain early to catch any xml errors before duping storage
         dom = design.original_conn.defineXML(design.clone_xml)
+        GuestInventory.invalidate_inventory(design.original_conn)
 
         if design.preserve == True:
             _do_duplicate(design, meter)
@@ -694,7 +719,7 @@ def start_duplicate(design, meter=None):
 # clone method
 def _do_duplicate(design, meter):
 
-    # Now actually do the cloning
+    disks = []
     for dst_dev in design.clone_virtual_disks:
         if dst_dev.clone_path == "/dev/null":
             # Not really sure why this check was here, but keeping for compat
@@ -703,6 +728,203 @@ def _do_duplicate(design, meter):
         elif dst_dev.clone_path == dst_dev.path:
             logging.debug("Source and destination are the same. Skipping.")
             continue
+        disks.append(dst_dev)
 
+    if design.max_parallel_disks > 1 and len(disks) > 1:
+        _do_duplicate_parallel(disks, design.max_parallel_disks, meter)
+        return
+
+    # Now actually do the cloning
+    for dst_dev in disks:
         # VirtualDisk.setup handles everything
         dst_dev.setup(meter)
+
+class _CloneCancelled(Exception):
+    pass
+
+class _AggregateMeter(object):
+    """
+    Combines the progress of several concurrent disk clones into a single
+    meter, so it shows total throughput and ETA. Each clone reports to its
+    own child meter from disk_meter().
+    """
+    def __init__(self, meter, total_size, text):
+        self.meter = meter
+        self.total_size = total_size
+        self.text = text
+
+        self.cancelled = False
+        self.error = None
+
+        self._lock = threading.Lock()
+        self._progress = {}
+
+    def start(self):
+        self.meter.start(size=self.total_size, text=self.text)
+
+    def end(self):
+        self.meter.end(self.total_size)
+
+    def cancel(self, exc_info):
+        """
+        Record exc_info as the failure that stops all clones. Returns
+        False if the clone was already cancelled.
+        """
+        self._lock.acquire()
+        try:
+            if self.cancelled:
+                return False
+            self.cancelled = True
+            self.error = exc_info
+            return True
+        finally:
+            self._lock.release()
+
+    def disk_meter(self):
+        return _DiskMeter(self)
+
+    def report(self, child, amount):
+        self._lock.acquire()
+        try:
+            self._progress[child] = amount
+            total = sum(self._progress.values())
+            self.meter.update(min(total, self.total_size))
+        finally:
+            self._lock.release()
+
+class _DiskMeter(object):
+    """
+    Progress meter handed to a single VirtualDisk.setup call
+    """
+    def __init__(self, parent):
+        self.parent = parent
+        self.size = None
+
+    def _clamp(self, amount):
+        if self.size:
+            return min(amount, self.size)
+        return amount
+
+    def start(self, filename=None, url=None, basename=None,
+              size=None, now=None, text=None):
+        ignore = filename, url, basename, now, text
+        self.size = size
+
+    def update(self, amount_read, now=None):
+        ignore = now
+        # Storage's allocation progress thread calls this too, so only
+        # report here and leave stopping the clone to check_cancelled
+        self.parent.report(self, self._clamp(amount_read))
+
+    def check_cancelled(self):
+        """
+        Raise _CloneCancelled if another disk failed. Called from the
+        local copy loop, so the clone stops on its own thread.
+        """
+        if self.parent.cancelled:
+            raise _CloneCancelled()
+
+    def end(self, amount_read, now=None):
+        ignore = now
+        self.parent.report(self, self.size or amount_read)
+
+def _partial_output_remover(dst_dev):
+    """
+    Return a function that removes the clone output of dst_dev, or None
+    if the output already exists and must be left alone
+    """
+    vol_install = dst_dev.vol_install
+    if vol_install:
+        try:
+            vol_install.pool.storageVolLookupByName(vol_install.name)
+            return None
+        except libvirt.libvirtError:
+            pass
+    if dst_dev.path and os.path.exists(dst_dev.path):
+        return None
+
+    def remove():
+        if vol_install:
+            try:
+                vol = vol_install.pool.storageVolLookupByName(vol_install.name)
+            except libvirt.libvirtError:
+                vol = None
+            if vol:
+                logging.debug("Removing partial clone volume '%s'" %
+                              vol_install.name)
+                vol.delete(0)
+                return
+        if dst_dev.path and os.path.exists(dst_dev.path):
+            logging.debug("Removing partial clone '%s'" % dst_dev.path)
+            os.unlink(dst_dev.path)
+    return remove
+
+def _do_duplicate_parallel(disks, max_parallel, meter):
+    """
+    Clone disks on a pool of max_parallel worker threads. If any disk
+    fails, the others are cancelled (in-progress volume creations by
+    libvirt are waited for), every output the clone created is removed,
+    and the first error is raised.
+    """
+    total_size = 0
+    for dst_dev in disks:
+        total_size += long(dst_dev.size * 1024L * 1024L * 1024L)
+
+    agg = _AggregateMeter(meter, total_size,
+                          _("Cloning %d disks") % len(disks))
+    todo = Queue.Queue()
+    for dst_dev in disks:
+        todo.put(dst_dev)
+    removers = []
+
+    def worker():
+        while not agg.cancelled:
+            try:
+                dst_dev = todo.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                remover = _partial_output_remover(dst_dev)
+                if remover:
+                    removers.append(remover)
+                dst_dev.setup(agg.disk_meter())
+            except:
+                if agg.cancel(sys.exc_info()):
+                    logging.debug("Cloning %s failed, cancelling other "
+                                  "disks" % dst_dev.path, exc_info=True)
+                else:
+                    logging.debug("Cloning %s stopped: %s" %
+                                  (dst_dev.path, sys.exc_info()[1]))
+
+    nthreads = min(max_parallel, len(disks))
+    logging.debug("Cloning %d disks with %d threads" %
+                  (len(disks), nthreads))
+
+    agg.start()
+    threads = []
+    for ignore in range(nthreads):
+        t = threading.Thread(target=worker, name="Cloning disk")
+        t.setDaemon(True)
+        threads.append(t)
+        t.start()
+
+    for t in threads:
+        # Join with a timeout so KeyboardInterrupt is still delivered
+        while t.isAlive():
+            try:
+                t.join(1)
+            except KeyboardInterrupt:
+                agg.cancel(sys.exc_info())
+
+    if not agg.error:
+        agg.end()
+        return
+
+    for remover in removers:
+        try:
+            remover()
+        except Exception, e:
+            logging.debug("Error removing partial clone output: %s" % e)
+
+    raise agg.error[0], agg.error[1], agg.error[2]
@@ -19,14 +19,14 @@
 
 import logging
 import os
-import sys
-import shutil
-import subprocess
-import tempfile
+
+import libvirt
 
 import Storage
 import support
 import _util
+import _filecopy
+import _cpio
 import Installer
 from VirtualDisk import VirtualDisk
 from User import User
@@ -85,16 +85,88 @@ def _build_pool(conn, meter, path):
                              autostart=True)
 
 
-def _upload_file(conn, meter, destpool, src):
-    # Build stream object
-    stream = conn.newStream(0)
-    def safe_send(data):
-        while True:
-            ret = stream.send(data)
-            if ret == 0 or ret == len(data):
-                break
-            data = data[ret:]
+# Bytes read from the source and sent per stream call
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+def _stream_send(stream, data):
+    """
+    Send all of data, handling partial sends. buffer() views are used
+    for the remainder so the string is never copied.
+    """
+    view = data
+    offset = 0
+    while offset < len(data):
+        ret = stream.send(view)
+        if ret <= 0:
+            raise RuntimeError(_("Stream send failed with %d bytes "
+                                 "remaining") % (len(data) - offset))
+        offset += ret
+        view = buffer(data, offset)
+
+def _stream_file(stream, meter, src, chunk_size=None, sparse=False,
+                 use_sendall=False):
+    """
+    Send the contents of local file src over stream, reporting progress
+    on meter.
+
+    @param chunk_size: Bytes to read and send at a time
+    @param sparse: Only read and send the data regions of src, and send
+                   the holes with stream.sendHole. The stream must be set
+                   up for a sparse upload.
+    @param use_sendall: Use the stream's sendAll callback API when
+                        available. Not used for sparse transfers.
+    @returns: Number of data bytes sent
+    """
+    chunk_size = chunk_size or UPLOAD_CHUNK_SIZE
+
+    fd = os.open(src, os.O_RDONLY)
+    try:
+        size = _filecopy.fd_size(fd)
+        if sparse:
+            extents, ignore = _filecopy.data_extents(fd, size)
+        else:
+            extents = [(0, size)]
+
+        meter.start(size=size,
+                    text=_("Transferring %s") % os.path.basename(src))
+
+        if use_sendall and not sparse and hasattr(stream, "sendAll"):
+            state = {"pos": 0}
+            def handler(ignore1, nbytes, ignore2):
+                data = os.read(fd, min(chunk_size, nbytes))
+                state["pos"] += len(data)
+                meter.update(state["pos"])
+                return data
+            stream.sendAll(handler, None)
+            sent = state["pos"]
+        else:
+            sent = 0
+            pos = 0
+            for offset, length in extents + [(size, 0)]:
+                if offset > pos:
+                    stream.sendHole(offset - pos, 0)
+                    meter.update(offset)
+
+                os.lseek(fd, offset, 0)
+                end = offset + length
+                pos = offset
+                while pos < end:
+                    data = os.read(fd, min(chunk_size, end - pos))
+                    if not data:
+                        raise RuntimeError(_("Unexpected end of file "
+                                             "reading %s") % src)
+                    _stream_send(stream, data)
+                    pos += len(data)
+                    sent += len(data)
+                    meter.update(pos)
+
+        meter.end(size)
+        return sent
+    finally:
+        os.close(fd)
 
+def _upload_file(conn, meter, destpool, src, chunk_size=None,
+                 use_sendall=False):
     # Build placeholder volume
     size = os.path.getsize(src)
     basename = os.path.basename(src)
@@ -114,34 +186,28 @@ def _upload_file(conn, meter, destpool, src):
     if not vol:
         raise RuntimeError(_("Failed to lookup scratch media volume"))
 
+    # The volume is sparse, so only send the data regions if we can
+    sparse = support.check_stream_support(conn,
+                                support.SUPPORT_STREAM_SPARSE_UPLOAD)
+
     try:
         # Register upload
+        stream = conn.newStream(0)
         offset = 0
         length = size
         flags = 0
+        if sparse:
+            flags |= libvirt.VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM
         stream.upload(vol, offset, length, flags)
 
-        # Open source file
-        fileobj = file(src, "r")
-
         # Start transfer
-        total = 0
-        meter.start(size=size,
-                    text=_("Transferring %s") % os.path.basename(src))
-        while True:
-            #blocksize = (1024 ** 2)
-            blocksize = 1024
-            data = fileobj.read(blocksize)
-            if not data:
-                break
-
-            safe_send(data)
-            total += len(data)
-            meter.update(total)
+        sent = _stream_file(stream, meter, src, chunk_size=chunk_size,
+                            sparse=sparse, use_sendall=use_sendall)
+        logging.debug("Uploaded %s: %d bytes, %d of them data" %
+                      (src, size, sent))
 
         # Cleanup
         stream.finish()
-        meter.end(size)
     except:
         if vol:
             vol.delete(0)
@@ -158,6 +224,7 @@ class DistroInstaller(Installer.Installer):
                                      os_type, conn=conn, caps=caps)
 
         self._livecd = False
+        self._use_original_media = False
 
         # True == location is a filesystem path
         # False == location is a url
@@ -171,6 +238,18 @@ class DistroInstaller(Installer.Installer):
         self._livecd = bool(val)
     livecd = property(_get_livecd, _set_livecd)
 
+    def _get_use_original_media(self):
+        return self._use_original_media
+    def _set_use_original_media(self, val):
+        self._use_original_media = bool(val)
+    use_original_media = property(_get_use_original_media,
+                                  _set_use_original_media,
+                                  doc="If the location is a local install "
+                                      "tree, boot its kernel and initrd in "
+                                      "place rather than copying them to "
+                                      "scratchdir. The hypervisor must be "
+                                      "able to read them there.")
+
     def get_location(self):
         return self._location
     def set_location(self, val):
@@ -276,29 +355,11 @@ class DistroInstaller(Installer.Installer):
         """
         Insert files into the root directory of the initial ram disk
         """
-        tempdir = tempfile.mkdtemp(dir=self.scratchdir)
-        os.chmod(tempdir, 0775)
-
         for filename in self._initrd_injections:
-            logging.debug("Copying %s to the initrd." % filename)
-            shutil.copy(filename, tempdir)
+            logging.debug("Injecting %s into the initrd." % filename)
 
         logging.debug("Appending to the initrd.")
-        find_proc = subprocess.Popen(['find', '.', '-print0'],
-                                     stdout=subprocess.PIPE,
-                                     stderr=sys.stderr, cwd=tempdir)
-        cpio_proc = subprocess.Popen(['cpio', '-o', '--null', '-Hnewc', '--quiet'],
-                                     stdin=find_proc.stdout,
-                                     stdout=subprocess.PIPE,
-                                     stderr=sys.stderr, cwd=tempdir)
-        f = open(initrd, 'ab')
-        gzip_proc = subprocess.Popen(['gzip'], stdin=cpio_proc.stdout,
-                                     stdout=f, stderr=sys.stderr)
-        cpio_proc.wait()
-        find_proc.wait()
-        gzip_proc.wait()
-        f.close()
-        shutil.rmtree(tempdir)
+        _cpio.append_injections(initrd, self._initrd_injections)
 
     def support_remote_url_install(self):
         if not self.conn:
@@ -362,10 +423,16 @@ class DistroInstaller(Installer.Installer):
 
         # Need to fetch the kernel & initrd from a remote site, or
         # out of a loopback mounted disk image/device
-        ignore, os_type, os_variant, media = OSDistro.acquireKernel(guest,
-                                                self.location, meter,
-                                                self.scratchdir,
-                                                self.os_type)
+        # Initrd injections modify the initrd, so it has to be a copy
+        original_paths = (self._use_original_media and
+                          not self._initrd_injections)
+        ret = OSDistro.acquireKernel(guest, self.location, meter,
+                                     self.scratchdir, self.os_type,
+                                     original_paths)
+        in_place = []
+        if original_paths:
+            in_place = ret.pop()
+        ignore, os_type, os_variant, media = ret
         (kernelfn, initrdfn, args) = media
 
         if guest.get_os_autodetect():
@@ -377,9 +444,9 @@ class DistroInstaller(Installer.Installer):
                 logging.debug("Auto detected OS variant as: %s" % os_variant)
                 guest.os_variant = os_variant
 
-        self._tmpfiles.append(kernelfn)
-        if initrdfn:
-            self._tmpfiles.append(initrdfn)
+        for fn in [kernelfn, initrdfn]:
+            if fn and fn not in in_place:
+                self._tmpfiles.append(fn)
 
         if self._initrd_injections:
             self._perform_initrd_injections(initrdfn)
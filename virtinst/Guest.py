@@ -30,6 +30,7 @@ import libxml2
 
 import _util
 import CapabilitiesParser
+import GuestInventory
 import VirtualGraphics
 import support
 import XMLBuilderDomain
@@ -126,7 +127,7 @@ class Guest(XMLBuilderDomain.XMLBuilderDomain):
         If host doesn't have a suitable NUMA configuration, a RuntimeError
         is thrown.
         """
-        caps = CapabilitiesParser.parse(conn.getCapabilities())
+        caps = CapabilitiesParser.get_conn_caps(conn)
 
         if caps.host.topology is None:
             raise RuntimeError(_("No topology section in capabilities xml."))
@@ -870,12 +871,12 @@ class Guest(XMLBuilderDomain.XMLBuilderDomain):
                 if origpath:
                     dev.path = origpath
 
-        xml = self._get_emulator_xml()
+        xml = _util.XMLBuffer(self._get_emulator_xml())
         # Build XML
         for dev in devs:
-            xml = _util.xml_append(xml, get_dev_xml(dev))
+            xml.append(get_dev_xml(dev))
 
-        return xml
+        return xml.getvalue()
 
     def _get_emulator_xml(self):
         emulator = self.emulator
@@ -1044,42 +1045,42 @@ class Guest(XMLBuilderDomain.XMLBuilderDomain):
             desc_xml = ("  <description>%s</description>" %
                         _util.xml_escape(desc))
 
-        xml = ""
-        add = lambda x: _util.xml_append(xml, x)
+        xml = _util.XMLBuffer()
+        add = xml.append
 
-        xml = add("<domain type='%s'>" % self.type)
-        xml = add("  <name>%s</name>" % self.name)
-        xml = add("  <uuid>%s</uuid>" % self.uuid)
-        xml = add(desc_xml)
-        xml = add("  <memory>%s</memory>" % (self.maxmemory * 1024))
-        xml = add("  <currentMemory>%s</currentMemory>" % (self.memory * 1024))
+        add("<domain type='%s'>" % self.type)
+        add("  <name>%s</name>" % self.name)
+        add("  <uuid>%s</uuid>" % self.uuid)
+        add(desc_xml)
+        add("  <memory>%s</memory>" % (self.maxmemory * 1024))
+        add("  <currentMemory>%s</currentMemory>" % (self.memory * 1024))
 
         # <blkiotune>
         # <memtune>
         if self.hugepage is True:
-            xml = add("  <memoryBacking>")
-            xml = add("    <hugepages/>")
-            xml = add("  </memoryBacking>")
+            add("  <memoryBacking>")
+            add("    <hugepages/>")
+            add("  </memoryBacking>")
 
-        xml = add(self._get_vcpu_xml())
+        add(self._get_vcpu_xml())
         # <cputune>
-        xml = add(self.numatune.get_xml_config())
+        add(self.numatune.get_xml_config())
         # <sysinfo>
         # XXX: <bootloader> goes here, not in installer XML
-        xml = add("  %s" % osblob)
-        xml = add(self._get_features_xml(tmpfeat))
-        xml = add(self._get_cpu_xml())
-        xml = add(self._get_clock_xml())
-        xml = add("  <on_poweroff>destroy</on_poweroff>")
-        xml = add("  <on_reboot>%s</on_reboot>" % action)
-        xml = add("  <on_crash>%s</on_crash>" % action)
-        xml = add("  <devices>")
-        xml = add(self._get_device_xml(devs, install))
-        xml = add("  </devices>")
-        xml = add(self._get_seclabel_xml())
-        xml = add("</domain>\n")
-
-        return xml
+        add("  %s" % osblob)
+        add(self._get_features_xml(tmpfeat))
+        add(self._get_cpu_xml())
+        add(self._get_clock_xml())
+        add("  <on_poweroff>destroy</on_poweroff>")
+        add("  <on_reboot>%s</on_reboot>" % action)
+        add("  <on_crash>%s</on_crash>" % action)
+        add("  <devices>")
+        add(self._get_device_xml(devs, install))
+        add("  </devices>")
+        add(self._get_seclabel_xml())
+        add("</domain>\n")
+
+        return xml.getvalue()
 
     def post_install_check(self):
         """
@@ -1206,6 +1207,7 @@ class Guest(XMLBuilderDomain.XMLBuilderDomain):
         except libvirt.libvirtError, e:
             raise RuntimeError(_("Could not remove old vm '%s': %s") %
                                (self.name, str(e)))
+        GuestInventory.invalidate_inventory(self.conn)
 
     def start_install(self, consolecb=None, meter=None, removeOld=None,
                       wait=True, dry=False, return_xml=False, noboot=False):
@@ -1277,8 +1279,11 @@ class Guest(XMLBuilderDomain.XMLBuilderDomain):
         log_label = is_initial and "install" or "continue"
         disk_boot = not is_initial
 
+        reused = VirtualDevice.fragments_reused
         start_xml = self.get_xml_config(install=True, disk_boot=disk_boot)
         final_xml = self.get_xml_config(install=False)
+        logging.debug("Reused %d cached device XML fragments" %
+                      (VirtualDevice.fragments_reused - reused))
 
         logging.debug("Generated %s XML: %s" %
                       (log_label,
@@ -1318,6 +1323,7 @@ class Guest(XMLBuilderDomain.XMLBuilderDomain):
              self._consolechild) = self._wait_and_connect_console(consolecb)
 
         self.domain = self.conn.defineXML(final_xml)
+        GuestInventory.invalidate_inventory(self.conn)
         if is_initial:
             try:
                 logging.debug("XML fetched from libvirt object:\n%s",
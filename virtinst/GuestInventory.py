@@ -0,0 +1,196 @@
+#
+# Indexed snapshot of all guests defined on a connection
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+import logging
+
+import libvirt
+
+import _util
+
+# Name of the inventory in _util.get_conn_cache
+_conn_cache_name = "guest_inventory"
+
+# Disk source attributes we index, same as VirtualDisk._target_props
+_disk_source_props = ["file", "dev", "dir"]
+
+def normalize_mac(mac):
+    """
+    Return a canonical form of the passed MAC address string, so that
+    '0:16:3E:...' and '00:16:3e:...' hash to the same key. This matches
+    the semantics of util.compareMAC.
+    """
+    if not mac:
+        return mac
+    try:
+        return ":".join(["%02x" % int(p, 16) for p in mac.split(":")])
+    except ValueError:
+        return mac.lower()
+
+class _GuestEntry(object):
+    """
+    Everything we index from a single domain's XML
+    """
+    def __init__(self, name, active, xml):
+        self.name = name
+        self.active = active
+        self.xml = xml
+
+        self.macs = []
+        # List of (path, shareable) tuples
+        self.disks = []
+
+        _util.get_xml_path(xml, func=self._parse)
+
+    def _parse(self, ctx):
+        for mac in ctx.xpathEval("/domain/devices/interface/mac/@address"):
+            if mac.content:
+                self.macs.append(normalize_mac(mac.content))
+
+        for disk in ctx.xpathEval("/domain/devices/disk"):
+            shareable = bool(disk.xpathEval("shareable"))
+            for prop in _disk_source_props:
+                for src in disk.xpathEval("source/@%s" % prop):
+                    if src.content:
+                        self.disks.append((src.content, shareable))
+
+class GuestInventory(object):
+    """
+    Host wide guest inventory used for conflict checks.
+
+    Disk source paths, MAC addresses and names of all domains are
+    kept in hash indexes. Every query fetches the current XML of each
+    domain, so guests edited in place are seen, but only domains whose
+    XML changed since the last query are parsed and reindexed.
+
+    Use get_inventory() to fetch the instance shared by a connection.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+        self._entries = {}
+        self._disks = {}
+        self._macs = {}
+
+        self.xml_parses = 0
+
+    def invalidate(self):
+        """
+        Throw away all cached domain info, the next query reparses
+        everything
+        """
+        self._entries = {}
+
+    def refresh(self, force=False):
+        """
+        Bring the indexes up to date with the connection's guest list
+        """
+        if force:
+            self.invalidate()
+
+        active, inactive = _util.fetch_all_guests(self.conn)
+        entries = {}
+        changed = False
+
+        for vmlist, is_active in [(active, True), (inactive, False)]:
+            for vm in vmlist:
+                try:
+                    name = vm.name()
+                    xml = vm.XMLDesc(0)
+                except libvirt.libvirtError:
+                    # guest probably in process of dieing
+                    logging.debug("Failed to index guest", exc_info=True)
+                    continue
+
+                old = self._entries.get(name)
+                if old and old.active == is_active and old.xml == xml:
+                    entries[name] = old
+                    continue
+
+                entries[name] = _GuestEntry(name, is_active, xml)
+                self.xml_parses += 1
+                changed = True
+
+        if changed or len(entries) != len(self._entries):
+            self._entries = entries
+            self._build_indexes()
+
+    def _build_indexes(self):
+        disks = {}
+        macs = {}
+
+        for entry in self._entries.values():
+            for mac in entry.macs:
+                macs.setdefault(mac, []).append(entry)
+            for path, shareable in entry.disks:
+                disks.setdefault(path, []).append((entry, shareable))
+
+        self._disks = disks
+        self._macs = macs
+
+    #################
+    # Query methods #
+    #################
+
+    def path_in_use_by(self, path, check_conflict=False):
+        """
+        Return a list of guest names using the passed disk path. If
+        check_conflict, skip guests using the disk with the shareable flag.
+        """
+        self.refresh()
+
+        names = []
+        for entry, shareable in self._disks.get(path, []):
+            if check_conflict and shareable:
+                continue
+            if entry.name not in names:
+                names.append(entry.name)
+        return names
+
+    def mac_in_use_by(self, mac):
+        """
+        Return a tuple of lists ([active names], [inactive names]) of guests
+        using the passed MAC address
+        """
+        self.refresh()
+
+        active = []
+        inactive = []
+        for entry in self._macs.get(normalize_mac(mac), []):
+            if entry.active:
+                active.append(entry.name)
+            else:
+                inactive.append(entry.name)
+        return (active, inactive)
+
+    def name_in_use(self, name):
+        self.refresh()
+        return name in self._entries
+
+def get_inventory(conn):
+    """
+    Return the GuestInventory shared by all users of the passed connection
+    """
+    return _util.get_conn_cache(conn, _conn_cache_name, GuestInventory)
+
+def invalidate_inventory(conn):
+    """
+    Drop cached guest info for the passed connection, if any
+    """
+    inv = _util.get_conn_cache(conn, _conn_cache_name)
+    if inv is not None:
+        inv.invalidate()
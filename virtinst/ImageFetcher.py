@@ -24,20 +24,146 @@ import os
 import stat
 import subprocess
 import urlgrabber.grabber as grabber
+import urllib
 import urllib2
 import urlparse
+import httplib
+import socket
+import threading
 import ftplib
 import tempfile
+import time
 from virtinst import _gettext as _
+from virtinst import _filecopy
+from virtinst import mediacache
+from virtinst import isoreader
+
+# Max HTTP redirects followed on a pooled connection
+_max_redirects = 5
+# Bytes read at a time when downloading
+_read_size = 65536
+
+# saveTemp's read size for streams grows while reads complete quickly,
+# and shrinks when they stall so progress keeps being reported
+_min_block_size = 16384
+_max_block_size = 1024 * 1024
+_fast_read = 0.05
+_slow_read = 0.5
+
+def _proxy_configured():
+    for key in os.environ:
+        if key.lower() in ["http_proxy", "all_proxy"]:
+            return True
+    return False
+
+class _HTTPConnectionPool(object):
+    """
+    Keep-alive HTTP/1.1 connections to a single server, shared by all
+    requests of a fetcher. Safe to use from several threads.
+    """
+    def __init__(self, netloc):
+        self.netloc = netloc
+        self._idle = []
+        self._lock = threading.Lock()
+
+        self.connections = 0
+        self.requests = 0
+
+    def _get_conn(self):
+        self._lock.acquire()
+        try:
+            self.requests += 1
+            if self._idle:
+                return self._idle.pop(), True
+            self.connections += 1
+        finally:
+            self._lock.release()
+        return httplib.HTTPConnection(self.netloc), False
+
+    def release(self, conn, resp):
+        """
+        Hand back a connection once resp has been read completely
+        """
+        if resp.will_close:
+            conn.close()
+            return
+        self._lock.acquire()
+        try:
+            self._idle.append(conn)
+        finally:
+            self._lock.release()
+
+    def request(self, method, path):
+        """
+        Send a request, and return (conn, response). The caller must read
+        the whole response body and call release(). A connection the
+        server has closed in the meantime is replaced transparently.
+        """
+        while True:
+            conn, reused = self._get_conn()
+            try:
+                conn.request(method, path)
+                return conn, conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise
+
+    def head(self, path):
+        conn, resp = self.request("HEAD", path)
+        resp.read()
+        self.release(conn, resp)
+        return resp
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            for conn in self._idle:
+                conn.close()
+            self._idle = []
+        finally:
+            self._lock.release()
+
+    def stats_string(self):
+        return ("%d HTTP connections for %d requests to %s" %
+                (self.connections, self.requests, self.netloc))
+
+def _fileobj_fd(fileobj):
+    """
+    Return the fd of fileobj if it is a regular file nothing has been
+    read from yet, so it can be copied at the fd level, None otherwise
+    """
+    if not isinstance(fileobj, file):
+        return None
+    try:
+        if fileobj.tell() != 0:
+            return None
+        fd = fileobj.fileno()
+        if not _filecopy.is_regular_fd(fd):
+            return None
+    except (IOError, OSError):
+        return None
+    return fd
 
 # This is a generic base class for fetching/extracting files from
 # a media source, such as CD ISO, NFS server, or HTTP/FTP server
 class ImageFetcher:
 
+    # If set, acquireFile(readonly=True) may return the file in the source
+    # tree itself instead of a copy, for local trees
+    original_paths = False
+
     def __init__(self, location, scratchdir):
         self.location = location
         self.scratchdir = scratchdir
 
+        # mediacache.MediaCache for acquireFile, if any
+        self.cache = mediacache.get_default_cache()
+
+        # Source tree files acquireFile returned in place. Callers must
+        # not remove these.
+        self.in_place_paths = []
+
     def _make_path(self, filename):
         if hasattr(self, "srcdir"):
             path = getattr(self, "srcdir")
@@ -51,20 +177,56 @@ class ImageFetcher:
 
         return path
 
-    def saveTemp(self, fileobj, prefix):
-        if not os.path.exists(self.scratchdir):
-            os.makedirs(self.scratchdir, 0750)
+    def _copyStream(self, fileobj, fd, progress_cb):
+        block_size = _min_block_size
+        total = 0
+        while 1:
+            start = time.time()
+            buff = fileobj.read(block_size)
+            if not buff:
+                break
+            elapsed = time.time() - start
+            count = len(buff)
+
+            while buff:
+                buff = buff[os.write(fd, buff):]
+            total += count
+            if progress_cb:
+                progress_cb(total)
+
+            if count == block_size:
+                if elapsed < _fast_read and block_size < _max_block_size:
+                    block_size *= 2
+                elif elapsed > _slow_read and block_size > _min_block_size:
+                    block_size /= 2
+
+    def saveTemp(self, fileobj, prefix, dirname=None, progress_cb=None):
+        """
+        Copy fileobj to a new temp file in dirname (default scratchdir),
+        and return its path. Unread regular files are copied in kernel
+        or reflinked, see _filecopy.copy_data.
+
+        @param progress_cb: Called with the number of bytes copied so far
+        """
+        dirname = dirname or self.scratchdir
+        if not os.path.exists(dirname):
+            os.makedirs(dirname, 0750)
         (fd, fn) = tempfile.mkstemp(prefix="virtinst-" + prefix,
-                                    dir=self.scratchdir)
-        block_size = 16384
-        try:
-            while 1:
-                buff = fileobj.read(block_size)
-                if not buff:
-                    break
-                os.write(fd, buff)
-        finally:
-            os.close(fd)
+                                    dir=dirname)
+        try:
+            try:
+                src_fd = _fileobj_fd(fileobj)
+                if src_fd is not None:
+                    _filecopy.copy_data(src_fd, fd, _filecopy.fd_size(src_fd),
+                                        progress_cb=progress_cb)
+                else:
+                    self._copyStream(fileobj, fd, progress_cb)
+            finally:
+                os.close(fd)
+        except:
+            # Don't leave partial downloads behind
+            os.unlink(fn)
+            raise
         return fn
 
     def prepareLocation(self):
@@ -73,7 +235,15 @@ class ImageFetcher:
     def cleanupLocation(self):
         pass
 
-    def acquireFile(self, filename, progresscb):
+    def _cacheValidator(self, filename):
+        """
+        Return a string that changes whenever the contents of filename
+        change, for keying the media cache, or None if we can't tell
+        """
+        ignore = filename
+        return None
+
+    def _fetchFile(self, filename, progresscb, dirname=None):
         # URLGrabber works for all network and local cases
 
         f = None
@@ -90,13 +260,49 @@ class ImageFetcher:
                 raise ValueError(_("Couldn't acquire file %s: %s") %
                                    (path, str(e)))
 
-            tmpname = self.saveTemp(f, prefix=base + ".")
+            tmpname = self.saveTemp(f, prefix=base + ".", dirname=dirname)
             logging.debug("Saved file to " + tmpname)
             return tmpname
         finally:
             if f:
                 f.close()
 
+    def _originalPath(self, filename):
+        """
+        Path of filename in the source tree, if it can be used in place
+        """
+        ignore = filename
+        return None
+
+    def acquireFile(self, filename, progresscb, readonly=False):
+        """
+        Fetch filename into a new temp file in scratchdir, and return its
+        path. If readonly, the caller doesn't modify or remove the file,
+        so with original_paths set it may get the source file itself.
+        """
+        if readonly and self.original_paths:
+            path = self._originalPath(filename)
+            if path:
+                logging.debug("Using %s in place" % path)
+                self.in_place_paths.append(path)
+                return path
+
+        validator = None
+        if self.cache:
+            validator = self._cacheValidator(filename)
+        if not validator:
+            return self._fetchFile(filename, progresscb)
+
+        # Key on the location rather than _make_path, which can be a
+        # temporary mount point
+        url = self.location.rstrip("/") + "/" + filename.lstrip("/")
+        base = os.path.basename(filename)
+        fetch_cb = lambda dirname: self._fetchFile(filename, progresscb,
+                                                   dirname)
+        tmpname = self.cache.acquire(url, validator, fetch_cb,
+                                     self.scratchdir, base + ".")
+        logging.debug("Saved file to " + tmpname)
+        return tmpname
 
     def hasFile(self, src):
         raise NotImplementedError("Must be implemented in subclass")
@@ -114,17 +320,157 @@ class URIImageFetcher(ImageFetcher):
 
 class HTTPImageFetcher(URIImageFetcher):
 
+    def __init__(self, location, scratchdir):
+        URIImageFetcher.__init__(self, location, scratchdir)
+
+        # urllib2 handles proxies for us, the pool doesn't
+        self.pool = None
+        if not _proxy_configured():
+            self.pool = _HTTPConnectionPool(urlparse.urlparse(location)[1])
+
+    def _pool_request(self, method, filename):
+        """
+        Send a request for filename over the pool, following redirects
+        on the same server. Returns (conn, response) of the last request,
+        or None if a redirect leads elsewhere.
+        """
+        url = self._make_path(filename)
+        for ignore in range(_max_redirects + 1):
+            parts = urlparse.urlparse(url)
+            if parts[1] != self.pool.netloc:
+                return None
+            path = urlparse.urlunparse(("", "", parts[2] or "/", parts[3],
+                                        parts[4], ""))
+
+            conn, resp = self.pool.request(method, path)
+            location = resp.getheader("Location")
+            if resp.status not in [301, 302, 303, 307] or not location:
+                return conn, resp
+
+            resp.read()
+            self.pool.release(conn, resp)
+            url = urlparse.urljoin(url, location)
+        return None
+
+    def _head(self, filename):
+        """
+        Return the HEAD response for filename, or None if the pool can't
+        be used for it
+        """
+        ret = self._pool_request("HEAD", filename)
+        if not ret:
+            return None
+        conn, resp = ret
+        resp.read()
+        self.pool.release(conn, resp)
+        return resp
+
+    def _urllib2_head(self, filename):
+        path = self._make_path(filename)
+        request = urllib2.Request(path)
+        request.get_method = lambda: "HEAD"
+        return urllib2.urlopen(request).info()
+
+    def _head_headers(self, filename):
+        """
+        Return the headers of a successful HEAD of filename, raise an
+        exception otherwise
+        """
+        resp = None
+        if self.pool:
+            resp = self._head(filename)
+        if not resp:
+            return self._urllib2_head(filename)
+
+        if resp.status < 200 or resp.status >= 300:
+            raise ValueError("HTTP status %d" % resp.status)
+        return resp.msg
+
+    def _cacheValidator(self, filename):
+        path = self._make_path(filename)
+        try:
+            headers = self._head_headers(filename)
+        except Exception, e:
+            logging.debug("HTTP HEAD of %s failed: %s" % (path, str(e)))
+            return None
+
+        etag = headers.getheader("ETag")
+        modified = headers.getheader("Last-Modified")
+        if not etag and not modified:
+            return None
+        return "etag=%s;modified=%s;size=%s" % (etag, modified,
+                                                headers.getheader(
+                                                    "Content-Length"))
+
     def hasFile(self, filename):
+        path = self._make_path(filename)
         try:
-            path = self._make_path(filename)
-            request = urllib2.Request(path)
-            request.get_method = lambda: "HEAD"
-            urllib2.urlopen(request)
+            self._head_headers(filename)
         except Exception, e:
             logging.debug("HTTP hasFile: didn't find %s: %s" % (path, str(e)))
             return False
         return True
 
+    def _fetchFile(self, filename, progresscb, dirname=None):
+        ret = None
+        if self.pool:
+            try:
+                ret = self._pool_request("GET", filename)
+            except (httplib.HTTPException, socket.error), e:
+                logging.debug("Pooled GET of %s failed: %s" % (filename, e))
+        if not ret:
+            return URIImageFetcher._fetchFile(self, filename, progresscb,
+                                              dirname)
+
+        conn, resp = ret
+        if resp.status != 200:
+            resp.read()
+            self.pool.release(conn, resp)
+            # Let urlgrabber report the error
+            return URIImageFetcher._fetchFile(self, filename, progresscb,
+                                              dirname)
+
+        base = os.path.basename(filename)
+        logging.debug("Fetching URI: %s" % self._make_path(filename))
+        size = resp.getheader("Content-Length")
+        progresscb.start(filename=base, url=self._make_path(filename),
+                         basename=base, size=size and long(size) or None,
+                         text=_("Retrieving file %s...") % base)
+
+        reader = _ProgressReader(resp, progresscb)
+        try:
+            tmpname = self.saveTemp(reader, prefix=base + ".",
+                                    dirname=dirname)
+            progresscb.end(reader.total)
+        finally:
+            if resp.isclosed():
+                self.pool.release(conn, resp)
+            else:
+                # Body not read to the end, the connection can't be reused
+                conn.close()
+        logging.debug("Saved file to " + tmpname)
+        return tmpname
+
+    def cleanupLocation(self):
+        if self.pool:
+            logging.debug(self.pool.stats_string())
+            self.pool.close()
+
+class _ProgressReader(object):
+    """
+    File-like wrapper reporting the bytes read on a progress meter
+    """
+    def __init__(self, fileobj, progresscb):
+        self.fileobj = fileobj
+        self.progresscb = progresscb
+        self.total = 0
+
+    def read(self, size):
+        buf = self.fileobj.read(size)
+        self.total += len(buf)
+        self.progresscb.update(self.total)
+        return buf
+
 class FTPImageFetcher(URIImageFetcher):
 
     def __init__(self, location, scratchdir):
@@ -132,22 +478,73 @@ class FTPImageFetcher(URIImageFetcher):
 
         self.ftp = None
 
-    def prepareLocation(self):
+        self.connections = 0
+        self.requests = 0
+
+    def _connect(self):
         url = urlparse.urlparse(self._make_path(""))
         self.ftp = ftplib.FTP(url[1])
         self.ftp.login()
+        self.connections += 1
+
+    def _ftp_call(self, func, *args):
+        """
+        Run a command on the shared control session, logging in first if
+        needed, and again once if the server dropped it
+        """
+        self.requests += 1
+        if not self.ftp:
+            self._connect()
+        try:
+            return func(*args)
+        except (EOFError, socket.error, ftplib.error_temp), e:
+            logging.debug("FTP session to %s lost (%s), reconnecting" %
+                          (self.location, e))
+            self._connect()
+            return func(*args)
+
+    def _ftp_path(self, filename):
+        """
+        Path of filename on the server, with URL escapes decoded
+        """
+        return urllib.unquote(urlparse.urlparse(self._make_path(filename))[2])
+
+    def _cacheValidator(self, filename):
+        path = self._ftp_path(filename)
+        try:
+            size = self._ftp_call(lambda p: self.ftp.size(p), path)
+            modified = self._ftp_call(lambda p: self.ftp.sendcmd("MDTM " + p),
+                                      path)
+        except ftplib.all_errors, e:
+            logging.debug("FTP MDTM of %s failed: %s" % (path, str(e)))
+            return None
+        return "modified=%s;size=%s" % (modified, size)
+
+    def prepareLocation(self):
+        self._connect()
+
+    def cleanupLocation(self):
+        if not self.ftp:
+            return
+        logging.debug("%d FTP connections for %d requests to %s" %
+                      (self.connections, self.requests, self.location))
+        try:
+            self.ftp.quit()
+        except ftplib.all_errors:
+            self.ftp.close()
+        self.ftp = None
 
     def hasFile(self, filename):
         path = self._make_path(filename)
-        url = urlparse.urlparse(path)
+        ftppath = self._ftp_path(filename)
 
         try:
             try:
                 # If it's a file
-                self.ftp.size(url[2])
+                self._ftp_call(lambda p: self.ftp.size(p), ftppath)
             except ftplib.all_errors:
                 # If it's a dir
-                self.ftp.cwd(url[2])
+                self._ftp_call(lambda p: self.ftp.cwd(p), ftppath)
         except ftplib.all_errors, e:
             logging.debug("FTP hasFile: couldn't access %s: %s" %
                           (path, str(e)))
@@ -155,12 +552,67 @@ class FTPImageFetcher(URIImageFetcher):
 
         return True
 
+    def _fetchFile(self, filename, progresscb, dirname=None):
+        path = self._make_path(filename)
+        ftppath = self._ftp_path(filename)
+        base = os.path.basename(filename)
+        logging.debug("Fetching URI: %s" % path)
+
+        dirname = dirname or self.scratchdir
+        if not os.path.exists(dirname):
+            os.makedirs(dirname, 0750)
+        (fd, fn) = tempfile.mkstemp(prefix="virtinst-" + base + ".",
+                                    dir=dirname)
+        try:
+            try:
+                try:
+                    size = self._ftp_call(lambda p: self.ftp.size(p),
+                                          ftppath)
+                except ftplib.all_errors, e:
+                    # Not every server implements SIZE
+                    logging.debug("FTP SIZE of %s failed: %s" %
+                                  (ftppath, str(e)))
+                    size = None
+                progresscb.start(filename=base, url=path, basename=base,
+                                 size=size,
+                                 text=_("Retrieving file %s...") % base)
+
+                total = [0]
+                def write(buf):
+                    os.write(fd, buf)
+                    total[0] += len(buf)
+                    progresscb.update(total[0])
+
+                def retr(p):
+                    os.lseek(fd, 0, 0)
+                    os.ftruncate(fd, 0)
+                    total[0] = 0
+                    self.ftp.retrbinary("RETR " + p, write, _read_size)
+                self._ftp_call(retr, ftppath)
+                progresscb.end(total[0])
+            finally:
+                os.close(fd)
+        except ftplib.all_errors, e:
+            os.unlink(fn)
+            raise ValueError(_("Couldn't acquire file %s: %s") %
+                               (path, str(e)))
+
+        logging.debug("Saved file to " + fn)
+        return fn
+
 class LocalImageFetcher(ImageFetcher):
 
     def __init__(self, location, scratchdir, srcdir=None):
         ImageFetcher.__init__(self, location, scratchdir)
         self.srcdir = srcdir
 
+    def _cacheValidator(self, filename):
+        try:
+            st = os.stat(self._make_path(filename))
+        except OSError:
+            return None
+        return "mtime=%d;size=%d" % (st.st_mtime, st.st_size)
+
     def hasFile(self, filename):
         src = self._make_path(filename)
         if os.path.exists(src):
@@ -169,6 +621,30 @@ class LocalImageFetcher(ImageFetcher):
             logging.debug("local hasFile: Couldn't find %s" % src)
             return False
 
+    def _fetchFile(self, filename, progresscb, dirname=None):
+        path = self._make_path(filename)
+        base = os.path.basename(filename)
+        logging.debug("Copying local file %s" % path)
+
+        try:
+            f = open(path, "rb")
+        except IOError, e:
+            raise ValueError(_("Couldn't acquire file %s: %s") %
+                               (path, str(e)))
+        try:
+            size = os.fstat(f.fileno()).st_size
+            progresscb.start(filename=base, url=path, basename=base,
+                             size=size,
+                             text=_("Retrieving file %s...") % base)
+            tmpname = self.saveTemp(f, prefix=base + ".", dirname=dirname,
+                                    progress_cb=progresscb.update)
+            progresscb.end(size)
+        finally:
+            f.close()
+
+        logging.debug("Saved file to " + tmpname)
+        return tmpname
+
 # This is a fetcher capable of extracting files from a NFS server
 # or loopback mounted file, or local CDROM device
 class MountedImageFetcher(LocalImageFetcher):
@@ -213,7 +689,76 @@ class MountedImageFetcher(LocalImageFetcher):
         except:
             pass
 
+# This is a fetcher reading files straight out of a local ISO9660 image,
+# without needing root to loop mount it
+class ISOImageFetcher(ImageFetcher):
+
+    def __init__(self, location, scratchdir):
+        ImageFetcher.__init__(self, location, scratchdir)
+        self.iso = None
+
+    def prepareLocation(self):
+        try:
+            self.iso = isoreader.ISOImage(self.location)
+        except (isoreader.ISOError, OSError), e:
+            raise ValueError(_("Couldn't read ISO image '%s': %s") %
+                             (self.location, str(e)))
+        logging.debug("Reading ISO image %s (Rock Ridge=%s, Joliet=%s)" %
+                      (self.location, self.iso.rock_ridge, self.iso.joliet))
+        return True
+
+    def cleanupLocation(self):
+        if self.iso:
+            self.iso.close()
+            self.iso = None
+
+    def _cacheValidator(self, filename):
+        entry = self.iso.lookup(filename)
+        if not entry or entry.is_dir:
+            return None
+        st = os.stat(self.location)
+        return "mtime=%d;size=%d;extent=%d;length=%d" % (st.st_mtime,
+                                                         st.st_size,
+                                                         entry.extents[0][0],
+                                                         entry.size)
+
+    def hasFile(self, filename):
+        if self.iso.lookup(filename):
+            return True
+        logging.debug("ISO hasFile: Couldn't find %s in %s" %
+                      (filename, self.location))
+        return False
+
+    def _fetchFile(self, filename, progresscb, dirname=None):
+        base = os.path.basename(filename)
+        logging.debug("Fetching %s from ISO %s" % (filename, self.location))
+
+        try:
+            f = self.iso.open(filename)
+        except (isoreader.ISOError, OSError), e:
+            raise ValueError(_("Couldn't acquire file %s: %s") %
+                               (filename, str(e)))
+        try:
+            progresscb.start(filename=base, url=self._make_path(filename),
+                             basename=base, size=f.entry.size,
+                             text=_("Retrieving file %s...") % base)
+            reader = _ProgressReader(f, progresscb)
+            tmpname = self.saveTemp(reader, prefix=base + ".",
+                                    dirname=dirname)
+            progresscb.end(reader.total)
+        finally:
+            f.close()
+
+        logging.debug("Saved file to " + tmpname)
+        return tmpname
+
 class DirectImageFetcher(LocalImageFetcher):
 
     def prepareLocation(self):
         self.srcdir = self.location
+
+    def _originalPath(self, filename):
+        path = self._make_path(filename)
+        if os.path.isfile(path):
+            return os.path.abspath(path)
+        return None
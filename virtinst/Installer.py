@@ -336,7 +336,7 @@ class Installer(XMLBuilderDomain.XMLBuilderDomain):
             not self.bootconfig.kernel):
             return "<bootloader>%s</bootloader>" % _util.pygrub_path(conn)
 
-        osblob = "<os>"
+        osblob = _util.XMLBuffer("<os>")
 
         typexml = "    <type"
         if arch:
@@ -345,22 +345,19 @@ class Installer(XMLBuilderDomain.XMLBuilderDomain):
             typexml += " machine='%s'" % machine
         typexml += ">%s</type>" % os_type
 
-        osblob = _util.xml_append(osblob, typexml)
+        osblob.append(typexml)
 
         if init:
-            osblob = _util.xml_append(osblob,
-                                      "    <init>%s</init>" %
-                                      _util.xml_escape(init))
+            osblob.append("    <init>%s</init>" % _util.xml_escape(init))
         if loader:
-            osblob = _util.xml_append(osblob,
-                                      "    <loader>%s</loader>" %
-                                      _util.xml_escape(loader))
+            osblob.append("    <loader>%s</loader>" %
+                          _util.xml_escape(loader))
 
         if not self.is_container():
-            osblob = _util.xml_append(osblob, bootconfig.get_xml_config())
-        osblob = _util.xml_append(osblob, "  </os>")
+            osblob.append(bootconfig.get_xml_config())
+        osblob.append("  </os>")
 
-        return osblob
+        return osblob.getvalue()
 
 
     # Method definitions
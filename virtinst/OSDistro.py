@@ -21,14 +21,26 @@
 
 import logging
 import os
+import sys
 import gzip
 import re
 import tempfile
+import shutil
+import subprocess
+import stat
 import socket
+import threading
+import StringIO
 import ConfigParser
 
+import urlgrabber.progress as progress
+
 import virtinst
 import osdict
+import treecache
+import isoreader
+import _cpio
+import _rpm
 from virtinst import _util
 from virtinst import _gettext as _
 
@@ -36,6 +48,7 @@ from ImageFetcher import MountedImageFetcher
 from ImageFetcher import FTPImageFetcher
 from ImageFetcher import HTTPImageFetcher
 from ImageFetcher import DirectImageFetcher
+from ImageFetcher import ISOImageFetcher
 
 def safeint(c):
     try:
@@ -54,7 +67,10 @@ def _fetcherForURI(uri, scratchdir=None):
     else:
         if os.path.isdir(uri):
             fclass = DirectImageFetcher
+        elif os.path.isfile(uri) and isoreader.is_iso(uri):
+            fclass = ISOImageFetcher
         else:
+            # Block devices, and images we can't read ourselves (UDF)
             fclass = MountedImageFetcher
     return fclass(uri, scratchdir)
 
@@ -62,6 +78,11 @@ def _storeForDistro(fetcher, baseuri, typ, progresscb, arch, distro=None,
                     scratchdir=None):
     stores = []
     skip_treeinfo = False
+
+    store = _cachedStore(fetcher, baseuri, typ, arch, distro, scratchdir)
+    if store:
+        return store
+
     logging.debug("Attempting to detect distro:")
 
     dist = virtinst.OSDistro.distroFromTreeinfo(fetcher, progresscb, baseuri,
@@ -101,18 +122,425 @@ def _storeForDistro(fetcher, baseuri, typ, progresscb, arch, distro=None,
 
     stores.append(GenericDistro)
 
+    storeobjs = []
     for sclass in stores:
         store = sclass(baseuri, arch, typ, scratchdir)
         if skip_treeinfo:
             store.uses_treeinfo = False
-        if store.isValidStore(fetcher, progresscb):
-            return store
+        storeobjs.append(store)
+
+    store = _probeStores(fetcher, progresscb, storeobjs)
+    if store:
+        return store
 
     raise ValueError(
         _("Could not find an installable distribution at '%s'\n"
           "The location must be the root directory of an install tree." %
           baseuri))
 
+def _cachedStore(fetcher, baseuri, typ, arch, distro, scratchdir):
+    """
+    Rebuild the store a previous detection run with the same distro hint
+    picked for this tree, if the tree cache has a valid entry
+    """
+    entry = treecache.load(fetcher, baseuri, arch, typ, distro)
+    if not entry:
+        return None
+    classname, attrs, treeinfo = entry
+
+    sclass = globals().get(classname)
+    if (type(sclass) is not type(Distro) or
+        not issubclass(sclass, Distro)):
+        logging.debug("Unknown distro class '%s' in tree cache" % classname)
+        return None
+
+    store = sclass(baseuri, arch, typ, scratchdir)
+    store.__dict__.update(attrs)
+    store.treeinfo = treeinfo
+    return store
+
+# Max number of distro classes probing an install tree at the same time
+PROBE_THREADS = 4
+
+class _ProbeCancelled(Exception):
+    pass
+
+class _SharedProbes(object):
+    """
+    Memoized hasFile/acquireFile results for a fetcher, shared by all
+    distro classes probing a tree. Only one thread does any given probe,
+    others asking for it wait for the result.
+    """
+    def __init__(self, fetcher):
+        self.fetcher = fetcher
+        self._cond = threading.Condition()
+        self._results = {}
+        # FTPImageFetcher has a single control connection
+        self._fetcher_lock = None
+        if isinstance(fetcher, FTPImageFetcher):
+            self._fetcher_lock = threading.Lock()
+
+        self.probes = 0
+        self.shared = 0
+
+    def _call(self, func, *args):
+        if not self._fetcher_lock:
+            return func(*args)
+        self._fetcher_lock.acquire()
+        try:
+            return func(*args)
+        finally:
+            self._fetcher_lock.release()
+
+    def _get(self, key, func, *args):
+        """
+        Return func(*args), memoized under key. Exceptions are memoized
+        and re-raised as well.
+        """
+        self._cond.acquire()
+        try:
+            while key in self._results and self._results[key] is None:
+                # Someone else is probing this
+                self._cond.wait()
+            if key in self._results:
+                self.shared += 1
+                ok, val = self._results[key]
+                if not ok:
+                    raise val[0], val[1], val[2]
+                return val
+            self._results[key] = None
+            self.probes += 1
+        finally:
+            self._cond.release()
+
+        try:
+            result = (True, self._call(func, *args))
+        except:
+            result = (False, sys.exc_info())
+
+        self._cond.acquire()
+        try:
+            self._results[key] = result
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+        ok, val = result
+        if not ok:
+            raise val[0], val[1], val[2]
+        return val
+
+    def _fetch_content(self, filename):
+        tmpname = self.fetcher.acquireFile(filename, progress.BaseMeter())
+        try:
+            return open(tmpname, "r").read()
+        finally:
+            os.unlink(tmpname)
+
+    def hasFile(self, filename):
+        return self._get(("hasFile", filename), self.fetcher.hasFile,
+                         filename)
+
+    def fileContent(self, filename):
+        # Probe files are small, keep the content rather than the file so
+        # every caller can get (and delete) its own copy
+        return self._get(("acquireFile", filename), self._fetch_content,
+                         filename)
+
+class _ProbeFetcher(object):
+    """
+    Fetcher handed to a single Distro.isValidStore call. Probes go
+    through _SharedProbes, and raise _ProbeCancelled once the result of
+    this store isn't needed anymore. Everything else is passed to the
+    real fetcher.
+    """
+    def __init__(self, shared):
+        self._shared = shared
+        self.cancelled = False
+
+    def __getattr__(self, name):
+        return getattr(self._shared.fetcher, name)
+
+    def _check_cancelled(self):
+        if self.cancelled:
+            raise _ProbeCancelled()
+
+    def hasFile(self, filename):
+        self._check_cancelled()
+        return self._shared.hasFile(filename)
+
+    def acquireFile(self, filename, progresscb):
+        ignore = progresscb
+        self._check_cancelled()
+        content = self._shared.fileContent(filename)
+        self._check_cancelled()
+        return self._shared.fetcher.saveTemp(StringIO.StringIO(content),
+                                             os.path.basename(filename) + ".")
+
+def _probeStores(fetcher, progresscb, stores):
+    """
+    Run isValidStore for all stores on up to PROBE_THREADS threads, and
+    return the first valid store in list order, or None. Once a store
+    is found valid, the probes of all stores after it are cancelled.
+    File probes are shared between stores, and fetched files are never
+    shown on progresscb.
+    """
+    shared = _SharedProbes(fetcher)
+    views = [_ProbeFetcher(shared) for ignore in stores]
+    # Per store: None == pending, else (valid, exc_info)
+    results = [None] * len(stores)
+    cond = threading.Condition()
+    nextidx = [0]
+
+    def decide():
+        # Return (finished, index of deciding store or None)
+        for idx in range(len(stores)):
+            if results[idx] is None:
+                return False, None
+            valid, err = results[idx]
+            if err or valid:
+                return True, idx
+        return True, None
+
+    def worker():
+        while True:
+            cond.acquire()
+            try:
+                if decide()[0] or nextidx[0] >= len(stores):
+                    return
+                idx = nextidx[0]
+                nextidx[0] += 1
+            finally:
+                cond.release()
+
+            try:
+                result = (bool(stores[idx].isValidStore(views[idx],
+                                                        progresscb)),
+                          None)
+            except _ProbeCancelled:
+                result = (False, None)
+            except:
+                result = (False, sys.exc_info())
+
+            cond.acquire()
+            try:
+                results[idx] = result
+                if result[0] or result[1]:
+                    # Stores after this one can't win anymore
+                    for view in views[idx + 1:]:
+                        view.cancelled = True
+                cond.notifyAll()
+            finally:
+                cond.release()
+
+    threads = []
+    for ignore in range(min(PROBE_THREADS, len(stores))):
+        t = threading.Thread(target=worker, name="Probing distro")
+        t.setDaemon(True)
+        threads.append(t)
+        t.start()
+
+    cond.acquire()
+    try:
+        while not decide()[0]:
+            cond.wait(1)
+        for view in views:
+            view.cancelled = True
+    finally:
+        cond.release()
+
+    # Wait for in flight probes, the fetcher is cleaned up after we return
+    for t in threads:
+        while t.isAlive():
+            t.join(1)
+
+    logging.debug("Distro probes: %d done, %d shared" %
+                  (shared.probes, shared.shared))
+
+    idx = decide()[1]
+    if idx is None:
+        return None
+    valid, err = results[idx]
+    if err:
+        raise err[0], err[1], err[2]
+    return stores[idx]
+
+class _FetchCancelled(Exception):
+    pass
+
+class _CombinedMeter(object):
+    """
+    Reports several concurrent downloads as a single one on a progress
+    meter. The meter is started once every download has reported its
+    size (or finished without reporting any, like media cache hits).
+    """
+    def __init__(self, meter, filenames):
+        self.meter = meter
+        self.count = len(filenames)
+        self.text = (_("Retrieving files %s...") %
+                     ", ".join([os.path.basename(f) for f in filenames]))
+
+        self.cancelled = False
+        self.error = None
+
+        self._lock = threading.Lock()
+        self._started = False
+        self._sizes = {}
+        self._amounts = {}
+
+    def _maybe_start(self):
+        if self._started or len(self._sizes) < self.count:
+            return
+        self._started = True
+
+        total = None
+        if None not in self._sizes.values():
+            total = sum(self._sizes.values())
+        self.meter.start(size=total, text=self.text)
+        self.meter.update(sum(self._amounts.values()))
+
+    def cancel(self, exc_info):
+        """
+        Record exc_info as the failure that stops all downloads
+        """
+        self._lock.acquire()
+        try:
+            if not self.cancelled:
+                self.cancelled = True
+                self.error = exc_info
+        finally:
+            self._lock.release()
+
+    def child_start(self, child, size):
+        self._lock.acquire()
+        try:
+            self._sizes[child] = size and long(size) or None
+            self._maybe_start()
+        finally:
+            self._lock.release()
+
+    def child_update(self, child, amount):
+        if self.cancelled:
+            raise _FetchCancelled()
+
+        self._lock.acquire()
+        try:
+            self._amounts[child] = amount
+            if self._started:
+                self.meter.update(sum(self._amounts.values()))
+        finally:
+            self._lock.release()
+
+    def child_done(self, child):
+        self._lock.acquire()
+        try:
+            if child not in self._sizes:
+                self._sizes[child] = self._amounts.get(child, 0)
+            self._maybe_start()
+        finally:
+            self._lock.release()
+
+    def end(self):
+        if self._started:
+            self.meter.end(sum(self._amounts.values()))
+
+class _ChildMeter(object):
+    """
+    Progress meter handed to a single fetcher.acquireFile call
+    """
+    def __init__(self, parent):
+        self.parent = parent
+
+    def start(self, filename=None, url=None, basename=None,
+              size=None, now=None, text=None):
+        ignore = filename, url, basename, now, text
+        self.parent.child_start(self, size)
+
+    def update(self, amount_read, now=None):
+        ignore = now
+        self.parent.child_update(self, amount_read)
+
+    def end(self, amount_read, now=None):
+        ignore = now
+        self.parent.child_update(self, amount_read)
+
+def _removeFetched(fetcher, paths):
+    """
+    Remove the files acquireFile returned, except source files returned
+    in place
+    """
+    for path in paths:
+        if not path or not os.path.exists(path):
+            continue
+        if path in fetcher.in_place_paths:
+            continue
+        os.unlink(path)
+
+def _acquireFiles(fetcher, progresscb, filenames, readonly=False):
+    """
+    Fetch all of filenames at the same time, and return their temp file
+    paths in the same order. Progress is shown as a single download on
+    progresscb. If any transfer fails, the others are cancelled, every
+    fetched file is removed, and the first error is raised.
+
+    @param readonly: Passed to acquireFile: files may come back in place
+    """
+    if len(filenames) < 2 or isinstance(fetcher, FTPImageFetcher):
+        # FTP fetchers have a single control connection
+        paths = []
+        try:
+            for filename in filenames:
+                paths.append(fetcher.acquireFile(filename, progresscb,
+                                                 readonly))
+        except:
+            _removeFetched(fetcher, paths)
+            raise
+        return paths
+
+    meter = _CombinedMeter(progresscb, filenames)
+    paths = [None] * len(filenames)
+
+    def fetch(idx):
+        child = _ChildMeter(meter)
+        try:
+            try:
+                paths[idx] = fetcher.acquireFile(filenames[idx], child,
+                                                 readonly)
+            except _FetchCancelled:
+                pass
+            except:
+                meter.cancel(sys.exc_info())
+        finally:
+            meter.child_done(child)
+
+    threads = []
+    for idx in range(len(filenames)):
+        t = threading.Thread(target=fetch, args=(idx,),
+                             name="Fetching %s" % filenames[idx])
+        t.setDaemon(True)
+        threads.append(t)
+        t.start()
+
+    try:
+        # Join with a timeout, so KeyboardInterrupt gets delivered
+        for t in threads:
+            while t.isAlive():
+                t.join(1)
+    except:
+        meter.cancel(sys.exc_info())
+        for t in threads:
+            t.join()
+        _removeFetched(fetcher, paths)
+        raise
+
+    if meter.error:
+        _removeFetched(fetcher, paths)
+        err = meter.error
+        raise err[0], err[1], err[2]
+
+    meter.end()
+    return paths
+
 def _locationCheckWrapper(guest, baseuri, progresscb,
                           scratchdir, _type, arch, callback):
     fetcher = _fetcherForURI(baseuri, scratchdir)
@@ -130,32 +558,42 @@ def _locationCheckWrapper(guest, baseuri, progresscb,
                                 progresscb=progresscb, scratchdir=scratchdir,
                                 arch=arch)
 
-        return callback(store, fetcher)
+        ret = callback(store, fetcher)
+        treecache.save(fetcher, store, baseuri, arch, _type)
+        return ret
     finally:
         fetcher.cleanupLocation()
 
 def _acquireMedia(iskernel, guest, baseuri, progresscb,
-                  scratchdir="/var/tmp", _type=None):
+                  scratchdir="/var/tmp", _type=None, original_paths=False):
 
     def media_cb(store, fetcher):
         os_type, os_variant = store.get_osdict_info()
         media = None
+        fetcher.original_paths = original_paths
 
         if iskernel:
             media = store.acquireKernel(guest, fetcher, progresscb)
         else:
             media = store.acquireBootDisk(guest, fetcher, progresscb)
 
-        return [store, os_type, os_variant, media]
+        ret = [store, os_type, os_variant, media]
+        if original_paths:
+            ret.append(fetcher.in_place_paths[:])
+        return ret
 
     return _locationCheckWrapper(guest, baseuri, progresscb, scratchdir, _type,
                                  None, media_cb)
 
-# Helper method to lookup install media distro and fetch an install kernel
-def acquireKernel(guest, baseuri, progresscb, scratchdir, type=None):
+# Helper method to lookup install media distro and fetch an install kernel.
+# With original_paths, kernel and initrd in a local tree are returned in
+# place rather than copied to scratchdir: the caller mustn't modify them.
+# A fifth list item then holds the returned paths that are used in place.
+def acquireKernel(guest, baseuri, progresscb, scratchdir, type=None,
+                  original_paths=False):
     iskernel = True
     return _acquireMedia(iskernel, guest, baseuri, progresscb,
-                         scratchdir, type)
+                         scratchdir, type, original_paths)
 
 # Helper method to lookup install media distro and fetch a boot iso
 def acquireBootDisk(guest, baseuri, progresscb, scratchdir, type=None):
@@ -241,6 +679,9 @@ class Distro:
     _xen_kernel_paths = []
     uses_treeinfo = False
 
+    # (kernel, initrd) paths found by acquireKernel, kept in the tree cache
+    _kernel_paths = None
+
     def __init__(self, uri, arch, vmtype=None, scratchdir=None):
         self.uri = uri
         self.type = vmtype
@@ -255,7 +696,9 @@ class Distro:
     def acquireKernel(self, guest, fetcher, progresscb):
         kernelpath = None
         initrdpath = None
-        if self._hasTreeinfo(fetcher, progresscb):
+        if self._kernel_paths:
+            kernelpath, initrdpath = self._kernel_paths
+        elif self._hasTreeinfo(fetcher, progresscb):
             kernelpath = self._getTreeinfoMedia("kernel")
             initrdpath = self._getTreeinfoMedia("initrd")
         else:
@@ -275,6 +718,7 @@ class Distro:
                                  "%(distro)s tree.") % \
                                  { "distro": self.name, "type" : self.type })
 
+        self._kernel_paths = (kernelpath, initrdpath)
         return self._kernelFetchHelper(fetcher, guest, progresscb, kernelpath,
                                        initrdpath)
 
@@ -367,9 +811,11 @@ class Distro:
 
     def _kernelFetchHelper(self, fetcher, guest, progresscb, kernelpath,
                            initrdpath):
-        # Simple helper for fetching kernel + initrd and performing
-        # cleanup if neccessary
-        kernel = fetcher.acquireFile(kernelpath, progresscb)
+        # Simple helper for fetching kernel + initrd at the same time and
+        # performing cleanup if neccessary
+        kernel, initrd = _acquireFiles(fetcher, progresscb,
+                                       [kernelpath, initrdpath],
+                                       readonly=True)
         args = ''
 
         if not fetcher.location.startswith("/"):
@@ -378,11 +824,7 @@ class Distro:
         if guest.extraargs:
             args += " " + guest.extraargs
 
-        try:
-            initrd = fetcher.acquireFile(initrdpath, progresscb)
-            return kernel, initrd, args
-        except:
-            os.unlink(kernel)
+        return kernel, initrd, args
 
 
 class GenericDistro(Distro):
@@ -649,6 +1091,32 @@ class SLDistro(RHELDistro):
         return version, update
 
 
+# Where the install-initrd RPM keeps the base initrd and module lists
+_suse_initrd_dir = "usr/lib/install-initrd/"
+
+def _payloadName(entry):
+    """
+    Path of an RPM payload member, without the leading './'
+    """
+    name = entry.name
+    if name.startswith("./"):
+        name = name[2:]
+    return name.lstrip("/")
+
+def _saveEntry(entry, path):
+    """
+    Write the contents of an RPM payload member to path
+    """
+    f = open(path, "wb")
+    try:
+        while True:
+            buf = entry.read(65536)
+            if not buf:
+                break
+            f.write(buf)
+    finally:
+        f.close()
+
 # Suse  image store is harder - we fetch the kernel RPM and a helper
 # RPM and then munge bits together to generate a initrd
 class SuseDistro(Distro):
@@ -657,6 +1125,10 @@ class SuseDistro(Distro):
     os_type = "linux"
     _boot_iso_paths   = [ "boot/boot.iso" ]
 
+    # gzip level for initrds we build: much faster than -9, for a few
+    # percent more size
+    _initrd_level = 6
+
     def __init__(self, uri, arch, vmtype=None, scratchdir=None):
         Distro.__init__(self, uri, arch, vmtype, scratchdir)
         if re.match(r'i[4-9]86', arch):
@@ -699,6 +1171,41 @@ class SuseDistro(Distro):
 
 
     def _findXenRPMS(self, fetcher, progresscb):
+        cache = fetcher.cache
+        validator = cache and fetcher._cacheValidator("ls-lR.gz")
+        if not validator:
+            return self._buildXenMedia(fetcher, progresscb)
+
+        # Cache the built kernel/initrd pair per tree and arch. The tree's
+        # file list changes whenever the RPMs we use do.
+        baseurl = fetcher.location.rstrip("/") + "/ls-lR.gz#xen-%s-" % self.arch
+        kernelurl = baseurl + "vmlinuz"
+        initrdurl = baseurl + "initrd.img"
+
+        def build_initrd(dirname):
+            kernel, initrd, ignore = self._buildXenMedia(fetcher, progresscb,
+                                                         dirname)
+            cache.add(kernelurl, validator, kernel)
+            return initrd
+
+        def build_kernel(dirname):
+            # Only reached if the kernel was evicted since
+            kernel, initrd, ignore = self._buildXenMedia(fetcher, progresscb,
+                                                         dirname)
+            os.unlink(initrd)
+            return kernel
+
+        initrdname = cache.acquire(initrdurl, validator, build_initrd,
+                                   self.scratchdir, "initrd.img.")
+        try:
+            kernelname = cache.acquire(kernelurl, validator, build_kernel,
+                                       self.scratchdir, "vmlinuz.")
+        except:
+            os.unlink(initrdname)
+            raise
+        return (kernelname, initrdname, "install=" + fetcher.location)
+
+    def _buildXenMedia(self, fetcher, progresscb, dirname=None):
         kernelrpm = None
         installinitrdrpm = None
         filelist = None
@@ -713,7 +1220,9 @@ class SuseDistro(Distro):
             installinitrdrpm = fetcher.acquireFile(initrdrpmname, progresscb)
 
             # Process the RPMs to extract the kernel & generate an initrd
-            return self._buildKernelInitrd(fetcher, kernelrpm, installinitrdrpm, progresscb)
+            return self._buildKernelInitrd(fetcher, kernelrpm,
+                                           installinitrdrpm, progresscb,
+                                           dirname)
         finally:
             if filelist is not None:
                 os.unlink(filelist)
@@ -740,31 +1249,28 @@ class SuseDistro(Distro):
                 kernelname = "kernel-xenpae"
             else:
                 kernelname = "kernel-xen"
+            wantdirs = {}
+            for arch in arches:
+                wantdirs["./suse/" + arch + ":\n"] = "/suse/" + arch
 
             installinitrdrpm = None
             kernelrpm = None
             dirname = None
-            while 1:
-                data = filelistData.readline()
-                if not data:
-                    break
+            for data in filelistData:
                 if dirname is None:
-                    for arch in arches:
-                        wantdir = "/suse/" + arch
-                        if data == "." + wantdir + ":\n":
-                            dirname = wantdir
-                            break
-                else:
-                    if data == "\n":
-                        dirname = None
-                    else:
-                        if data[:5] != "total":
-                            filename = re.split("\s+", data)[8]
-
-                            if filename[:14] == "install-initrd":
-                                installinitrdrpm = dirname + "/" + filename
-                            elif filename[:len(kernelname)] == kernelname:
-                                kernelrpm = dirname + "/" + filename
+                    dirname = wantdirs.get(data)
+                elif data == "\n":
+                    dirname = None
+                elif data[:5] != "total":
+                    fields = data.split(None, 8)
+                    if len(fields) < 9:
+                        continue
+                    filename = fields[8].rstrip("\n")
+
+                    if filename.startswith("install-initrd"):
+                        installinitrdrpm = dirname + "/" + filename
+                    elif filename.startswith(kernelname):
+                        kernelrpm = dirname + "/" + filename
 
             if kernelrpm is None:
                 raise Exception(_("Unable to determine kernel RPM path"))
@@ -774,117 +1280,192 @@ class SuseDistro(Distro):
         finally:
             filelistData.close()
 
+    def _readInstallInitrdRPM(self, installinitrdrpm, stagedir):
+        """
+        Pull the per flavor module lists and configs out of the
+        install-initrd RPM, and spill the base initrd to stagedir
+        """
+        modlists = {}
+        modconfigs = {}
+        baseinitrd = None
+
+        payload = _rpm.RPMPayload(installinitrdrpm)
+        try:
+            for entry in payload.entries():
+                name = _payloadName(entry)
+                if (not name.startswith(_suse_initrd_dir) or
+                    not stat.S_ISREG(entry.mode)):
+                    continue
+
+                name = name[len(_suse_initrd_dir):]
+                if name == "initrd-base.gz":
+                    baseinitrd = os.path.join(stagedir, name)
+                    _saveEntry(entry, baseinitrd)
+                elif name.endswith("/module.list"):
+                    modlists[os.path.dirname(name)] = entry.read().splitlines()
+                elif name.endswith("/module.config"):
+                    modconfigs[os.path.dirname(name)] = entry.read()
+        finally:
+            payload.close()
+
+        if not baseinitrd:
+            raise RuntimeError(_("No base initrd found in %s") %
+                               os.path.basename(installinitrdrpm))
+        return modlists, modconfigs, baseinitrd
+
+    def _readKernelRPM(self, fetcher, kernelrpm, wantmods, stagedir, dirname):
+        """
+        Extract System.map, the wanted modules to stagedir and the kernel
+        images to dirname
+
+        @returns: (System.map path, dict of vmlinuz name -> saved path,
+                   dict of module name -> extracted path)
+        """
+        sysmap = None
+        kernels = {}
+        modpaths = {}
+        os.mkdir(os.path.join(stagedir, "ko"))
+
+        payload = _rpm.RPMPayload(kernelrpm)
+        try:
+            for entry in payload.entries():
+                if not stat.S_ISREG(entry.mode):
+                    continue
+                name = _payloadName(entry)
+                base = os.path.basename(name)
+
+                if name.startswith("boot/System.map-"):
+                    sysmap = os.path.join(stagedir, base)
+                    _saveEntry(entry, sysmap)
+                elif name.startswith("boot/vmlinuz-"):
+                    kernels[base] = fetcher.saveTemp(entry, "vmlinuz",
+                                                     dirname=dirname)
+                elif base in wantmods and base not in modpaths:
+                    modpaths[base] = os.path.join(stagedir, "ko", base)
+                    _saveEntry(entry, modpaths[base])
+        except:
+            payload.close()
+            for path in kernels.values():
+                os.unlink(path)
+            raise
+        payload.close()
+
+        return sysmap, kernels, modpaths
+
     # We have a kernel RPM and a install-initrd RPM with a generic initrd in it
     # Now we have to merge the two together to build an initrd capable of
     # booting the installer.
     #
-    # Yes, this is crazy ass stuff :-)
-    def _buildKernelInitrd(self, fetcher, kernelrpm, installinitrdrpm, progresscb):
-        progresscb.start(text=_("Building initrd"), size=11)
+    # Both RPM payloads are streamed in process, only the pieces we need
+    # are extracted. The new initrd is the base one with the modules and
+    # their depmod output appended, compressed as it is written out.
+    def _buildKernelInitrd(self, fetcher, kernelrpm, installinitrdrpm,
+                           progresscb, dirname=None):
+        progresscb.start(text=_("Building initrd"), size=6)
         progresscb.update(1)
-        cpiodir = tempfile.mkdtemp(prefix="virtinstcpio.", dir=self.scratchdir)
+        stagedir = tempfile.mkdtemp(prefix="virtinstcpio.", dir=self.scratchdir)
+        kernels = {}
+        kernelname = None
+        initrdname = None
         try:
-            # Extract the kernel RPM contents
-            os.mkdir(cpiodir + "/kernel")
-            cmd = "cd " + cpiodir + "/kernel && (rpm2cpio " + kernelrpm + " | cpio --quiet -idm)"
-            logging.debug("Running " + cmd)
-            os.system(cmd)
-            progresscb.update(2)
-
-            # Determine the raw kernel version
-            kernelinfo = None
-            for f in os.listdir(cpiodir + "/kernel/boot"):
-                if f.startswith("System.map-"):
-                    kernelinfo = re.split("-", f)
-            kernel_override = kernelinfo[1] + "-override-" + kernelinfo[3]
-            kernel_version = kernelinfo[1] + "-" + kernelinfo[2] + "-" + kernelinfo[3]
-            logging.debug("Got kernel version " + str(kernelinfo))
-
-            # Build a list of all .ko files
-            modpaths = {}
-            for root, dummy, files in os.walk(cpiodir + "/kernel/lib/modules", topdown=False):
-                for name in files:
-                    if name.endswith(".ko"):
-                        modpaths[name] = os.path.join(root, name)
-            progresscb.update(3)
-
-            # Extract the install-initrd RPM contents
-            os.mkdir(cpiodir + "/installinitrd")
-            cmd = "cd " + cpiodir + "/installinitrd && (rpm2cpio " + installinitrdrpm + " | cpio --quiet -idm)"
-            logging.debug("Running " + cmd)
-            os.system(cmd)
-            progresscb.update(4)
-
-            # Read in list of mods required for initrd
-            modnames = []
-            fn = open(cpiodir + "/installinitrd/usr/lib/install-initrd/" + kernelinfo[3] + "/module.list", "r")
             try:
-                while 1:
-                    line = fn.readline()
-                    if not line:
-                        break
-                    line = line[:len(line) - 1]
-                    modnames.append(line)
-            finally:
-                fn.close()
-            progresscb.update(5)
-
-            # Uncompress the basic initrd
-            cmd = "gunzip -c " + cpiodir + "/installinitrd/usr/lib/install-initrd/initrd-base.gz > " + cpiodir + "/initrd.img"
-            logging.debug("Running " + cmd)
-            os.system(cmd)
-            progresscb.update(6)
-
-            # Create temp tree to hold stuff we're adding to initrd
-            moddir = cpiodir + "/initrd/lib/modules/" + kernel_override + "/initrd/"
-            moddepdir = cpiodir + "/initrd/lib/modules/" + kernel_version
-            os.makedirs(moddir)
-            os.makedirs(moddepdir)
-            os.symlink("../" + kernel_override, moddepdir + "/updates")
-            os.symlink("lib/modules/" + kernel_override + "/initrd", cpiodir + "/initrd/modules")
-            cmd = "cp " + cpiodir + "/installinitrd/usr/lib/install-initrd/" + kernelinfo[3] + "/module.config" + " " + moddir
-            logging.debug("Running " + cmd)
-            os.system(cmd)
-            progresscb.update(7)
-
-            # Copy modules we need into initrd staging dir
-            for modname in modnames:
-                if modname in modpaths:
-                    src = modpaths[modname]
-                    dst = moddir + "/" + modname
-                    os.system("cp " + src + " " + dst)
-            progresscb.update(8)
-
-            # Run depmod across the staging area
-            cmd = "depmod -a -b " + cpiodir + "/initrd -F " + cpiodir + "/kernel/boot/System.map-" + kernel_version + " " + kernel_version
-            logging.debug("Running " + cmd)
-            os.system(cmd)
-            progresscb.update(9)
-
-            # Add the extra modules to the basic initrd
-            cmd = "cd " + cpiodir + "/initrd && ( find . | cpio --quiet -o -H newc -A -F " + cpiodir + "/initrd.img)"
-            logging.debug("Running " + cmd)
-            os.system(cmd)
-            progresscb.update(10)
-
-            # Compress the final initrd
-            cmd = "gzip -f9N " + cpiodir + "/initrd.img"
-            logging.debug("Running " + cmd)
-            os.system(cmd)
-            progresscb.end(11)
-
-            # Save initrd & kernel to temp files for booting...
-            initrdname = fetcher.saveTemp(open(cpiodir + "/initrd.img.gz", "r"), "initrd.img")
-            logging.debug("Saved " + initrdname)
-            try:
-                kernelname = fetcher.saveTemp(open(cpiodir + "/kernel/boot/vmlinuz-" + kernel_version, "r"), "vmlinuz")
-                logging.debug("Saved " + kernelname)
-                return (kernelname, initrdname, "install=" + fetcher.location)
+                # Read the module lists and base initrd
+                modlists, modconfigs, baseinitrd = \
+                    self._readInstallInitrdRPM(installinitrdrpm, stagedir)
+                wantmods = {}
+                for modnames in modlists.values():
+                    for modname in modnames:
+                        wantmods[modname] = True
+                progresscb.update(2)
+
+                # Extract the kernel, System.map and modules we need
+                sysmap, kernels, modpaths = self._readKernelRPM(fetcher,
+                                                                kernelrpm,
+                                                                wantmods,
+                                                                stagedir,
+                                                                dirname)
+                if not sysmap:
+                    raise RuntimeError(_("No System.map found in %s") %
+                                       os.path.basename(kernelrpm))
+                progresscb.update(3)
+
+                # Determine the raw kernel version
+                kernelinfo = re.split("-", os.path.basename(sysmap))
+                kernel_override = kernelinfo[1] + "-override-" + kernelinfo[3]
+                kernel_version = kernelinfo[1] + "-" + kernelinfo[2] + "-" + kernelinfo[3]
+                logging.debug("Got kernel version " + str(kernelinfo))
+
+                kernelname = kernels.pop("vmlinuz-" + kernel_version, None)
+                if not kernelname:
+                    raise RuntimeError(_("No kernel image for %s found in %s")
+                                       % (kernel_version,
+                                          os.path.basename(kernelrpm)))
+
+                # Lay out the files we add to the initrd
+                initrddir = os.path.join(stagedir, "initrd")
+                moddir = initrddir + "/lib/modules/" + kernel_override + "/initrd/"
+                moddepdir = initrddir + "/lib/modules/" + kernel_version
+                os.makedirs(moddir)
+                os.makedirs(moddepdir)
+                os.symlink("../" + kernel_override, moddepdir + "/updates")
+                os.symlink("lib/modules/" + kernel_override + "/initrd",
+                           initrddir + "/modules")
+                f = open(moddir + "module.config", "w")
+                try:
+                    f.write(modconfigs.get(kernelinfo[3], ""))
+                finally:
+                    f.close()
+                for modname in modlists.get(kernelinfo[3], []):
+                    if modname in modpaths:
+                        os.rename(modpaths[modname], moddir + modname)
+
+                # Run depmod across the staging area
+                cmd = ["depmod", "-a", "-b", initrddir, "-F", sysmap,
+                       kernel_version]
+                logging.debug("Running %s" % cmd)
+                try:
+                    ret = subprocess.call(cmd)
+                except OSError, e:
+                    ret = str(e)
+                if ret != 0:
+                    logging.warning("depmod failed for the installer "
+                                    "initrd: %s" % ret)
+                progresscb.update(4)
+
+                # Append the new files to the base initrd, compressing
+                # as we write it out
+                (fd, initrdname) = tempfile.mkstemp(
+                                        prefix="virtinst-initrd.img",
+                                        dir=dirname or self.scratchdir)
+                out = os.fdopen(fd, "wb")
+                base = gzip.GzipFile(baseinitrd, mode="r")
+                try:
+                    gz = _cpio.GzipWriter(out, self._initrd_level)
+                    _cpio.copy_archive(base, gz)
+                    progresscb.update(5)
+
+                    cpio = _cpio.CpioWriter(gz)
+                    _cpio.add_tree(cpio, initrddir)
+                    cpio.finish()
+                    gz.close()
+                finally:
+                    base.close()
+                    out.close()
+                progresscb.end(6)
             except:
-                os.unlink(initrdname)
+                if initrdname:
+                    os.unlink(initrdname)
+                if kernelname:
+                    os.unlink(kernelname)
+                raise
         finally:
-            #pass
-            os.system("rm -rf " + cpiodir)
+            for path in kernels.values():
+                os.unlink(path)
+            shutil.rmtree(stagedir)
+
+        logging.debug("Saved " + initrdname)
+        logging.debug("Saved " + kernelname)
+        return (kernelname, initrdname, "install=" + fetcher.location)
 
 
 class DebianDistro(Distro):
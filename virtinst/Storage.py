@@ -1376,9 +1376,12 @@ class CloneVolume(StorageVolume):
         # Populate some basic info
         xml  = input_vol.XMLDesc(0)
         typ  = input_vol.info()[0]
-        cap  = int(_util.get_xml_path(xml, "/volume/capacity"))
-        alc  = int(_util.get_xml_path(xml, "/volume/allocation"))
-        fmt  = _util.get_xml_path(xml, "/volume/target/format/@type")
+        cap, alc, fmt = _util.get_xml_paths(xml,
+                                            ["/volume/capacity",
+                                             "/volume/allocation",
+                                             "/volume/target/format/@type"])
+        cap = int(cap)
+        alc = int(alc)
 
         StorageVolume.__init__(self, name=name, pool=pool,
                                pool_name=pool.name(),
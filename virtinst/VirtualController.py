@@ -177,6 +177,9 @@ class VirtualControllerUSB(VirtualController):
 
 
 class VirtualDeviceMaster(XMLBuilderDomain):
+    # Part of device XML, see VirtualDevice._track_xml_state
+    _track_xml_state = True
+
     def __init__(self, conn, parsexml=None, parsexmlnode=None, caps=None):
         XMLBuilderDomain.__init__(self, conn, parsexml, parsexmlnode,
                                   caps=caps)
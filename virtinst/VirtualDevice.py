@@ -23,6 +23,9 @@ from XMLBuilderDomain import XMLBuilderDomain, _xml_property
 from virtinst import _gettext as _
 import logging
 
+# Fragments kept per device, enough for the install and boot XML
+_fragment_cache_size = 2
+
 class VirtualDevice(XMLBuilderDomain):
     """
     Base class for all domain xml device objects.
@@ -67,6 +70,13 @@ class VirtualDevice(XMLBuilderDomain):
     # General device type (disk, interface, etc.)
     _virtual_device_type = None
 
+    # Track attribute sets, so get_xml_config can reuse fragments
+    _track_xml_state = True
+
+    # Number of device XML fragments built, and reused from the cache
+    fragments_built = 0
+    fragments_reused = 0
+
     def __init__(self, conn=None, parsexml=None, parsexmlnode=None, caps=None):
         """
         Initialize device state
@@ -74,6 +84,11 @@ class VirtualDevice(XMLBuilderDomain):
         @param conn: libvirt connection to validate device against
         @type conn: virConnect
         """
+        # List of (_xml_state(), XML) for recent get_xml_config calls.
+        # Shared with our copies, which mostly differ from us by defaults
+        # that are the same every time
+        self._xml_fragments = []
+
         XMLBuilderDomain.__init__(self, conn, parsexml, parsexmlnode,
                                   caps=caps)
 
@@ -102,6 +117,37 @@ class VirtualDevice(XMLBuilderDomain):
         # See XMLBuilderDomain for docs
         raise NotImplementedError()
 
+    def _get_xml_config_env(self):
+        """
+        Return global state the device XML depends on, besides the device
+        attributes. Overwritten by subclasses as needed.
+        """
+        return None
+
+    def get_xml_config(self, *args, **kwargs):
+        """
+        Construct and return device xml. The result is reused until an
+        attribute of the device (or of its address etc.) is set.
+
+        @return: device xml representation as a string
+        @rtype: str
+        """
+        if self._is_parse():
+            return XMLBuilderDomain.get_xml_config(self, *args, **kwargs)
+
+        key = (self._xml_state(), self._get_xml_config_env(),
+               args, kwargs)
+        for oldkey, xml in self._xml_fragments:
+            if oldkey == key:
+                VirtualDevice.fragments_reused += 1
+                return xml
+
+        xml = XMLBuilderDomain.get_xml_config(self, *args, **kwargs)
+        VirtualDevice.fragments_built += 1
+        self._xml_fragments.insert(0, (key, xml))
+        del(self._xml_fragments[_fragment_cache_size:])
+        return xml
+
     def setup_dev(self, conn=None, meter=None):
         """
         Perform potentially hazardous device initialization, like
@@ -121,6 +167,9 @@ class VirtualDevice(XMLBuilderDomain):
 
 
 class VirtualDeviceAlias(XMLBuilderDomain):
+    # Part of device XML, see VirtualDevice._track_xml_state
+    _track_xml_state = True
+
     def __init__(self, conn, parsexml=None, parsexmlnode=None, caps=None):
         XMLBuilderDomain.__init__(self, conn, parsexml, parsexmlnode,
                                   caps=caps)
@@ -139,6 +188,9 @@ class VirtualDeviceAlias(XMLBuilderDomain):
 
 class VirtualDeviceAddress(XMLBuilderDomain):
 
+    # Part of device XML, see VirtualDevice._track_xml_state
+    _track_xml_state = True
+
     ADDRESS_TYPE_PCI           = "pci"
     ADDRESS_TYPE_DRIVE         = "drive"
     ADDRESS_TYPE_VIRTIO_SERIAL = "virtio-serial"
@@ -270,3 +322,8 @@ class VirtualDeviceAddress(XMLBuilderDomain):
             xml += " controller='%s' slot='%s'" % (self.controller, self.slot)
         xml += "/>"
         return xml
+
+def stats_string():
+    total = VirtualDevice.fragments_built + VirtualDevice.fragments_reused
+    return ("Device XML: %d fragments, %d reused" %
+            (total, VirtualDevice.fragments_reused))
@@ -32,7 +32,9 @@ import libvirt
 
 import virtinst
 import _util
+import _filecopy
 import Storage
+import GuestInventory
 from VirtualDevice import VirtualDevice
 from XMLBuilderDomain import _xml_property
 from virtinst import _gettext as _
@@ -134,11 +136,10 @@ def _check_if_pool_source(conn, path):
         pool = conn.storagePoolLookupByName(poolname)
         xml = pool.XMLDesc(0)
 
-        for element in ["dir", "device", "adapter"]:
-            xml_path = _util.get_xml_path(xml,
-                                          "/pool/source/%s/@path" % element)
-            if xml_path == path:
-                return pool
+        xpaths = ["/pool/source/%s/@path" % element
+                  for element in ["dir", "device", "adapter"]]
+        if path in _util.get_xml_paths(xml, xpaths):
+            return pool
 
     running_list = conn.listStoragePools()
     inactive_list = conn.listDefinedStoragePools()
@@ -347,6 +348,12 @@ class VirtualDisk(VirtualDevice):
 
     error_policies = ["none", "stop", "enospace"]
 
+    PREALLOC_AUTO = _filecopy.PREALLOC_AUTO
+    PREALLOC_FALLOCATE = _filecopy.PREALLOC_FALLOCATE
+    PREALLOC_POSIX_FALLOCATE = _filecopy.PREALLOC_POSIX_FALLOCATE
+    PREALLOC_ZERO = _filecopy.PREALLOC_ZERO
+    prealloc_methods = _filecopy.prealloc_methods
+
     @staticmethod
     def path_exists(conn, path):
         """
@@ -470,31 +477,8 @@ class VirtualDisk(VirtualDevice):
         if not path:
             return
 
-        active, inactive = _util.fetch_all_guests(conn)
-        vms = active + inactive
-
-        def count_cb(ctx):
-            c = 0
-
-            template = "count(/domain/devices/disk["
-            if check_conflict:
-                template += "not(shareable) and "
-            template += "source/@%s='%s'])"
-
-            for dtype in VirtualDisk._target_props:
-                xpath = template % (dtype, path)
-                c += ctx.xpathEval(xpath)
-
-            return c
-
-        names = []
-        for vm in vms:
-            xml = vm.XMLDesc(0)
-            tmpcount = _util.get_xml_path(xml, func=count_cb)
-            if tmpcount:
-                names.append(vm.name())
-
-        return names
+        inv = GuestInventory.get_inventory(conn)
+        return inv.path_in_use_by(path, check_conflict=check_conflict)
 
     @staticmethod
     def stat_local_path(path):
@@ -606,6 +590,8 @@ class VirtualDisk(VirtualDevice):
         self._driver_cache = None
         self._selinux_label = None
         self._clone_path = None
+        self._copy_workers = 1
+        self._preallocation = self.PREALLOC_AUTO
         self._format = None
         self._driverName = driverName
         self._driverType = driverType
@@ -807,6 +793,32 @@ class VirtualDisk(VirtualDevice):
         self.__validate_wrapper("_sparse", val, validate, self.sparse)
     sparse = property(get_sparse, set_sparse)
 
+    def get_copy_workers(self):
+        return self._copy_workers
+    def set_copy_workers(self, val):
+        try:
+            val = int(val)
+        except (ValueError, TypeError):
+            raise ValueError(_("Copy workers must be an integer."))
+        if val < 1:
+            raise ValueError(_("Copy workers must be at least 1."))
+        self._copy_workers = val
+    copy_workers = property(get_copy_workers, set_copy_workers,
+                            doc="Number of threads copying byte ranges "
+                                "of a local clone_path in parallel")
+
+    def get_preallocation(self):
+        return self._preallocation
+    def set_preallocation(self, val):
+        if val not in self.prealloc_methods:
+            raise ValueError(_("Unknown preallocation method '%s'") % val)
+        self._preallocation = val
+    preallocation = property(get_preallocation, set_preallocation,
+                             doc="How to allocate a new non-sparse local "
+                                 "file, see PREALLOC_*. The default picks "
+                                 "the fastest method the filesystem "
+                                 "supports.")
+
     def get_read_only(self):
         return self._readOnly
     def set_read_only(self, val, validate=True):
@@ -1320,23 +1332,17 @@ class VirtualDisk(VirtualDevice):
 
         try:
             try:
-                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_DSYNC)
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT)
 
                 if sparse:
                     os.ftruncate(fd, size_bytes)
                 else:
-                    # 1 meg of nulls
-                    mb = 1024 * 1024
-                    buf = '\x00' * mb
-
-                    left = size_bytes
-                    while left > 0:
-                        if left < mb:
-                            buf = '\x00' * left
-                        left = max(left - mb, 0)
-
-                        os.write(fd, buf)
-                        progresscb.update(size_bytes - left)
+                    def progress_cb(pos):
+                        if pos < size_bytes:
+                            progresscb.update(pos)
+                    _filecopy.preallocate(fd, size_bytes,
+                                          method=self.preallocation,
+                                          progress_cb=progress_cb)
             except OSError, e:
                 raise RuntimeError(_("Error creating diskimage %s: %s") %
                                    (path, str(e)))
@@ -1350,7 +1356,6 @@ class VirtualDisk(VirtualDevice):
         # if a destination file exists and sparse flg is True,
         # this priority takes a existing file.
         if (os.path.exists(self.path) == False and self.sparse == True):
-            clone_block_size = 4096
             sparse = True
             fd = None
             try:
@@ -1360,46 +1365,28 @@ class VirtualDisk(VirtualDevice):
                 if fd:
                     os.close(fd)
         else:
-            clone_block_size = 1024 * 1024 * 10
             sparse = False
 
-        logging.debug("Local Cloning %s to %s, sparse=%s, block_size=%s" %
-                      (self.clone_path, self.path, sparse, clone_block_size))
+        logging.debug("Local Cloning %s to %s, sparse=%s" %
+                      (self.clone_path, self.path, sparse))
 
-        zeros = '\0' * 4096
+        # Meters of parallel disk clones can ask us to stop
+        check_cancelled = getattr(meter, "check_cancelled", None)
+
+        def progress_cb(pos):
+            if check_cancelled:
+                check_cancelled()
+            if pos < size_bytes:
+                meter.update(pos)
 
-        src_fd, dst_fd = None, None
         try:
-            try:
-                src_fd = os.open(self.clone_path, os.O_RDONLY)
-                dst_fd = os.open(self.path, os.O_WRONLY | os.O_CREAT)
-
-                i = 0
-                while 1:
-                    l = os.read(src_fd, clone_block_size)
-                    s = len(l)
-                    if s == 0:
-                        meter.end(size_bytes)
-                        break
-                    # check sequence of zeros
-                    if sparse and zeros == l:
-                        os.lseek(dst_fd, s, 1)
-                    else:
-                        b = os.write(dst_fd, l)
-                        if s != b:
-                            meter.end(i)
-                            break
-                    i += s
-                    if i < size_bytes:
-                        meter.update(i)
-            except OSError, e:
-                raise RuntimeError(_("Error cloning diskimage %s to %s: %s") %
-                                       (self.clone_path, self.path, str(e)))
-        finally:
-            if src_fd is not None:
-                os.close(src_fd)
-            if dst_fd is not None:
-                os.close(dst_fd)
+            _filecopy.copy_file_parallel(self.clone_path, self.path, None,
+                                         self.copy_workers, sparse=sparse,
+                                         progress_cb=progress_cb)
+            meter.end(size_bytes)
+        except OSError, e:
+            raise RuntimeError(_("Error cloning diskimage %s to %s: %s") %
+                                   (self.clone_path, self.path, str(e)))
 
     def setup_dev(self, conn=None, meter=None):
         """
@@ -1436,6 +1423,9 @@ class VirtualDisk(VirtualDevice):
                               (self.path, storage_label, self.selinux_label))
                 _util.selinux_setfilecon(self.path, self.selinux_label)
 
+    def _get_xml_config_env(self):
+        return virtinst.enable_rhel6_defaults
+
     def _get_xml_config(self, disknode=None):
         """
         @param disknode: device name in host (xvda, hdb, etc.). self.target
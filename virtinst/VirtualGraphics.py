@@ -31,7 +31,11 @@ def _get_mode_prop(channel_type):
     def get_mode(s):
         return s._channels.get(channel_type, None)
     def set_mode(s, val):
-        s._channels[channel_type] = val
+        # Replace the dict rather than changing it, so the cached
+        # device XML is invalidated
+        channels = s._channels.copy()
+        channels[channel_type] = val
+        s._channels = channels
     return _xml_property(get_mode, set_mode, xpath=xpath)
 
 class VirtualGraphics(VirtualDevice.VirtualDevice):
@@ -322,6 +326,10 @@ class VirtualGraphics(VirtualDevice.VirtualDevice):
                                passwdValidTo=self.passwdValidTo,
                                socket=self.socket)
 
+    def _get_xml_config_env(self):
+        # SDL config falls back to these
+        return (os.environ.get("DISPLAY"), os.environ.get("HOME"))
+
     def _get_xml_config(self):
         if self._type == self.TYPE_SDL:
             return self._sdl_config()
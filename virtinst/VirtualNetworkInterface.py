@@ -21,32 +21,17 @@ import logging
 import libvirt
 
 import _util
+import GuestInventory
 import VirtualDevice
 import XMLBuilderDomain
 from XMLBuilderDomain import _xml_property
 from virtinst import _gettext as _
 
-def _countMACaddr(vms, searchmac):
-    if not searchmac:
-        return
-
-    def count_cb(ctx):
-        c = 0
-
-        for mac in ctx.xpathEval("/domain/devices/interface/mac"):
-            macaddr = mac.xpathEval("attribute::address")[0].content
-            if macaddr and _util.compareMAC(searchmac, macaddr) == 0:
-                c += 1
-        return c
-
-    count = 0
-    for vm in vms:
-        xml = vm.XMLDesc(0)
-        count += _util.get_xml_path(xml, func=count_cb)
-    return count
-
 class VirtualPort(XMLBuilderDomain.XMLBuilderDomain):
 
+    # Part of device XML, see VirtualDevice._track_xml_state
+    _track_xml_state = True
+
     def __init__(self, conn, parsexml=None, parsexmlnode=None, caps=None):
         XMLBuilderDomain.XMLBuilderDomain.__init__(self, conn, parsexml,
                                                    parsexmlnode, caps=caps)
@@ -318,12 +303,13 @@ class VirtualNetworkInterface(VirtualDevice.VirtualDevice):
         if self.is_remote():
             return (False, None)
 
-        vms, inactive_vm = _util.fetch_all_guests(conn)
+        inv = GuestInventory.get_inventory(conn)
+        active_vms, inactive_vms = inv.mac_in_use_by(mac)
 
         # get the Host's NIC MACaddress
         hostdevs = _util.get_host_network_devices()
 
-        if _countMACaddr(vms, mac) > 0:
+        if active_vms:
             return (True, _("The MAC address you entered is already in use "
                             "by another active virtual machine."))
 
@@ -333,7 +319,7 @@ class VirtualNetworkInterface(VirtualDevice.VirtualDevice):
                 return (True, _("The MAC address you entered conflicts with "
                                 "a device on the physical host."))
 
-        if _countMACaddr(inactive_vm, mac) > 0:
+        if inactive_vms:
             return (False, _("The MAC address you entered is already in use "
                              "by another inactive virtual machine."))
 
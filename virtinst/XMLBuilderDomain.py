@@ -20,6 +20,8 @@
 # MA 02110-1301 USA.
 
 import copy
+import weakref
+import itertools
 
 import libvirt
 import libxml2
@@ -28,36 +30,95 @@ import CapabilitiesParser
 import _util
 from virtinst import _gettext as _
 
+class _XMLDoc(object):
+    """
+    A parsed document, and the xpath context shared by every object
+    backed by it. Objects point the context at their own node each time
+    they use it, see XMLBuilderDomain._xml_ctx
+    """
+    def __init__(self, doc):
+        self.doc = doc
+        self.refs = 0
+        self.ctx = doc.xpathNewContext()
+
+        # (context node, xpath, is_multi) -> lookup result, for
+        # _xml_property. Emptied whenever the document's structure changes
+        self.nodes = {}
+
+    def free(self):
+        self.nodes = {}
+        self.ctx.xpathFreeContext()
+        self.ctx = None
+        self.doc.freeDoc()
+        self.doc = None
+
+# Source of XMLBuilderDomain._xml_gen values, unique across all objects
+_xml_generation = itertools.count(1)
+# Attribute sets logged in a copy's _xml_overlay before they are folded
+# into a new _xml_gen
+_max_xml_overlay = 8
+
+# Parsed document -> _XMLDoc. libxml2 wrappers hash and compare by the
+# underlying xmlDoc, so any wrapper for a document finds its entry.
 _xml_refs = {}
+
 def _unref_doc(doc):
     if not doc:
         return
 
-    idx = None
-    for n in _xml_refs:
-        if n == doc:
-            idx = n
-            break
-
-    if not idx:
+    xmldoc = _xml_refs.get(doc)
+    if not xmldoc:
         return
 
-    _xml_refs[idx] = _xml_refs[idx] - 1
-    if _xml_refs[idx] == 0:
-        idx.freeDoc()
+    xmldoc.refs -= 1
+    if xmldoc.refs == 0:
+        del(_xml_refs[doc])
+        xmldoc.free()
 
 def _ref_doc(doc):
-    if not doc:
-        return
+    xmldoc = _xml_refs.get(doc)
+    if not xmldoc:
+        xmldoc = _XMLDoc(doc)
+        _xml_refs[doc] = xmldoc
 
-    idx = doc
-    for n in _xml_refs:
-        if n == doc:
-            idx = n
-            break
+    xmldoc.refs += 1
+    return xmldoc
 
-    refcount = _xml_refs.get(idx) or 0
-    _xml_refs[idx] = refcount + 1
+class _XMLHandle(object):
+    """
+    An object's reference to its parsed document. Released by a weakref
+    callback when the object goes away, so freeing doesn't depend on
+    __del__, which would also keep objects in reference cycles from ever
+    being collected.
+    """
+    def __init__(self, doc):
+        self.xmldoc = _ref_doc(doc)
+
+    def release(self):
+        if self.xmldoc:
+            _unref_doc(self.xmldoc.doc)
+            self.xmldoc = None
+
+# id(weakref) -> (weakref, _XMLHandle), keeps the weakrefs alive until
+# their object is collected
+_xml_handles = {}
+
+def _handle_released(ref):
+    try:
+        ignore, handle = _xml_handles.pop(id(ref))
+        handle.release()
+    except:
+        # Can fail at interpreter shutdown
+        pass
+
+def _track_handle(obj, handle):
+    ref = weakref.ref(obj, _handle_released)
+    _xml_handles[id(ref)] = (ref, handle)
+    return ref
+
+def _untrack_handle(ref):
+    ignore, handle = _xml_handles.pop(id(ref))
+    handle.release()
 
 def _sanitize_libxml_xml(xml):
     # Strip starting <?...> line
@@ -67,6 +128,59 @@ def _sanitize_libxml_xml(xml):
         xml += "\n"
     return xml
 
+class _XPath(object):
+    """
+    An xpath string, split up for _build_xpath_node and _remove_xpath_node
+    """
+    def __init__(self, xpath):
+        self.xpath = xpath
+
+        # (path of the node so far, name of the node to create,
+        #  whether it's an attribute)
+        self.steps = []
+        parentpath = ""
+        for nodename in xpath.split("/"):
+            if not nodename:
+                continue
+
+            if nodename.startswith("@"):
+                self.steps.append((None, nodename.strip("@"), True))
+                continue
+
+            if not parentpath:
+                parentpath = nodename
+            else:
+                parentpath += "/%s" % nodename
+
+            # Remove conditional xpath elements for node creation
+            if nodename.count("["):
+                nodename = nodename[:nodename.index("[")]
+            self.steps.append((parentpath, nodename, False))
+
+        # The xpath and all its ancestors, innermost first
+        self.parents = []
+        curxpath = xpath
+        while curxpath:
+            self.parents.append(curxpath)
+            if curxpath.count("/"):
+                curxpath, ignore = curxpath.rsplit("/", 1)
+            else:
+                curxpath = None
+
+# xpath string -> _XPath. Mostly the static xpaths of _xml_property, but
+# nodePath() results end up here too, so it's emptied if it grows too big
+_xpath_cache = {}
+_xpath_cache_max = 2048
+
+def _compile_xpath(xpath):
+    ret = _xpath_cache.get(xpath)
+    if ret is None:
+        if len(_xpath_cache) >= _xpath_cache_max:
+            _xpath_cache.clear()
+        ret = _XPath(xpath)
+        _xpath_cache[xpath] = ret
+    return ret
+
 def _get_xpath_node(ctx, xpath, is_multi=False):
     node = ctx.xpathEval(xpath)
     if not is_multi:
@@ -79,7 +193,6 @@ def _build_xpath_node(ctx, xpath, addnode=None):
     to set xpath /foo/bar/baz@booyeah, we create node 'bar' and 'baz'
     returning the last node created.
     """
-    parentpath = ""
     parentnode = None
 
     def prevSibling(node):
@@ -137,23 +250,12 @@ def _build_xpath_node(ctx, xpath, addnode=None):
         newnode.addNextSibling(txt)
         return newnode
 
-    nodelist = xpath.split("/")
-    for idx in range(len(nodelist)):
-        nodename = nodelist[idx]
-        if not nodename:
-            continue
-
+    for parentpath, nodename, is_prop in _compile_xpath(xpath).steps:
         # If xpath is a node property, set it and move on
-        if nodename.startswith("@"):
-            nodename = nodename.strip("@")
+        if is_prop:
             parentnode = parentnode.setProp(nodename, "")
             continue
 
-        if not parentpath:
-            parentpath = nodename
-        else:
-            parentpath += "/%s" % nodename
-
         # Node found, nothing to create for now
         node = _get_xpath_node(ctx, parentpath)
         if node:
@@ -163,10 +265,6 @@ def _build_xpath_node(ctx, xpath, addnode=None):
         if not parentnode:
             raise RuntimeError("Could not find XML root node")
 
-        # Remove conditional xpath elements for node creation
-        if nodename.count("["):
-            nodename = nodename[:nodename.index("[")]
-
         newnode = libxml2.newNode(nodename)
         parentnode = make_node(parentnode, newnode)
 
@@ -179,16 +277,9 @@ def _remove_xpath_node(ctx, xpath, dofree=True):
     """
     Remove an XML node tree if it has no content
     """
-    curxpath = xpath
-
-    while curxpath:
+    for curxpath in _compile_xpath(xpath).parents:
         is_orig = (curxpath == xpath)
         node = _get_xpath_node(ctx, curxpath)
-        if curxpath.count("/"):
-            curxpath, ignore = curxpath.rsplit("/", 1)
-        else:
-            curxpath = None
-
         if not node:
             continue
 
@@ -266,8 +357,7 @@ def _xml_property(fget=None, fset=None, fdel=None, doc=None,
         if usexpath is None:
             return getval
 
-        nodes = _util.listify(_get_xpath_node(self._xml_ctx,
-                                              usexpath, is_multi))
+        nodes = _util.listify(self._xpath_lookup(usexpath, is_multi))
         if nodes:
             ret = []
             for node in nodes:
@@ -311,8 +401,7 @@ def _xml_property(fget=None, fset=None, fdel=None, doc=None,
         if nodexpath is None:
             return
 
-        nodes = _util.listify(_get_xpath_node(self._xml_ctx,
-                                              nodexpath, is_multi))
+        nodes = _util.listify(self._xpath_lookup(nodexpath, is_multi))
 
         xpath_list = nodexpath
         if xml_set_list:
@@ -323,21 +412,30 @@ def _xml_property(fget=None, fset=None, fdel=None, doc=None,
                        _util.listify(val),
                        _util.listify(xpath_list))
 
+        # Setting an attribute's value leaves the cached lookups valid,
+        # anything else may have added or freed nodes
+        changed = False
         for node, val, usexpath in node_map:
-            if node:
-                usexpath = node.nodePath()
-
             if val not in [None, False]:
                 if not node:
                     node = _build_xpath_node(self._xml_node, usexpath)
+                    changed = True
 
                 if val is True:
                     # Boolean property, creating the node is enough
                     pass
                 else:
                     node.setContent(str(val))
+                    if node.type != "attribute":
+                        changed = True
             else:
+                if node:
+                    usexpath = node.nodePath()
                 _remove_xpath_node(self._xml_node, usexpath)
+                changed = True
+
+        if changed:
+            self._xml_changed()
 
 
     if fdel:
@@ -352,6 +450,21 @@ class XMLBuilderDomain(object):
     """
 
     _dumpxml_xpath = "."
+
+    # Whether _xml_property lookups are cached per document. Only turned
+    # off for comparison, see tests/xmlpropbench.py
+    _cache_nodes = True
+
+    # Whether attribute sets are tracked for _xml_state. Only turned on
+    # for classes whose XML is cached (see VirtualDevice.get_xml_config),
+    # and off for parsed objects
+    _track_xml_state = False
+    # Bumped to a new value whenever an attribute is set, see _xml_state
+    _xml_gen = 0
+    # For copies made by copy(), list of the (name, value) attribute sets
+    # made since, instead of bumping _xml_gen
+    _xml_overlay = None
+
     def __init__(self, conn=None, parsexml=None, parsexmlnode=None,
                  caps=None):
         """
@@ -370,7 +483,8 @@ class XMLBuilderDomain(object):
         self.__caps = None
 
         self._xml_node = None
-        self._xml_ctx = None
+        self._xml_doc = None
+        self._xml_ref = None
 
         if conn:
             self.set_conn(conn)
@@ -383,23 +497,45 @@ class XMLBuilderDomain(object):
         if parsexml or parsexmlnode:
             self._parsexml(parsexml, parsexmlnode)
 
-    def __del__(self):
-        try:
-            if self._xml_node:
-                _unref_doc(self._xml_node.doc)
-        except:
-            pass
-        try:
-            if self._xml_ctx:
-                self._xml_ctx.xpathFreeContext()
-        except:
-            pass
+    def __setattr__(self, name, val):
+        object.__setattr__(self, name, val)
+        if not self._track_xml_state:
+            return
+
+        overlay = self._xml_overlay
+        if overlay is not None and len(overlay) < _max_xml_overlay:
+            overlay.append((name, val))
+        else:
+            self.__dict__["_xml_gen"] = _xml_generation.next()
+            if overlay:
+                self.__dict__["_xml_overlay"] = []
+
+    def _xml_state(self):
+        """
+        Return a value which compares equal for two calls only if nothing
+        the object's XML is built from was set in between, on it or on
+        its XMLBuilderDomain attributes. Untracked objects never compare
+        equal.
+        """
+        if not self._track_xml_state:
+            return _xml_generation.next()
+
+        children = []
+        for name, val in self.__dict__.items():
+            if isinstance(val, XMLBuilderDomain):
+                children.append((name, val._xml_state()))
+        children.sort()
+        return (self._xml_gen, tuple(self._xml_overlay or ()), children)
 
     def copy(self):
         # Otherwise we can double free XML info
         if self._is_parse():
             return self
-        return copy.copy(self)
+        ret = copy.copy(self)
+        if self._track_xml_state:
+            # Copies start out in the same state as us
+            ret.__dict__["_xml_overlay"] = list(self._xml_overlay or [])
+        return ret
 
     def get_conn(self):
         return self._conn
@@ -416,7 +552,7 @@ class XMLBuilderDomain(object):
 
     def _get_caps(self):
         if not self.__caps and self.conn:
-            self.__caps = CapabilitiesParser.parse(self.conn.getCapabilities())
+            self.__caps = CapabilitiesParser.get_conn_caps(self.conn)
         return self.__caps
 
     def is_remote(self):
@@ -440,7 +576,7 @@ class XMLBuilderDomain(object):
                                 (name, type(val))))
 
     def _is_parse(self):
-        return bool(self._xml_node or self._xml_ctx)
+        return bool(self._xml_node)
 
     def set_xml_node(self, node):
         self._parsexml(None, node)
@@ -452,28 +588,64 @@ class XMLBuilderDomain(object):
 
     def _add_child_node(self, parent_xpath, newnode):
         ret = _build_xpath_node(self._xml_ctx, parent_xpath, newnode)
+        self._xml_changed()
         return ret
 
     def _remove_child_xpath(self, xpath):
         _remove_xpath_node(self._xml_ctx, xpath, dofree=False)
-        self._set_xml_context()
+        self._xml_changed()
 
-    def _set_xml_context(self):
-        doc = self._xml_node.doc
-        ctx = doc.xpathNewContext()
+    def _xpath_lookup(self, xpath, is_multi=False):
+        """
+        _get_xpath_node relative to our node, remembering the result
+        until the document changes
+        """
+        if not self._cache_nodes:
+            return _get_xpath_node(self._xml_ctx, xpath, is_multi)
+
+        key = (self._xml_node, xpath, is_multi)
+        try:
+            return self._xml_doc.nodes[key]
+        except KeyError:
+            pass
+
+        ret = _get_xpath_node(self._xml_ctx, xpath, is_multi)
+        self._xml_doc.nodes[key] = ret
+        return ret
+
+    def _xml_changed(self):
+        self._xml_doc.nodes.clear()
+
+        # Our node may have been moved into another document since we
+        # parsed it, see Guest.add_device
+        xmldoc = _xml_refs.get(self._xml_node.doc)
+        if xmldoc:
+            xmldoc.nodes.clear()
+
+    def _get_xml_ctx(self):
+        # The document's shared context, pointed at our node
+        if not self._xml_doc:
+            return None
+        ctx = self._xml_doc.ctx
         ctx.setContextNode(self._xml_node)
-        if self._xml_ctx:
-            self._xml_ctx.xpathFreeContext()
-        self._xml_ctx = ctx
+        return ctx
+    _xml_ctx = property(_get_xml_ctx)
 
     def _parsexml(self, xml, node):
         if xml:
-            self._xml_node = libxml2.parseDoc(xml).children
-        else:
-            self._xml_node = node
+            node = libxml2.parseDoc(xml).children
+
+        # Take the new reference first, in case node is from the
+        # document we already hold
+        handle = _XMLHandle(node.doc)
+        ref = _track_handle(self, handle)
+        if self._xml_ref:
+            _untrack_handle(self._xml_ref)
 
-        _ref_doc(self._xml_node.doc)
-        self._set_xml_context()
+        self._xml_node = node
+        self._xml_doc = handle.xmldoc
+        self._xml_ref = ref
+        self._track_xml_state = False
 
     def _get_xml_config(self):
         """
@@ -488,7 +660,7 @@ class XMLBuilderDomain(object):
         @return: object xml representation as a string
         @rtype: str
         """
-        if self._xml_ctx:
+        if self._xml_node:
             node = _get_xpath_node(self._xml_ctx, self._dumpxml_xpath)
             if not node:
                 return ""
@@ -498,10 +670,8 @@ class XMLBuilderDomain(object):
 
     @staticmethod
     def indent(xmlstr, level):
-        xml = ""
         if not xmlstr:
-            return xml
+            return ""
 
-        for l in iter(xmlstr.splitlines()):
-            xml += " " * level + l + "\n"
-        return xml
+        pad = " " * level
+        return "".join([pad + l + "\n" for l in xmlstr.splitlines()])
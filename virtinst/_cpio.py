@@ -0,0 +1,353 @@
+#
+# Helpers for building initrd cpio archives in process
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+#
+# Internal utility functions. These do NOT form part of the API and must
+# not be used by clients.
+#
+
+import os
+import stat
+import zlib
+import logging
+import threading
+
+import _util
+
+_newc_magic = "070701"
+_trailer = "TRAILER!!!"
+_read_size = 65536
+
+# gzip output from zlib, see deflateInit2
+_gzip_wbits = 16 + zlib.MAX_WBITS
+DEFAULT_LEVEL = 9
+
+# Biggest injected segment we keep in memory, and how many of them
+SEGMENT_CACHE_MAX = 4 * 1024 * 1024
+SEGMENT_CACHE_ENTRIES = 8
+
+def _pad(length):
+    return "\0" * ((4 - length % 4) % 4)
+
+class GzipWriter(object):
+    """
+    File-like object gzip compressing everything written to it onto
+    fileobj, as a single gzip member
+    """
+    def __init__(self, fileobj, level=DEFAULT_LEVEL):
+        self.fileobj = fileobj
+        self._compress = zlib.compressobj(level, zlib.DEFLATED, _gzip_wbits)
+
+    def write(self, data):
+        buf = self._compress.compress(data)
+        if buf:
+            self.fileobj.write(buf)
+
+    def close(self):
+        self.fileobj.write(self._compress.flush())
+
+class CpioWriter(object):
+    """
+    Writes a newc format cpio archive, as understood by the kernel's
+    initramfs unpacker, to a file-like object
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self._ino = 0
+
+    def _header(self, name, mode, size, nlink=1, mtime=0):
+        self._ino += 1
+        namesize = len(name) + 1
+        hdr = _newc_magic + "".join(["%08X" % val for val in
+                                     [self._ino, mode, 0, 0, nlink, mtime,
+                                      size, 0, 0, 0, 0, namesize, 0]])
+        hdr += name + "\0"
+        self.fileobj.write(hdr + _pad(len(hdr)))
+
+    def add_dir(self, name, mode=0755):
+        self._header(name, stat.S_IFDIR | (mode & 07777), 0, nlink=2)
+
+    def add_data(self, name, data, mode=0644):
+        """
+        Add a regular file with contents data
+        """
+        self._header(name, stat.S_IFREG | (mode & 07777), len(data))
+        self.fileobj.write(data + _pad(len(data)))
+
+    def add_file(self, name, fileobj, size, mode=0644):
+        """
+        Add a regular file, streaming size bytes of contents from fileobj
+        """
+        self._header(name, stat.S_IFREG | (mode & 07777), size)
+        left = size
+        while left > 0:
+            buf = fileobj.read(min(left, _read_size))
+            if not buf:
+                raise IOError("File %s shrank while archiving it" % name)
+            self.fileobj.write(buf)
+            left -= len(buf)
+        self.fileobj.write(_pad(size))
+
+    def add_symlink(self, name, target):
+        self._header(name, stat.S_IFLNK | 0777, len(target))
+        self.fileobj.write(target + _pad(len(target)))
+
+    def finish(self):
+        self._header(_trailer, 0, 0, nlink=1)
+
+def add_tree(cpio, topdir):
+    """
+    Add the contents of the local directory topdir (but not topdir
+    itself) to cpio, with names relative to topdir
+    """
+    for root, dirs, files in os.walk(topdir):
+        dirs.sort()
+        for name in dirs + sorted(files):
+            path = os.path.join(root, name)
+            arcname = path[len(topdir):].lstrip("/")
+            st = os.lstat(path)
+
+            if stat.S_ISLNK(st.st_mode):
+                cpio.add_symlink(arcname, os.readlink(path))
+            elif stat.S_ISDIR(st.st_mode):
+                cpio.add_dir(arcname, stat.S_IMODE(st.st_mode))
+            elif stat.S_ISREG(st.st_mode):
+                f = open(path, "rb")
+                try:
+                    cpio.add_file(arcname, f, st.st_size,
+                                  stat.S_IMODE(st.st_mode))
+                finally:
+                    f.close()
+
+class CpioEntry(object):
+    """
+    A member of an archive being read by CpioReader. read() returns its
+    contents.
+    """
+    def __init__(self, reader, raw_header, name, mode, size):
+        self.reader = reader
+        self.raw_header = raw_header
+        self.name = name
+        self.mode = mode
+        self.size = size
+        self._left = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self._left:
+            size = self._left
+        if not size:
+            return ""
+        buf = self.reader._read_exact(size)
+        self._left -= len(buf)
+        return buf
+
+    def _skip(self):
+        while self._left:
+            self.read(_read_size)
+        self.reader._read_exact(len(_pad(self.size)))
+
+class CpioReader(object):
+    """
+    Reads a newc (or crc) format cpio archive sequentially from a
+    file-like object
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self._entry = None
+
+    def _read_exact(self, size):
+        ret = []
+        left = size
+        while left:
+            buf = self.fileobj.read(left)
+            if not buf:
+                raise IOError("Truncated cpio archive")
+            ret.append(buf)
+            left -= len(buf)
+        return "".join(ret)
+
+    def next_entry(self):
+        """
+        Return the next CpioEntry, or None at the end of the archive.
+        Anything left unread of the previous entry is skipped.
+        """
+        if self._entry:
+            self._entry._skip()
+            self._entry = None
+
+        hdr = self._read_exact(110)
+        if hdr[:6] not in [_newc_magic, "070702"]:
+            raise IOError("Unsupported cpio header magic %r" % hdr[:6])
+
+        mode = int(hdr[14:22], 16)
+        size = int(hdr[54:62], 16)
+        namesize = int(hdr[94:102], 16)
+        rawname = self._read_exact(namesize)
+        raw = hdr + rawname
+        raw += self._read_exact(len(_pad(len(raw))))
+
+        name = rawname.rstrip("\0")
+        if name == _trailer:
+            return None
+        self._entry = CpioEntry(self, raw, name, mode, size)
+        return self._entry
+
+    def __iter__(self):
+        while True:
+            entry = self.next_entry()
+            if entry is None:
+                break
+            yield entry
+
+def copy_archive(fileobj, out):
+    """
+    Copy the cpio archive read from fileobj to out verbatim, except for
+    its trailer, so more members can be appended
+    """
+    for entry in CpioReader(fileobj):
+        out.write(entry.raw_header)
+        while True:
+            buf = entry.read(_read_size)
+            if not buf:
+                break
+            out.write(buf)
+        out.write(_pad(entry.size))
+
+class _TeeWriter(object):
+    """
+    Write to fileobj, and keep a copy of everything written as long as it
+    stays under limit
+    """
+    def __init__(self, fileobj, limit):
+        self.fileobj = fileobj
+        self.limit = limit
+        self.size = 0
+        self._bufs = []
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.size += len(data)
+        if self._bufs is not None:
+            if self.size > self.limit:
+                self._bufs = None
+            else:
+                self._bufs.append(data)
+
+    def getvalue(self):
+        if self._bufs is None:
+            return None
+        return "".join(self._bufs)
+
+# Compressed archive segments, keyed by the hash of the injected files
+_segment_cache = {}
+_segment_order = []
+_segment_lock = threading.Lock()
+_segment_hits = 0
+
+def _injection_key(filenames, level):
+    """
+    Hash of everything that ends up in the archive segment: names, modes
+    and contents of filenames
+    """
+    digest = _util.sha1()
+    digest.update("%d\n" % level)
+    for filename in filenames:
+        st = os.stat(filename)
+        digest.update("%s\n%o\n%d\n" % (os.path.basename(filename),
+                                        stat.S_IMODE(st.st_mode),
+                                        st.st_size))
+        f = open(filename, "rb")
+        try:
+            while True:
+                buf = f.read(_read_size)
+                if not buf:
+                    break
+                digest.update(buf)
+        finally:
+            f.close()
+    return digest.hexdigest()
+
+def _get_segment(key):
+    global _segment_hits
+
+    _segment_lock.acquire()
+    try:
+        data = _segment_cache.get(key)
+        if data is not None:
+            _segment_hits += 1
+            _segment_order.remove(key)
+            _segment_order.append(key)
+        return data
+    finally:
+        _segment_lock.release()
+
+def _put_segment(key, data):
+    _segment_lock.acquire()
+    try:
+        if key in _segment_cache:
+            return
+        _segment_cache[key] = data
+        _segment_order.append(key)
+        while len(_segment_order) > SEGMENT_CACHE_ENTRIES:
+            del(_segment_cache[_segment_order.pop(0)])
+    finally:
+        _segment_lock.release()
+
+def write_injections(fileobj, filenames, level=DEFAULT_LEVEL):
+    """
+    Write a gzip compressed cpio archive holding filenames in its root
+    directory to fileobj
+    """
+    gz = GzipWriter(fileobj, level)
+    cpio = CpioWriter(gz)
+    cpio.add_dir(".", 0775)
+    for filename in filenames:
+        st = os.stat(filename)
+        f = open(filename, "rb")
+        try:
+            cpio.add_file(os.path.basename(filename), f, st.st_size,
+                          stat.S_IMODE(st.st_mode))
+        finally:
+            f.close()
+    cpio.finish()
+    gz.close()
+
+def append_injections(initrd, filenames, level=DEFAULT_LEVEL):
+    """
+    Append filenames to the root directory of the initrd, as a new gzip
+    compressed cpio segment. Segments for the same set of file contents
+    are reused from memory.
+    """
+    key = _injection_key(filenames, level)
+    segment = _get_segment(key)
+
+    f = open(initrd, "ab")
+    try:
+        if segment is not None:
+            logging.debug("Reusing cached initrd segment %s" % key)
+            f.write(segment)
+            return
+
+        tee = _TeeWriter(f, SEGMENT_CACHE_MAX)
+        write_injections(tee, filenames, level)
+    finally:
+        f.close()
+
+    segment = tee.getvalue()
+    if segment is not None:
+        _put_segment(key, segment)
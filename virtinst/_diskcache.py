@@ -0,0 +1,101 @@
+#
+# Helpers shared by the on disk caches
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+#
+# Internal utility functions. These do NOT form part of the API and must
+# not be used by clients.
+#
+
+import os
+import time
+import ConfigParser
+import StringIO
+
+def env_value(env_var):
+    """
+    Return the value of the environment variable enabling a cache, or
+    None if it is unset or turns the cache off (0, no, off)
+    """
+    val = os.environ.get(env_var)
+    if not val or val.lower() in ["0", "no", "off"]:
+        return None
+    return val
+
+def ttl_from_env(env_var, default_ttl):
+    """
+    Return the cache TTL in seconds set by env_var, default_ttl if it is
+    just turned on ('yes'), or None if the cache isn't enabled
+    """
+    val = env_value(env_var)
+    if val is None:
+        return None
+    try:
+        return int(val)
+    except ValueError:
+        return default_ttl
+
+def make_cachedir(path):
+    if not os.path.exists(path):
+        os.makedirs(path, 0700)
+
+def new_config():
+    """
+    Return an empty ConfigParser for a cache entry. Option names keep
+    their case.
+    """
+    conf = ConfigParser.RawConfigParser()
+    conf.optionxform = str
+    return conf
+
+def read_config(path):
+    conf = new_config()
+    conf.read(path)
+    return conf
+
+def set_timestamp(conf, section):
+    """
+    Record the current time in conf, at full precision
+    """
+    conf.set(section, "timestamp", repr(time.time()))
+
+def check_age(conf, section, ttl):
+    """
+    Return True if the timestamp in conf is less than ttl seconds old,
+    and not in the future
+    """
+    age = time.time() - float(conf.get(section, "timestamp"))
+    return age >= 0 and age <= ttl
+
+def write_file(path, data):
+    """
+    Write data to path through a temp file and a rename, so concurrent
+    readers never see a partial file. The directory is created if needed.
+    """
+    make_cachedir(os.path.dirname(path))
+    tmppath = path + ".tmp.%d" % os.getpid()
+    f = open(tmppath, "w")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmppath, path)
+
+def write_config(path, conf):
+    buf = StringIO.StringIO()
+    conf.write(buf)
+    write_file(path, buf.getvalue())
@@ -0,0 +1,657 @@
+#
+# Helpers for efficiently copying local disk images
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+#
+# Internal utility functions. These do NOT form part of the API and must
+# not be used by clients.
+#
+
+import os
+import sys
+import stat
+import array
+import errno
+import fcntl
+import struct
+import logging
+import threading
+import Queue
+
+try:
+    import ctypes
+    _libc = ctypes.CDLL(None, use_errno=True)
+except (ImportError, OSError):
+    ctypes = None
+    _libc = None
+
+# lseek whence values for finding data and holes (Linux, Solaris)
+SEEK_DATA = getattr(os, "SEEK_DATA", 3)
+SEEK_HOLE = getattr(os, "SEEK_HOLE", 4)
+
+# FIEMAP ioctl, see linux/fiemap.h
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_FLAG_SYNC = 0x1
+FIEMAP_EXTENT_LAST = 0x1
+FIEMAP_EXTENT_UNWRITTEN = 0x800
+_fiemap_header = "=QQLLLL"
+_fiemap_extent = "=QQQQQLLLL"
+_fiemap_batch = 256
+
+# Reflink ioctl, see linux/fs.h
+FICLONE = 0x40049409
+
+# Errors meaning a copy method isn't supported for a pair of files
+_unsupported_errnos = [errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                       errno.EOPNOTSUPP, errno.EBADF, errno.ENOTTY,
+                       errno.EPERM]
+
+# Granularity of hole detection when scanning data for zeros
+SPARSE_BLOCK_SIZE = 4096
+# Size of each read when copying through userspace
+COPY_BLOCK_SIZE = 1024 * 1024
+# Size of each in kernel copy call, between progress updates
+KERNEL_COPY_SIZE = 64 * 1024 * 1024
+# Size of the byte ranges handed to each worker by copy_file_parallel
+PARALLEL_RANGE_SIZE = 64 * 1024 * 1024
+# Size of each write when preallocating by writing zeros
+ZERO_WRITE_SIZE = 8 * 1024 * 1024
+
+# Preallocation methods, see preallocate()
+PREALLOC_AUTO = "auto"
+PREALLOC_FALLOCATE = "fallocate"
+PREALLOC_POSIX_FALLOCATE = "posix_fallocate"
+PREALLOC_ZERO = "zero"
+prealloc_methods = [PREALLOC_AUTO, PREALLOC_FALLOCATE,
+                    PREALLOC_POSIX_FALLOCATE, PREALLOC_ZERO]
+
+_zeros = "\0" * COPY_BLOCK_SIZE
+
+def is_regular_fd(fd):
+    return stat.S_ISREG(os.fstat(fd).st_mode)
+
+def fd_size(fd):
+    """
+    Size of the file or block device open at fd
+    """
+    if is_regular_fd(fd):
+        return os.fstat(fd).st_size
+    return os.lseek(fd, 0, 2)
+
+def _seek_extents(fd, size):
+    extents = []
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, SEEK_DATA)
+        except OSError, e:
+            if e.errno == errno.ENXIO:
+                # No more data after pos
+                break
+            raise
+        end = min(os.lseek(fd, start, SEEK_HOLE), size)
+        if end > start:
+            extents.append((start, end - start))
+        pos = end
+    return extents
+
+def _fiemap_extents(fd, size):
+    extents = []
+    pos = 0
+    extsize = struct.calcsize(_fiemap_extent)
+    while pos < size:
+        req = array.array("B", struct.pack(_fiemap_header, pos, size - pos,
+                                           FIEMAP_FLAG_SYNC, 0,
+                                           _fiemap_batch, 0) +
+                               "\0" * (extsize * _fiemap_batch))
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, req, True)
+        ret = req.tostring()
+
+        hdrsize = struct.calcsize(_fiemap_header)
+        count = struct.unpack(_fiemap_header, ret[:hdrsize])[3]
+        if not count:
+            break
+
+        last = False
+        for i in range(count):
+            off = hdrsize + i * extsize
+            (logical, ignore, length, ignore, ignore,
+             flags, ignore, ignore, ignore) = struct.unpack(_fiemap_extent,
+                                                    ret[off:off + extsize])
+            pos = logical + length
+            last = bool(flags & FIEMAP_EXTENT_LAST)
+
+            # Unwritten extents are preallocated but read back as zeros
+            if flags & FIEMAP_EXTENT_UNWRITTEN:
+                continue
+
+            length = min(length, size - logical)
+            if length <= 0:
+                continue
+            if extents and extents[-1][0] + extents[-1][1] == logical:
+                extents[-1] = (extents[-1][0], extents[-1][1] + length)
+            else:
+                extents.append((logical, length))
+        if last:
+            break
+    return extents
+
+def data_extents(fd, size):
+    """
+    Return (extents, method): a list of (offset, length) regions of fd
+    that may contain data, and the name of the method used to find them.
+    Everything outside the extents is a hole. Tries SEEK_DATA/SEEK_HOLE,
+    then FIEMAP, then reports the whole file as data.
+    """
+    if is_regular_fd(fd):
+        for method, func in [("seek", _seek_extents),
+                             ("fiemap", _fiemap_extents)]:
+            try:
+                return func(fd, size), method
+            except (OSError, IOError), e:
+                logging.debug("Finding extents with %s failed: %s" %
+                              (method, e))
+    return [(0, size)], "full"
+
+def _use_kernel_copy(sparse, extents, size, method):
+    """
+    Kernel copies write zero blocks out as data. For a sparse copy only
+    use them if the extent map found holes: a source that seems to have
+    none (unknown extents, or a preallocated image) may still be mostly
+    zeros, which the userspace copy leaves as holes.
+    """
+    if not sparse:
+        return True
+    data_bytes = sum([l for ignore, l in extents])
+    return method != "full" and data_bytes < size
+
+def _libc_func(name, restype, argtypes):
+    if not _libc or not hasattr(_libc, name):
+        return None
+    func = getattr(_libc, name)
+    func.restype = restype
+    func.argtypes = argtypes
+    return func
+
+if ctypes:
+    _ssize_t = getattr(ctypes, "c_ssize_t", ctypes.c_long)
+    _loff_p = ctypes.POINTER(ctypes.c_longlong)
+    _copy_file_range = _libc_func("copy_file_range", _ssize_t,
+                                  [ctypes.c_int, _loff_p, ctypes.c_int,
+                                   _loff_p, ctypes.c_size_t, ctypes.c_uint])
+    _sendfile = _libc_func("sendfile64", _ssize_t,
+                           [ctypes.c_int, ctypes.c_int, _loff_p,
+                            ctypes.c_size_t])
+    _fallocate = _libc_func("fallocate64", ctypes.c_int,
+                            [ctypes.c_int, ctypes.c_int, ctypes.c_longlong,
+                             ctypes.c_longlong])
+    _posix_fallocate = _libc_func("posix_fallocate64", ctypes.c_int,
+                                  [ctypes.c_int, ctypes.c_longlong,
+                                   ctypes.c_longlong])
+else:
+    _copy_file_range = None
+    _sendfile = None
+    _fallocate = None
+    _posix_fallocate = None
+
+def _check_libc_ret(ret):
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ret
+
+def _is_unsupported(e):
+    return isinstance(e, (OSError, IOError)) and e.errno in _unsupported_errnos
+
+def reflink(src_fd, dst_fd):
+    """
+    Make dst_fd share all of src_fd's blocks (XFS, btrfs, ...). Raises
+    OSError/IOError if not supported for this pair of files.
+    """
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+def _kernel_copy_file_range(src_fd, dst_fd, offset, count):
+    off_in = ctypes.c_longlong(offset)
+    off_out = ctypes.c_longlong(offset)
+    return _check_libc_ret(_copy_file_range(src_fd, ctypes.byref(off_in),
+                                            dst_fd, ctypes.byref(off_out),
+                                            count, 0))
+
+def _kernel_sendfile(src_fd, dst_fd, offset, count):
+    off_in = ctypes.c_longlong(offset)
+    os.lseek(dst_fd, offset, 0)
+    return _check_libc_ret(_sendfile(dst_fd, src_fd, ctypes.byref(off_in),
+                                     count))
+
+class _RangeCopier(object):
+    """
+    Copies byte ranges between a pair of fds using the best method that
+    works for them: copy_file_range, then sendfile, then a userspace
+    read/write loop. A method that fails as unsupported is dropped for
+    the rest of the copy.
+    """
+    def __init__(self, src_fd, dst_fd, sparse, use_kernel=True):
+        self.src_fd = src_fd
+        self.dst_fd = dst_fd
+        self.sparse = sparse
+
+        self.tiers = []
+        if use_kernel:
+            if _copy_file_range:
+                self.tiers.append(("copy_file_range",
+                                   _kernel_copy_file_range))
+            if _sendfile:
+                self.tiers.append(("sendfile", _kernel_sendfile))
+        self.tiers.append(("userspace", None))
+
+    def tier(self):
+        return self.tiers[0][0]
+
+    def _userspace_copy(self, offset, length, progress_cb):
+        _copy_range(self.src_fd, self.dst_fd, offset, length,
+                    self.sparse, progress_cb)
+
+    def copy(self, offset, length, progress_cb):
+        end = offset + length
+        pos = offset
+        while pos < end:
+            name, func = self.tiers[0]
+            if not func:
+                self._userspace_copy(pos, end - pos, progress_cb)
+                return
+
+            try:
+                ret = func(self.src_fd, self.dst_fd, pos,
+                           min(KERNEL_COPY_SIZE, end - pos))
+            except (OSError, IOError), e:
+                if not _is_unsupported(e):
+                    raise
+                logging.debug("%s copy not usable: %s" % (name, e))
+                self.tiers.pop(0)
+                continue
+
+            if ret == 0:
+                raise RuntimeError("Unexpected end of file at offset %d" %
+                                   pos)
+            pos += ret
+            progress_cb(pos)
+
+def _write_all(fd, buf):
+    while buf:
+        ret = os.write(fd, buf)
+        buf = buf[ret:]
+
+def _write_sparse(fd, buf):
+    """
+    Write buf at the current offset of fd, seeking over any aligned
+    zero blocks instead of writing them
+    """
+    size = len(buf)
+    if buf == _zeros[:size]:
+        os.lseek(fd, size, 1)
+        return
+
+    zeroblock = _zeros[:SPARSE_BLOCK_SIZE]
+    runstart = None
+    for off in range(0, size, SPARSE_BLOCK_SIZE):
+        if buf[off:off + SPARSE_BLOCK_SIZE] == zeroblock:
+            if runstart is not None:
+                _write_all(fd, buf[runstart:off])
+                runstart = None
+            os.lseek(fd, min(SPARSE_BLOCK_SIZE, size - off), 1)
+        elif runstart is None:
+            runstart = off
+    if runstart is not None:
+        _write_all(fd, buf[runstart:])
+
+def _write_zeros(fd, offset, length):
+    os.lseek(fd, offset, 0)
+    while length > 0:
+        count = min(length, COPY_BLOCK_SIZE)
+        _write_all(fd, _zeros[:count])
+        length -= count
+
+def _copy_range(src_fd, dst_fd, offset, length, sparse, progress_cb):
+    os.lseek(src_fd, offset, 0)
+    os.lseek(dst_fd, offset, 0)
+
+    end = offset + length
+    pos = offset
+    while pos < end:
+        buf = os.read(src_fd, min(COPY_BLOCK_SIZE, end - pos))
+        if not buf:
+            raise RuntimeError("Unexpected end of file at offset %d" % pos)
+
+        if sparse:
+            _write_sparse(dst_fd, buf)
+        else:
+            _write_all(dst_fd, buf)
+        pos += len(buf)
+        progress_cb(pos)
+
+def _prealloc_fallocate(fd, size):
+    if not _fallocate:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    _check_libc_ret(_fallocate(fd, 0, 0, size))
+
+def _prealloc_posix_fallocate(fd, size):
+    if not _posix_fallocate:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    # Returns the error number instead of setting errno
+    err = _posix_fallocate(fd, 0, size)
+    if err:
+        raise OSError(err, os.strerror(err))
+
+def _prealloc_zero(fd, size, progress_cb):
+    os.lseek(fd, 0, 0)
+    buf = "\0" * ZERO_WRITE_SIZE
+    pos = 0
+    while pos < size:
+        count = min(ZERO_WRITE_SIZE, size - pos)
+        if count < ZERO_WRITE_SIZE:
+            buf = buf[:count]
+        _write_all(fd, buf)
+        pos += count
+        progress_cb(pos)
+
+    # One flush at the end, instead of syncing every write
+    os.fsync(fd)
+
+def preallocate(fd, size, method=PREALLOC_AUTO, progress_cb=None):
+    """
+    Allocate size bytes of zeroed storage for regular file fd.
+
+    PREALLOC_FALLOCATE reserves the blocks in the filesystem without
+    writing them. PREALLOC_POSIX_FALLOCATE is the same, but glibc emulates
+    it by writing a byte into each block on filesystems without fallocate
+    support. PREALLOC_ZERO writes out zeros with large buffered writes
+    and a single final fsync. PREALLOC_AUTO uses fallocate, and falls back
+    to writing zeros if the filesystem doesn't support it: the glibc
+    emulation can't report progress.
+
+    @param progress_cb: Called with the bytes allocated so far
+    @returns: The method used
+    """
+    progress_cb = progress_cb or (lambda ignore: None)
+    if method not in prealloc_methods:
+        raise ValueError("Unknown preallocation method '%s'" % method)
+
+    if method in [PREALLOC_AUTO, PREALLOC_FALLOCATE]:
+        try:
+            _prealloc_fallocate(fd, size)
+            method = PREALLOC_FALLOCATE
+        except OSError, e:
+            if method != PREALLOC_AUTO or not _is_unsupported(e):
+                raise
+            logging.debug("fallocate not usable: %s" % e)
+            method = PREALLOC_ZERO
+    elif method == PREALLOC_POSIX_FALLOCATE:
+        _prealloc_posix_fallocate(fd, size)
+
+    if method == PREALLOC_ZERO:
+        _prealloc_zero(fd, size, progress_cb)
+
+    progress_cb(size)
+    logging.debug("Preallocated %d bytes using %s" % (size, method))
+    return method
+
+def _try_reflink(src_fd, dst_fd, size, progress_cb):
+    """
+    Reflink src_fd to dst_fd if both are regular files, and return True
+    if that worked
+    """
+    if not (is_regular_fd(src_fd) and is_regular_fd(dst_fd)):
+        return False
+    try:
+        reflink(src_fd, dst_fd)
+    except (OSError, IOError), e:
+        logging.debug("reflink copy not usable: %s" % e)
+        return False
+    logging.debug("Copied %d bytes using reflink" % size)
+    progress_cb(size)
+    return True
+
+def copy_data(src_fd, dst_fd, size, sparse=True, progress_cb=None):
+    """
+    Copy size bytes from src_fd to dst_fd, only reading the regions of the
+    source that hold data.
+
+    Copies between regular files are done with a reflink if the
+    filesystem supports it, which keeps the source's allocation. Otherwise,
+    if sparse, holes in the source are left as holes in the destination,
+    which must be a fresh regular file, and if not holes are written out
+    as zeros. Data is moved in kernel with
+    copy_file_range or sendfile where possible, see _RangeCopier. Sparse
+    copies of sources without holes use the userspace copy, which leaves
+    zero blocks within data as holes.
+
+    @param progress_cb: Called with the logical offset copied up to, so
+                        holes count towards progress
+    @returns: Number of bytes read from the source
+    """
+    progress_cb = progress_cb or (lambda ignore: None)
+
+    if _try_reflink(src_fd, dst_fd, size, progress_cb):
+        return 0
+
+    extents, method = data_extents(src_fd, size)
+    data_bytes = sum([l for ignore, l in extents])
+    logging.debug("Copying %d bytes, %d in %d data extents (found by %s)" %
+                  (size, data_bytes, len(extents), method))
+
+    copier = _RangeCopier(src_fd, dst_fd, sparse,
+                          use_kernel=_use_kernel_copy(sparse, extents,
+                                                      size, method))
+
+    pos = 0
+    for offset, length in extents + [(size, 0)]:
+        if offset > pos and not sparse:
+            _write_zeros(dst_fd, pos, offset - pos)
+        if offset > pos:
+            progress_cb(offset)
+
+        if length:
+            copier.copy(offset, length, progress_cb)
+        pos = offset + length
+
+    if (sparse and is_regular_fd(dst_fd) and
+        os.fstat(dst_fd).st_size < size):
+        # Make sure trailing holes are accounted for
+        os.ftruncate(dst_fd, size)
+
+    logging.debug("Copied %d bytes using %s" % (size, copier.tier()))
+    return data_bytes
+
+def copy_file(src, dst, sparse=True):
+    """
+    Copy file src to dst (created or truncated) with copy_data, keeping
+    the permission bits like shutil.copy
+    """
+    src_fd = None
+    dst_fd = None
+    try:
+        src_fd = os.open(src, os.O_RDONLY)
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        copy_data(src_fd, dst_fd, fd_size(src_fd), sparse=sparse)
+    finally:
+        if src_fd is not None:
+            os.close(src_fd)
+        if dst_fd is not None:
+            os.close(dst_fd)
+    os.chmod(dst, stat.S_IMODE(os.stat(src).st_mode))
+
+def _split_ranges(extents, size, range_size):
+    """
+    Split the data extents and the holes between them into
+    (offset, length, is_data) jobs of at most range_size bytes
+    """
+    jobs = []
+    def add(offset, length, is_data):
+        end = offset + length
+        while offset < end:
+            count = min(range_size, end - offset)
+            jobs.append((offset, count, is_data))
+            offset += count
+
+    pos = 0
+    for offset, length in extents + [(size, 0)]:
+        if offset > pos:
+            add(pos, offset - pos, False)
+        add(offset, length, True)
+        pos = offset + length
+    return jobs
+
+class _CopyAborted(Exception):
+    pass
+
+def copy_file_parallel(src, dst, size, workers, sparse=True,
+                       progress_cb=None, range_size=PARALLEL_RANGE_SIZE):
+    """
+    Like copy_data, but split the source into byte ranges of range_size
+    and copy them with a pool of worker threads, to keep several I/Os in
+    flight. Python 2 has no pread/pwrite, so each worker opens its own
+    fds for the src and dst paths to get independent file offsets. Once
+    done, the bytes accounted for by the workers are checked against size.
+
+    @param size: Bytes to copy, None for the size of src
+    @param progress_cb: Called with the logical bytes copied so far
+    @returns: Number of bytes read from the source
+    """
+    progress_cb = progress_cb or (lambda ignore: None)
+
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        if size is None:
+            size = fd_size(src_fd)
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT)
+        try:
+            if workers <= 1:
+                return copy_data(src_fd, dst_fd, size, sparse=sparse,
+                                 progress_cb=progress_cb)
+
+            # A reflink makes splitting up the work pointless
+            if _try_reflink(src_fd, dst_fd, size, progress_cb):
+                return 0
+
+            extents, method = data_extents(src_fd, size)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+    data_bytes = sum([l for ignore, l in extents])
+    use_kernel = _use_kernel_copy(sparse, extents, size, method)
+    jobs = _split_ranges(extents, size, range_size)
+    workers = min(workers, len(jobs)) or 1
+    logging.debug("Copying %d bytes, %d in %d data extents (found by %s) "
+                  "as %d ranges with %d workers" %
+                  (size, data_bytes, len(extents), method, len(jobs),
+                   workers))
+
+    todo = Queue.Queue()
+    for job in jobs:
+        todo.put(job)
+
+    state = {"done": 0, "error": None, "tiers": []}
+    lock = threading.Lock()
+
+    def add_progress(count):
+        lock.acquire()
+        try:
+            if state["error"]:
+                raise _CopyAborted()
+            state["done"] += count
+            progress_cb(state["done"])
+        finally:
+            lock.release()
+
+    def worker():
+        wsrc = None
+        wdst = None
+        try:
+            try:
+                wsrc = os.open(src, os.O_RDONLY)
+                wdst = os.open(dst, os.O_WRONLY)
+                copier = _RangeCopier(wsrc, wdst, sparse,
+                                      use_kernel=use_kernel)
+
+                while not state["error"]:
+                    try:
+                        offset, length, is_data = todo.get_nowait()
+                    except Queue.Empty:
+                        break
+
+                    if not is_data:
+                        if not sparse:
+                            _write_zeros(wdst, offset, length)
+                        add_progress(length)
+                        continue
+
+                    last = [offset]
+                    def job_progress(pos):
+                        add_progress(pos - last[0])
+                        last[0] = pos
+                    copier.copy(offset, length, job_progress)
+
+                state["tiers"].append(copier.tier())
+            except _CopyAborted:
+                pass
+            except:
+                lock.acquire()
+                try:
+                    if not state["error"]:
+                        state["error"] = sys.exc_info()
+                finally:
+                    lock.release()
+        finally:
+            if wsrc is not None:
+                os.close(wsrc)
+            if wdst is not None:
+                os.close(wdst)
+
+    threads = []
+    for ignore in range(workers):
+        t = threading.Thread(target=worker, name="Copying range")
+        t.setDaemon(True)
+        threads.append(t)
+        t.start()
+    for t in threads:
+        while t.isAlive():
+            t.join(1)
+
+    if state["error"]:
+        err = state["error"]
+        raise err[0], err[1], err[2]
+
+    if state["done"] != size:
+        raise RuntimeError("Copied %d bytes, expected %d" %
+                           (state["done"], size))
+
+    dst_fd = os.open(dst, os.O_WRONLY)
+    try:
+        if (sparse and is_regular_fd(dst_fd) and
+            os.fstat(dst_fd).st_size < size):
+            os.ftruncate(dst_fd, size)
+        if is_regular_fd(dst_fd) and os.fstat(dst_fd).st_size < size:
+            raise RuntimeError("Copy destination is smaller than %d bytes" %
+                               size)
+    finally:
+        os.close(dst_fd)
+
+    logging.debug("Copied %d bytes using %s" %
+                  (size, ", ".join(sorted(set(state["tiers"])))))
+    return data_bytes
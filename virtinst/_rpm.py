@@ -0,0 +1,161 @@
+#
+# Helpers for reading RPM package payloads
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+#
+# Internal utility functions. These do NOT form part of the API and must
+# not be used by clients.
+#
+
+import zlib
+import struct
+import logging
+import subprocess
+
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+
+import _cpio
+
+_lead_size = 96
+_lead_magic = "\xed\xab\xee\xdb"
+_header_magic = "\x8e\xad\xe8\x01"
+
+RPMTAG_PAYLOADFORMAT = 1124
+RPMTAG_PAYLOADCOMPRESSOR = 1125
+_type_string = 6
+
+_read_size = 65536
+
+class RPMError(Exception):
+    pass
+
+def _read_exact(f, size):
+    buf = f.read(size)
+    if len(buf) != size:
+        raise RPMError("Truncated RPM header")
+    return buf
+
+def _read_header(f, pad):
+    """
+    Read an RPM header structure from f, returning a dict of its string
+    tags
+    """
+    magic, nindex, hsize = struct.unpack(">4s4xII", _read_exact(f, 16))
+    if magic != _header_magic:
+        raise RPMError("Bad RPM header magic")
+
+    index = _read_exact(f, 16 * nindex)
+    store = _read_exact(f, hsize)
+    if pad:
+        _read_exact(f, (8 - hsize % 8) % 8)
+
+    tags = {}
+    for i in range(nindex):
+        tag, typ, offset, ignore = struct.unpack(">IIII",
+                                                 index[16 * i:16 * i + 16])
+        if typ == _type_string:
+            tags[tag] = store[offset:store.index("\0", offset)]
+    return tags
+
+class RPMPayload(object):
+    """
+    File-like object reading the uncompressed cpio payload of a package.
+    gzip and bzip2 payloads are decompressed in process, anything else
+    (xz, lzma) is read through rpm2cpio.
+    """
+    def __init__(self, path):
+        self._proc = None
+        self._f = open(path, "rb")
+        try:
+            if _read_exact(self._f, _lead_size)[:4] != _lead_magic:
+                raise RPMError("%s is not an RPM package" % path)
+            _read_header(self._f, True)
+            tags = _read_header(self._f, False)
+        except:
+            self._f.close()
+            raise
+
+        fmt = tags.get(RPMTAG_PAYLOADFORMAT, "cpio")
+        self.compressor = tags.get(RPMTAG_PAYLOADCOMPRESSOR, "gzip")
+        if fmt != "cpio":
+            self._f.close()
+            raise RPMError("Unsupported payload format '%s' in %s" %
+                           (fmt, path))
+
+        if self.compressor == "gzip":
+            self._decompress = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.compressor == "bzip2" and bz2:
+            self._decompress = bz2.BZ2Decompressor()
+        else:
+            self._f.close()
+            self._start_rpm2cpio(path)
+
+        # Data read ahead, and the offset of the unconsumed part of it
+        self._buf = ""
+        self._pos = 0
+
+    def _start_rpm2cpio(self, path):
+        logging.debug("Using rpm2cpio for '%s' compressed payload of %s" %
+                      (self.compressor, path))
+        try:
+            self._proc = subprocess.Popen(["rpm2cpio", path],
+                                          stdout=subprocess.PIPE,
+                                          close_fds=True)
+        except OSError, e:
+            raise RPMError("Unsupported payload compression '%s' in %s, "
+                           "and rpm2cpio failed: %s" %
+                           (self.compressor, path, e))
+        self._f = self._proc.stdout
+        self._decompress = None
+
+    def read(self, size):
+        avail = len(self._buf) - self._pos
+        if avail < size:
+            # Only the unconsumed tail is copied, once per refill
+            chunks = [self._buf[self._pos:]]
+            while avail < size:
+                data = self._f.read(_read_size)
+                if not data:
+                    break
+                if self._decompress:
+                    data = self._decompress.decompress(data)
+                chunks.append(data)
+                avail += len(data)
+            self._buf = "".join(chunks)
+            self._pos = 0
+
+        ret = self._buf[self._pos:self._pos + size]
+        self._pos += len(ret)
+        return ret
+
+    def close(self):
+        self._f.close()
+        if self._proc:
+            # rpm2cpio gets EPIPE if we stopped reading early
+            ret = self._proc.wait()
+            if ret:
+                logging.debug("rpm2cpio exited with status %d" % ret)
+            self._proc = None
+
+    def entries(self):
+        """
+        Iterate over the payload's cpio members, see _cpio.CpioReader
+        """
+        return iter(_cpio.CpioReader(self))
@@ -31,6 +31,7 @@ import logging
 import traceback
 import platform
 import subprocess
+import threading
 
 import libxml2
 import libvirt
@@ -43,6 +44,15 @@ try:
 except ImportError:
     selinux = None
 
+# sha1([data]) returns a new SHA-1 hash object, for cache keys and
+# checksums. hashlib is only in python >= 2.5
+try:
+    import hashlib
+    sha1 = hashlib.sha1
+except ImportError:
+    import sha
+    sha1 = sha.new
+
 def listify(l):
     if l is None:
         return []
@@ -131,6 +141,27 @@ def libvirt_collision(collision_cb, val):
             pass
     return check
 
+def _conn_cache_attr(name):
+    return "_virtinst__" + name
+
+def get_conn_cache(conn, name, create_cb=None):
+    """
+    Return the per connection object stored on conn under name, so it
+    lives as long as the connection. If there is none yet, create_cb(conn)
+    makes one if passed, otherwise None is returned.
+    """
+    val = getattr(conn, _conn_cache_attr(name), None)
+    if val is None and create_cb:
+        val = create_cb(conn)
+        set_conn_cache(conn, name, val)
+    return val
+
+def set_conn_cache(conn, name, val):
+    """
+    Store val as the per connection object name of conn
+    """
+    setattr(conn, _conn_cache_attr(name), val)
+
 def validate_uuid(val):
     if type(val) is not str:
         raise ValueError(_("UUID must be a string."))
@@ -186,6 +217,24 @@ def xml_append(orig, new):
         orig += "\n"
     return orig + new
 
+class XMLBuffer(object):
+    """
+    Collects XML fragments and joins them once at the end, rather than
+    copying the whole string on every xml_append. Fragments are handled
+    like xml_append: empty ones are skipped, the rest separated by
+    newlines.
+    """
+    def __init__(self, xml=""):
+        self._parts = []
+        self.append(xml)
+
+    def append(self, new):
+        if new:
+            self._parts.append(new)
+
+    def getvalue(self):
+        return "\n".join(self._parts)
+
 def fetch_all_guests(conn):
     """
     Return 2 lists: ([all_running_vms], [all_nonrunning_vms])
@@ -261,6 +310,115 @@ def set_xml_path(xml, path, newval):
     return result
 
 
+class _XMLDocCache(object):
+    """
+    Bounded LRU cache of parsed libxml2 documents and their xpath contexts,
+    keyed by a digest of the XML string. Callers commonly run several
+    xpath queries against the same XMLDesc output, this saves reparsing
+    it for each one.
+
+    Cached documents are shared, so nothing handed a cached context may
+    modify the document.
+    """
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+
+        # digest -> (doc, ctx), and digests in least -> most recent order
+        self._docs = {}
+        self._lru = []
+        self._lock = threading.RLock()
+
+        self.parses = 0
+        self.hits = 0
+        self.evictions = 0
+
+    def _free(self, key):
+        doc, ctx = self._docs.pop(key)
+        ctx.xpathFreeContext()
+        doc.freeDoc()
+
+    def _lookup(self, xml):
+        key = sha1(xml).digest()
+        if key in self._docs:
+            self.hits += 1
+            self._lru.remove(key)
+            self._lru.append(key)
+            return self._docs[key][1]
+
+        doc = libxml2.parseDoc(xml)
+        ctx = doc.xpathNewContext()
+        self.parses += 1
+
+        self._docs[key] = (doc, ctx)
+        self._lru.append(key)
+        while len(self._lru) > self.maxsize:
+            self._free(self._lru.pop(0))
+            self.evictions += 1
+        return ctx
+
+    def eval_paths(self, xml, paths):
+        """
+        Return a list with the result of each xpath in paths. Node set
+        results are reduced to the content of the first node, like
+        get_xml_path does.
+        """
+        self._lock.acquire()
+        try:
+            ctx = self._lookup(xml)
+            return [_xpath_result(ctx, path) for path in paths]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            for key in self._lru:
+                self._free(key)
+            self._lru = []
+        finally:
+            self._lock.release()
+
+    def stats_string(self):
+        lookups = self.parses + self.hits
+        rate = lookups and (self.hits * 100.0 / lookups) or 0.0
+        return ("XML doc cache: %d lookups, %d parses, %d hits (%.1f%%), "
+                "%d evictions" % (lookups, self.parses, self.hits, rate,
+                                  self.evictions))
+
+_xml_doc_cache = _XMLDocCache()
+
+def _xpath_result(ctx, path):
+    result = None
+    ret = ctx.xpathEval(path)
+    if ret != None:
+        if type(ret) == list:
+            if len(ret) >= 1:
+                result = ret[0].content
+        else:
+            result = ret
+    return result
+
+def get_xml_paths(xml, paths):
+    """
+    Evaluate each xpath in the passed list against xml, parsing it at most
+    once. Returns a list of results in the same order, each like the
+    return value of get_xml_path(xml, path).
+    """
+    return _xml_doc_cache.eval_paths(xml, paths)
+
+def log_cache_stats():
+    """
+    Log hit rates for our internal caches, at the DEBUG level
+    """
+    import CapabilitiesParser
+    import VirtualDevice
+    import mediacache
+    logging.debug(_xml_doc_cache.stats_string())
+    logging.debug(CapabilitiesParser.stats_string())
+    logging.debug(VirtualDevice.stats_string())
+    if mediacache.get_default_cache():
+        logging.debug(mediacache.get_default_cache().stats_string())
+
 def generate_name(base, collision_cb, suffix="", lib_collision=True,
                   start_num=0, sep="-", force_num=False, collidelist=None):
     """
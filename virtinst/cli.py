@@ -21,6 +21,7 @@
 
 import os
 import sys
+import atexit
 import logging
 import logging.handlers
 import gettext
@@ -35,6 +36,7 @@ import libvirt
 
 import virtinst
 from virtinst import _util
+from virtinst import conncache
 from _util import log_exception
 from _util import listify
 from virtinst import _gettext as _
@@ -221,6 +223,9 @@ def setupLogging(appname, debug=False, do_quiet=False):
     # Log the app command string
     logging.debug("Launched with command line:\n%s" % " ".join(sys.argv))
 
+    # Dump internal cache statistics on the way out
+    atexit.register(_util.log_cache_stats)
+
 
 #######################################
 # Libvirt connection helpers          #
@@ -317,17 +322,36 @@ def _open_test_uri(uri):
 
     return conn
 
-def getConnection(uri):
+def getConnection(uri, prime_support=False, cache_ttl=None):
+    """
+    Open a libvirt connection for the CLI tools
+
+    @param prime_support: Fetch all version info and run all connection
+                          support checks up front, see
+                          support.prime_support_cache
+    @param cache_ttl: If set, use the on disk connection info cache with
+                      the passed TTL in seconds. Defaults to the value of
+                      the VIRTINST_CONN_CACHE environment variable, see
+                      conncache.py
+    """
     if (uri and not User.current().has_priv(User.PRIV_CREATE_DOMAIN, uri)):
         fail(_("Must be root to create Xen guests"))
 
     # Hack to facilitate virtinst unit testing
     if _is_virtinst_test_uri(uri):
-        return _open_test_uri(uri)
+        conn = _open_test_uri(uri)
+    else:
+        logging.debug("Requesting libvirt URI %s" % (uri or "default"))
+        conn = open_connection(uri)
+        logging.debug("Received libvirt URI %s" % conn.getURI())
 
-    logging.debug("Requesting libvirt URI %s" % (uri or "default"))
-    conn = open_connection(uri)
-    logging.debug("Received libvirt URI %s" % conn.getURI())
+    if cache_ttl is None:
+        cache_ttl = conncache.ttl_from_env()
+    if cache_ttl:
+        conncache.setup_conn(conn, uri, ttl=cache_ttl)
+
+    if prime_support:
+        virtinst.support.prime_support_cache(conn)
 
     return conn
 
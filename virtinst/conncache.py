@@ -0,0 +1,245 @@
+#
+# Persistent cache of per connection capabilities and version info
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+"""
+Opt-in on disk cache of everything the CLI tools ask a fresh connection
+for: capabilities XML, libvirt and hypervisor versions, support check
+results, getType and getMaxVcpus. Short lived virt-* runs against remote
+URIs can skip those round trips entirely.
+
+Entries are looked up by the requested URI and validated against the
+local and daemon libvirt versions, the identity of the host (its SMBIOS
+UUID where the driver reports sysinfo, and hostname), a TTL, and a
+checksum of the stored capabilities XML. Checking those takes a few
+cheap calls, instead of fetching the capabilities.
+"""
+
+import os
+import logging
+
+import libvirt
+
+import CapabilitiesParser
+import support
+import _diskcache
+import _util
+
+CACHE_DIR = os.path.expanduser("~/.cache/virtinst/conncache")
+DEFAULT_TTL = 24 * 60 * 60
+
+# Environment variable which enables the cache for the CLI tools. Value
+# is the TTL in seconds, or 'yes' for the default
+ENV_VAR = "VIRTINST_CONN_CACHE"
+
+_section = "conncache"
+_support_section = "support"
+
+def ttl_from_env():
+    """
+    Return the cache TTL requested in the environment, or None if the
+    cache isn't enabled
+    """
+    return _diskcache.ttl_from_env(ENV_VAR, DEFAULT_TTL)
+
+def _host_id(conn):
+    """
+    Return a string identifying the host behind conn, without fetching
+    the capabilities
+    """
+    uuid = ""
+    try:
+        uuid = _util.get_xml_path(conn.getSysinfo(0),
+                    "/sysinfo/system/entry[@name='uuid']") or ""
+    except (AttributeError, libvirt.libvirtError):
+        # Old libvirt, or the driver doesn't report sysinfo
+        pass
+
+    hostname = ""
+    try:
+        hostname = conn.getHostname()
+    except (AttributeError, libvirt.libvirtError):
+        pass
+    return "%s %s" % (uuid, hostname)
+
+def _support_key_to_str(key):
+    feature, datakey, rhel6 = key
+    return "%d/%s/%d" % (feature, datakey or "", int(bool(rhel6)))
+
+def _support_key_from_str(keystr):
+    feature, datakey, rhel6 = keystr.split("/", 2)
+    return (int(feature), datakey or None, bool(int(rhel6)))
+
+class ConnCache(object):
+    """
+    Cache entry for a single connection
+    """
+    def __init__(self, conn, requri, cachedir=None, ttl=DEFAULT_TTL):
+        """
+        @param conn: virConnect the entry is for
+        @param requri: URI string the user requested, this can differ
+                       from conn.getURI (ex. default connection)
+        @param cachedir: Directory to store entries in
+        @param ttl: Max age of a valid entry, in seconds
+        """
+        self.conn = conn
+        self.requri = requri or ""
+        self.ttl = ttl
+
+        cachedir = cachedir or CACHE_DIR
+        basename = _util.sha1(self.requri + "\n" +
+                              conn.getURI()).hexdigest()
+        self.conf_path = os.path.join(cachedir, basename + ".conf")
+        self.caps_path = os.path.join(cachedir, basename + ".caps.xml")
+
+    def _read_caps(self):
+        f = open(self.caps_path, "r")
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def _check_entry(self, conf):
+        """
+        Return (capabilities XML, None) if conf describes a valid entry
+        for our connection, (None, reason string) otherwise
+        """
+        def get(key):
+            return conf.get(_section, key)
+
+        if not _diskcache.check_age(conf, _section, self.ttl):
+            return None, "expired"
+        if get("uri") != self.requri or get("conn_uri") != self.conn.getURI():
+            return None, "URI mismatch"
+
+        if str(libvirt.getVersion()) != get("local_lib_ver"):
+            return None, "local libvirt version changed"
+        daemon_ver = support._fetch_daemon_lib_ver(self.conn, get("conn_uri"))
+        if str(daemon_ver) != get("daemon_lib_ver"):
+            return None, "daemon version changed"
+
+        if _host_id(self.conn) != get("host_id"):
+            return None, "different host"
+
+        capsxml = self._read_caps()
+        if _util.sha1(capsxml).hexdigest() != get("caps_sha1"):
+            return None, "capabilities checksum mismatch"
+
+        return capsxml, None
+
+    def load(self):
+        """
+        Seed the connection's capabilities and support caches from disk.
+        Returns True on success, False if there was no valid entry.
+        """
+        if not os.path.exists(self.conf_path):
+            return False
+
+        try:
+            conf = _diskcache.read_config(self.conf_path)
+            capsxml, reason = self._check_entry(conf)
+            if capsxml is None:
+                logging.debug("Ignoring connection cache %s: %s" %
+                              (self.conf_path, reason))
+                return False
+
+            vals = {}
+            for key, val in conf.items(_section):
+                if key.startswith("val_"):
+                    vals[key[4:]] = _eval_value(val)
+            results = {}
+            for key, val in conf.items(_support_section):
+                results[_support_key_from_str(key)] = bool(int(val))
+
+            caps = CapabilitiesParser.parse(capsxml)
+        except Exception, e:
+            logging.debug("Error reading connection cache %s: %s" %
+                          (self.conf_path, e))
+            return False
+
+        CapabilitiesParser.set_conn_caps(self.conn, caps)
+        support._get_support_cache(self.conn).seed(vals, results)
+        logging.debug("Loaded connection info from cache %s" %
+                      self.conf_path)
+        return True
+
+    def save(self):
+        """
+        Fetch everything we cache from the connection, and write it out
+        """
+        capsxml = self.conn.getCapabilities()
+        CapabilitiesParser.set_conn_caps(self.conn,
+                                         CapabilitiesParser.parse(capsxml))
+
+        cache = support._get_support_cache(self.conn)
+        cache.prime()
+        cache.conn_type()
+        cache.max_vcpus(cache.conn_type().lower())
+        vals, results = cache.export()
+
+        conf = _diskcache.new_config()
+        conf.add_section(_section)
+        conf.add_section(_support_section)
+        _diskcache.set_timestamp(conf, _section)
+        conf.set(_section, "uri", self.requri)
+        conf.set(_section, "conn_uri", self.conn.getURI())
+        conf.set(_section, "local_lib_ver", str(libvirt.getVersion()))
+        conf.set(_section, "daemon_lib_ver",
+                 str(support._fetch_daemon_lib_ver(self.conn,
+                                                   self.conn.getURI())))
+        conf.set(_section, "host_id", _host_id(self.conn))
+        conf.set(_section, "caps_sha1", _util.sha1(capsxml).hexdigest())
+        for key, val in vals.items():
+            conf.set(_section, "val_" + key, repr(val))
+        for key, val in results.items():
+            conf.set(_support_section, _support_key_to_str(key),
+                     str(int(bool(val))))
+
+        # The conf file goes last: until it is replaced, the old one
+        # fails the caps checksum
+        _diskcache.write_file(self.caps_path, capsxml)
+        _diskcache.write_config(self.conf_path, conf)
+
+def _eval_value(val):
+    """
+    Convert a repr()d cache value (int, long, str or None) back
+    """
+    if val == "None":
+        return None
+    if val[:1] in ["'", '"']:
+        return val[1:-1].decode("string_escape")
+    if val.endswith("L"):
+        return long(val[:-1])
+    return int(val)
+
+def setup_conn(conn, requri, cachedir=None, ttl=DEFAULT_TTL):
+    """
+    Load cached info for conn, or populate the cache if there is no valid
+    entry. Errors writing the cache are logged and ignored.
+
+    @returns: True if cached info was used
+    """
+    entry = ConnCache(conn, requri, cachedir=cachedir, ttl=ttl)
+    if entry.load():
+        return True
+
+    try:
+        entry.save()
+    except Exception, e:
+        logging.debug("Error writing connection cache %s: %s" %
+                      (entry.conf_path, e))
+    return False
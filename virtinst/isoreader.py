@@ -0,0 +1,402 @@
+#
+# Read-only access to files in ISO9660 images, without mounting them
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+"""
+Minimal ISO9660 reader, enough to pull kernels and initrds out of install
+ISOs: directory lookup by path and streaming reads of file contents.
+
+Names are taken from Rock Ridge NM entries if the image has them, from
+the Joliet supplementary volume otherwise, and from plain ISO9660
+identifiers (minus the ';1' version suffix) as a last resort. Lookups
+fall back to case insensitive matching, like mount's map=normal.
+Relocated deep directories (CL/RE) and multi-extent files are supported,
+symlinks are not followed. Images this can't read (UDF only, or not an
+ISO at all) raise ISOError, and callers should fall back to mounting.
+"""
+
+import os
+import struct
+import threading
+
+SECTOR_SIZE = 2048
+
+# Volume descriptors start at this sector
+_vd_start = 16
+_vd_primary = 1
+_vd_supplementary = 2
+_vd_terminator = 255
+_vd_max = 64
+
+_joliet_escapes = ["%/@", "%/C", "%/E"]
+
+# Directory record flags
+_flag_dir = 0x02
+_flag_multi_extent = 0x80
+
+# Rock Ridge NM flags
+_nm_continue = 0x01
+_nm_current = 0x02
+_nm_parent = 0x04
+
+class ISOError(Exception):
+    pass
+
+class _ISOEntry(object):
+    """
+    A file or directory in the image
+    """
+    def __init__(self, name, is_dir):
+        self.name = name
+        self.is_dir = is_dir
+        # List of (lba, length) data extents
+        self.extents = []
+
+    def _get_size(self):
+        return sum([length for ignore, length in self.extents])
+    size = property(_get_size)
+
+class ISOFile(object):
+    """
+    File-like object reading the contents of an _ISOEntry
+    """
+    def __init__(self, path, entry, block_size):
+        self.entry = entry
+        self.block_size = block_size
+        self._fd = os.open(path, os.O_RDONLY)
+        self._extent = 0
+        self._offset = 0
+
+    def read(self, size=-1):
+        ret = []
+        while size != 0 and self._extent < len(self.entry.extents):
+            lba, length = self.entry.extents[self._extent]
+            left = length - self._offset
+            if left <= 0:
+                self._extent += 1
+                self._offset = 0
+                continue
+
+            want = left
+            if size > 0:
+                want = min(want, size)
+            os.lseek(self._fd, lba * self.block_size + self._offset, 0)
+            buf = os.read(self._fd, want)
+            if not buf:
+                raise ISOError("Unexpected end of image reading %s" %
+                               self.entry.name)
+
+            ret.append(buf)
+            self._offset += len(buf)
+            if size > 0:
+                size -= len(buf)
+        return "".join(ret)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+def _susp_entries(data):
+    """
+    Yield (signature, entry data) for the SUSP entries in data
+    """
+    idx = 0
+    while idx + 4 <= len(data):
+        sig = data[idx:idx + 2]
+        length = ord(data[idx + 2])
+        if length < 4 or idx + length > len(data):
+            break
+        yield sig, data[idx:idx + length]
+        idx += length
+
+class ISOImage(object):
+    """
+    An ISO9660 image file opened for reading. Safe to use from several
+    threads.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.block_size = SECTOR_SIZE
+        self.rock_ridge = False
+        self.joliet = False
+
+        # Offset of SUSP entries in system use areas (SP LEN_SKP)
+        self._susp_skip = 0
+        # Cache of directory lba -> {name: _ISOEntry}
+        self._dirs = {}
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDONLY)
+        try:
+            self._root = self._read_volume_descriptors()
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _read(self, offset, length):
+        self._lock.acquire()
+        try:
+            os.lseek(self._fd, offset, 0)
+            buf = os.read(self._fd, length)
+        finally:
+            self._lock.release()
+        if len(buf) != length:
+            raise ISOError("Unexpected end of image at offset %d" % offset)
+        return buf
+
+    def _read_volume_descriptors(self):
+        primary = None
+        joliet = None
+
+        for sector in range(_vd_start, _vd_start + _vd_max):
+            try:
+                vd = self._read(sector * SECTOR_SIZE, SECTOR_SIZE)
+            except ISOError:
+                break
+            if vd[1:6] != "CD001":
+                break
+
+            vdtype = ord(vd[0])
+            if vdtype == _vd_terminator:
+                break
+            if vdtype == _vd_primary and not primary:
+                primary = vd
+            elif vdtype == _vd_supplementary and not joliet:
+                escapes = vd[88:120]
+                for esc in _joliet_escapes:
+                    if esc in escapes:
+                        joliet = vd
+                        break
+
+        if not primary:
+            raise ISOError("%s is not an ISO9660 image" % self.path)
+
+        self.block_size = struct.unpack("<H", primary[128:130])[0]
+        if not self.block_size:
+            raise ISOError("Invalid logical block size in %s" % self.path)
+
+        root = self._parse_record(primary[156:190], False)
+        if self._check_rock_ridge(root):
+            self.rock_ridge = True
+            return root
+
+        if joliet:
+            self.joliet = True
+            return self._parse_record(joliet[156:190], True)
+        return root
+
+    def _check_rock_ridge(self, root):
+        """
+        Look for the SUSP SP entry in the root directory's '.' record
+        """
+        lba = root.extents[0][0]
+        data = self._read(lba * self.block_size, self.block_size)
+        reclen = ord(data[0])
+        if not reclen:
+            return False
+
+        namelen = ord(data[32])
+        sysuse = 33 + namelen + ((namelen + 1) % 2)
+        for sig, entry in _susp_entries(data[sysuse:reclen]):
+            if sig == "SP" and entry[4:6] == "\xbe\xef":
+                self._susp_skip = ord(entry[6])
+                return True
+        return False
+
+    def _system_use(self, record, sysuse):
+        """
+        Return the SUSP entries of a directory record, following any CE
+        continuation areas
+        """
+        data = record[sysuse + self._susp_skip:]
+        ret = []
+        seen = 0
+        while data:
+            cont = None
+            for sig, entry in _susp_entries(data):
+                if sig == "CE":
+                    cont = struct.unpack("<I", entry[4:8])[0], \
+                           struct.unpack("<I", entry[12:16])[0], \
+                           struct.unpack("<I", entry[20:24])[0]
+                elif sig == "ST":
+                    break
+                else:
+                    ret.append((sig, entry))
+
+            data = None
+            # Guard against continuation loops in broken images
+            if cont and seen < 16:
+                seen += 1
+                lba, offset, length = cont
+                data = self._read(lba * self.block_size + offset, length)
+        return ret
+
+    def _parse_record(self, record, joliet):
+        return self._parse_record_full(record, joliet)[0]
+
+    def _parse_record_full(self, record, joliet):
+        """
+        Return (_ISOEntry, flags, Rock Ridge child link lba or None,
+        Rock Ridge relocated flag) for a directory record
+        """
+        lba, length = struct.unpack("<I4xI", record[2:14])
+        flags = ord(record[25])
+        namelen = ord(record[32])
+        rawname = record[33:33 + namelen]
+
+        if rawname == "\x00":
+            name = "."
+        elif rawname == "\x01":
+            name = ".."
+        elif joliet:
+            name = rawname.decode("utf-16-be").encode("utf-8")
+        else:
+            name = rawname
+
+        if not joliet and name not in [".", ".."]:
+            if ";" in name:
+                name = name[:name.rindex(";")]
+            if name.endswith(".") and not flags & _flag_dir:
+                name = name[:-1]
+
+        child = None
+        relocated = False
+        if self.rock_ridge and not joliet:
+            sysuse = 33 + namelen + ((namelen + 1) % 2)
+            rrname = None
+            for sig, entry in self._system_use(record, sysuse):
+                if sig == "NM":
+                    nmflags = ord(entry[4])
+                    if nmflags & (_nm_current | _nm_parent):
+                        continue
+                    rrname = (rrname or "") + entry[5:]
+                elif sig == "CL":
+                    child = struct.unpack("<I", entry[4:8])[0]
+                elif sig == "RE":
+                    relocated = True
+            if rrname and name not in [".", ".."]:
+                name = rrname
+
+        entry = _ISOEntry(name, bool(flags & _flag_dir) or child is not None)
+        entry.extents.append((lba, length))
+        return entry, flags, child, relocated
+
+    def _read_dir(self, direntry):
+        """
+        Return a dict of name -> _ISOEntry for the passed directory
+        """
+        key = direntry.extents[0][0]
+        self._lock.acquire()
+        try:
+            if key in self._dirs:
+                return self._dirs[key]
+        finally:
+            self._lock.release()
+
+        lba, length = direntry.extents[0]
+        data = self._read(lba * self.block_size, length)
+        joliet = self.joliet
+
+        entries = {}
+        pending = None
+        idx = 0
+        while idx < len(data):
+            reclen = ord(data[idx])
+            if not reclen:
+                # Records don't cross sectors, skip the padding
+                idx = (idx / self.block_size + 1) * self.block_size
+                continue
+
+            record = data[idx:idx + reclen]
+            idx += reclen
+            entry, flags, child, relocated = self._parse_record_full(record,
+                                                                     joliet)
+            if entry.name in [".", ".."] or relocated:
+                continue
+            if child is not None:
+                # Relocated deep directory, the real one is at child
+                chdata = self._read(child * self.block_size, self.block_size)
+                entry.extents = [self._parse_record(
+                                    chdata[:ord(chdata[0])], joliet
+                                 ).extents[0]]
+
+            if pending:
+                pending.extents += entry.extents
+                entry = pending
+            pending = None
+            if flags & _flag_multi_extent:
+                pending = entry
+                continue
+            entries[entry.name] = entry
+
+        self._lock.acquire()
+        try:
+            self._dirs[key] = entries
+        finally:
+            self._lock.release()
+        return entries
+
+    def lookup(self, path):
+        """
+        Return the _ISOEntry for path, or None if it doesn't exist
+        """
+        entry = self._root
+        for part in path.split("/"):
+            if not part or part == ".":
+                continue
+            if not entry.is_dir:
+                return None
+
+            entries = self._read_dir(entry)
+            if part in entries:
+                entry = entries[part]
+                continue
+
+            lower = part.lower()
+            match = None
+            for name, child in entries.items():
+                if name.lower() == lower:
+                    match = child
+                    break
+            if not match:
+                return None
+            entry = match
+        return entry
+
+    def open(self, path):
+        """
+        Return an ISOFile for reading path
+        """
+        entry = self.lookup(path)
+        if not entry or entry.is_dir:
+            raise ISOError("No file %s in %s" % (path, self.path))
+        return ISOFile(self.path, entry, self.block_size)
+
+def is_iso(path):
+    """
+    Return True if path is an ISO9660 image we can read
+    """
+    try:
+        ISOImage(path).close()
+    except (ISOError, OSError):
+        return False
+    return True
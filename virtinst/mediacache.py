@@ -0,0 +1,315 @@
+#
+# Persistent cache of fetched install media
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+"""
+Opt-in cache of kernels, initrds and boot ISOs fetched by ImageFetcher,
+so repeated installs from the same tree don't download the same media
+every time.
+
+Entries are keyed by the file's URL plus a validator string from the
+source (ETag/Last-Modified/size for HTTP, MDTM/size for FTP, mtime/size
+for local and NFS paths): a changed file gets a new key. Files are handed
+out to the scratch dir as reflinks where the filesystem supports them,
+copies otherwise. Hard links aren't used, since libvirt relabels and
+chowns the kernel and initrd it boots, which would change the shared
+entry. The least recently used entries are evicted when the cache
+grows past its size cap. A lock file per entry makes concurrent
+processes share a single download, and keeps entries being handed out
+from being evicted.
+"""
+
+import os
+import errno
+import fcntl
+import logging
+import tempfile
+
+import _diskcache
+import _filecopy
+import _util
+
+CACHE_DIR = os.path.expanduser("~/.cache/virtinst/media")
+DEFAULT_MAX_SIZE = 2 * 1024 * 1024 * 1024
+
+# Environment variable which enables the cache. Value is the size cap in
+# MiB, or 'yes' for the default
+ENV_VAR = "VIRTINST_MEDIA_CACHE"
+# Environment variable overriding CACHE_DIR
+ENV_DIR_VAR = "VIRTINST_MEDIA_CACHE_DIR"
+
+_lock_suffix = ".lock"
+_tmp_prefix = "tmp-"
+
+class _FileLock(object):
+    """
+    Exclusive flock() on a lock file
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def acquire(self, blocking=True):
+        """
+        Lock the file, blocking until it's free. Returns False instead of
+        waiting if blocking is False and someone else holds it.
+        """
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                fcntl.flock(fd, flags)
+            except IOError, e:
+                os.close(fd)
+                if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    return False
+                raise
+
+            # Whoever held the lock before us may have removed the file,
+            # in which case lock the one at path now
+            try:
+                st = os.stat(self.path)
+                fst = os.fstat(fd)
+                if (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino):
+                    self.fd = fd
+                    return True
+            except OSError:
+                pass
+            os.close(fd)
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def remove(self):
+        """
+        Delete the lock file and release the lock, which must be held
+        """
+        try:
+            os.unlink(self.path)
+        finally:
+            self.release()
+
+class MediaCache(object):
+    """
+    A directory of cached media files
+    """
+    def __init__(self, cachedir=None, max_size=DEFAULT_MAX_SIZE):
+        """
+        @param cachedir: Directory to store entries in
+        @param max_size: Size cap in bytes, least recently used entries
+                         are evicted past this
+        """
+        self.cachedir = cachedir or CACHE_DIR
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _entry_path(self, url, validator):
+        key = _util.sha1(url + "\n" + validator).hexdigest()
+        return os.path.join(self.cachedir,
+                            key + "-" + os.path.basename(url.rstrip("/")))
+
+    def _list_entries(self):
+        """
+        Return a list of (mtime, size, path) for all cache entries
+        """
+        ret = []
+        for name in os.listdir(self.cachedir):
+            if name.endswith(_lock_suffix) or name.startswith(_tmp_prefix):
+                continue
+            path = os.path.join(self.cachedir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            ret.append((st.st_mtime, st.st_size, path))
+        return ret
+
+    def _remove_entry(self, path):
+        """
+        Delete the entry at path along with its lock file. Returns False
+        if the entry is in use by someone else and was left alone.
+        """
+        entrylock = _FileLock(path + _lock_suffix)
+        if not entrylock.acquire(blocking=False):
+            return False
+
+        try:
+            if os.path.exists(path):
+                logging.debug("Evicting media cache entry %s" % path)
+                os.unlink(path)
+        finally:
+            entrylock.remove()
+        return True
+
+    def _remove_stale_locks(self):
+        """
+        Remove lock files whose entry doesn't exist, left behind by
+        failed downloads
+        """
+        for name in os.listdir(self.cachedir):
+            if not name.endswith(_lock_suffix) or name == _lock_suffix:
+                continue
+            path = os.path.join(self.cachedir, name[:-len(_lock_suffix)])
+            if os.path.exists(path):
+                continue
+            try:
+                self._remove_entry(path)
+            except OSError, e:
+                logging.debug("Error removing lock for %s: %s" % (path, e))
+
+    def _evict(self, keep):
+        lock = _FileLock(os.path.join(self.cachedir, _lock_suffix))
+        lock.acquire()
+        try:
+            self._remove_stale_locks()
+
+            entries = self._list_entries()
+            entries.sort()
+            total = sum([size for ignore, size, ignore in entries])
+
+            for ignore, size, path in entries:
+                if total <= self.max_size:
+                    break
+                if path == keep:
+                    continue
+
+                # Entries locked by a lookup in progress are skipped
+                try:
+                    if not self._remove_entry(path):
+                        continue
+                except OSError, e:
+                    logging.debug("Error evicting %s: %s" % (path, e))
+                    continue
+                total -= size
+                self.evictions += 1
+        finally:
+            lock.release()
+
+    def _copy_to_scratch(self, entry, scratchdir, prefix):
+        """
+        Reflink or copy entry to a new file in scratchdir, and return its
+        path
+        """
+        if not os.path.exists(scratchdir):
+            os.makedirs(scratchdir, 0750)
+        (fd, fn) = tempfile.mkstemp(prefix="virtinst-" + prefix,
+                                    dir=scratchdir)
+        os.close(fd)
+
+        try:
+            _filecopy.copy_file(entry, fn)
+        except:
+            os.unlink(fn)
+            raise
+        return fn
+
+    def acquire(self, url, validator, fetch_cb, scratchdir, prefix):
+        """
+        Return a path in scratchdir holding the file url. If the cache has
+        no entry for (url, validator), fetch_cb(dirname) is called to
+        download it into a new file in dirname, and return its path.
+        """
+        _diskcache.make_cachedir(self.cachedir)
+
+        entry = self._entry_path(url, validator)
+        lock = _FileLock(entry + _lock_suffix)
+        lock.acquire()
+        try:
+            if os.path.exists(entry):
+                logging.debug("Using media cache entry %s for %s" %
+                              (entry, url))
+                self.hits += 1
+                # mtime is the LRU timestamp
+                os.utime(entry, None)
+            else:
+                self.misses += 1
+                tmpdir = tempfile.mkdtemp(prefix=_tmp_prefix,
+                                          dir=self.cachedir)
+                try:
+                    os.rename(fetch_cb(tmpdir), entry)
+                finally:
+                    for name in os.listdir(tmpdir):
+                        os.unlink(os.path.join(tmpdir, name))
+                    os.rmdir(tmpdir)
+                logging.debug("Added %s to media cache as %s" %
+                              (url, entry))
+                self._evict(entry)
+
+            return self._copy_to_scratch(entry, scratchdir, prefix)
+        finally:
+            lock.release()
+
+    def add(self, url, validator, path):
+        """
+        Move the local file path into the cache as the entry for
+        (url, validator), for files built alongside another acquire()
+        """
+        _diskcache.make_cachedir(self.cachedir)
+
+        entry = self._entry_path(url, validator)
+        lock = _FileLock(entry + _lock_suffix)
+        lock.acquire()
+        try:
+            if os.path.exists(entry):
+                os.unlink(path)
+                return
+            try:
+                os.rename(path, entry)
+            except OSError:
+                _filecopy.copy_file(path, entry)
+                os.unlink(path)
+            logging.debug("Added %s to media cache as %s" % (url, entry))
+            self._evict(entry)
+        finally:
+            lock.release()
+
+    def stats_string(self):
+        return ("media cache: %d hits, %d misses, %d evictions" %
+                (self.hits, self.misses, self.evictions))
+
+_default_cache = None
+
+def get_default_cache():
+    """
+    Return the MediaCache requested in the environment, or None if the
+    cache isn't enabled
+    """
+    global _default_cache
+
+    val = _diskcache.env_value(ENV_VAR)
+    if val is None:
+        return None
+    try:
+        max_size = int(val) * 1024 * 1024
+    except ValueError:
+        max_size = DEFAULT_MAX_SIZE
+    cachedir = os.environ.get(ENV_DIR_VAR) or CACHE_DIR
+
+    if (not _default_cache or
+        _default_cache.cachedir != cachedir or
+        _default_cache.max_size != max_size):
+        _default_cache = MediaCache(cachedir, max_size)
+    return _default_cache
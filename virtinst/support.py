@@ -19,6 +19,8 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA 02110-1301 USA.
 
+import weakref
+
 import libvirt
 import _util
 
@@ -68,6 +70,7 @@ SUPPORT_CONN_HV_FILESYSTEM = 5007
 
 # Flags for check_stream_support
 SUPPORT_STREAM_UPLOAD = 6000
+SUPPORT_STREAM_SPARSE_UPLOAD = 6001
 
 """
 Possible keys:
@@ -272,6 +275,13 @@ _support_dict = {
         # for URL installs, want to be sure it works
         "version" : 9004,
     },
+
+    SUPPORT_STREAM_SPARSE_UPLOAD : {
+        "version" : 3004000,
+        "force_version" : True,
+        "function" : "virStream.sendHole",
+        "flag" : "VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM",
+    },
 }
 
 # XXX: RHEL6 has lots of feature backports, and since libvirt doesn't
@@ -337,26 +347,33 @@ def _try_command(func, args, check_all_error=False):
 def _local_lib_ver():
     return libvirt.getVersion()
 
-# Version of libvirt library/daemon on the connection (could be remote)
-def _daemon_lib_ver(conn, uri, force_version, minimum_libvirt_version):
-    # Always force the required version if it's after the version which
-    # has getLibVersion
-    if force_version or minimum_libvirt_version >= 7004:
-        default_ret = 0
-    else:
-        default_ret = 100000000000
-
+# Version of libvirt library/daemon on the connection (could be remote),
+# None if the daemon can't tell us
+def _fetch_daemon_lib_ver(conn, uri):
     if not _util.is_uri_remote(uri):
         return _local_lib_ver()
 
     if not _has_command("getLibVersion", obj=conn):
-        return default_ret
+        return None
 
     if not _try_command(getattr(conn, "getLibVersion"), ()):
-        return default_ret
+        return None
 
     return conn.getLibVersion()
 
+def _daemon_lib_ver(cache, force_version, minimum_libvirt_version):
+    # Always force the required version if it's after the version which
+    # has getLibVersion
+    if force_version or minimum_libvirt_version >= 7004:
+        default_ret = 0
+    else:
+        default_ret = 100000000000
+
+    ret = cache.daemon_lib_ver()
+    if ret is None:
+        return default_ret
+    return ret
+
 # Return the hypervisor version
 def _hv_ver(conn, uri):
     drv_type = _util.get_uri_driver(uri)
@@ -382,6 +399,122 @@ def _hv_ver(conn, uri):
 
     return ret
 
+class _SupportCache(object):
+    """
+    Per connection memo of feature check results, and of the URI and
+    version numbers they are computed from. Everything is fetched lazily
+    on first use, unless prime() is called.
+    """
+    def __init__(self, conn):
+        self._conn = conn
+        self._vals = {}
+        self._results = {}
+        self._obj_results = weakref.WeakKeyDictionary()
+
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, key, cb):
+        if key not in self._vals:
+            self._vals[key] = cb()
+        return self._vals[key]
+
+    def uri(self):
+        return self._get("uri", self._conn.getURI)
+    def local_lib_ver(self):
+        return self._get("local_lib_ver", _local_lib_ver)
+    def daemon_lib_ver(self):
+        return self._get("daemon_lib_ver",
+                         lambda: _fetch_daemon_lib_ver(self._conn,
+                                                       self.uri()))
+    def hv_ver(self):
+        return self._get("hv_ver", lambda: _hv_ver(self._conn, self.uri()))
+    def conn_type(self):
+        return self._get("conn_type", self._conn.getType)
+    def max_vcpus(self, typ):
+        def _fetch():
+            try:
+                return self._conn.getMaxVcpus(typ)
+            except libvirt.libvirtError:
+                return 32
+        return self._get("max_vcpus_" + typ, _fetch)
+
+    def check(self, feature, data):
+        if type(data) is unicode:
+            data = data.encode("utf-8")
+
+        if data is self._conn:
+            results = self._results
+            key = (feature, None, _get_rhel6())
+        elif data is None or type(data) is str:
+            results = self._results
+            key = (feature, data, _get_rhel6())
+        else:
+            # Object checks (domains, pools, ...) probe the object itself,
+            # so results are kept per object, for as long as it lives
+            try:
+                results = self._obj_results.setdefault(data, {})
+            except TypeError:
+                self.misses += 1
+                return _check_support_uncached(self, feature, data)
+            key = (feature, _get_rhel6())
+
+        if key in results:
+            self.hits += 1
+            return results[key]
+
+        self.misses += 1
+        ret = _check_support_uncached(self, feature, data)
+        results[key] = ret
+        return ret
+
+    def invalidate(self):
+        self._vals = {}
+        self._results = {}
+        self._obj_results = weakref.WeakKeyDictionary()
+
+    def export(self):
+        """
+        Return (values, results) dicts of everything cached that is safe
+        to persist, see seed()
+        """
+        return (self._vals.copy(), self._results.copy())
+
+    def seed(self, vals, results):
+        """
+        Prefill the cache with values previously returned by export()
+        """
+        self._vals.update(vals)
+        self._results.update(results)
+
+    def prime(self):
+        """
+        Fetch all version info in one go, and run every check that only
+        needs the connection
+        """
+        self.uri()
+        self.local_lib_ver()
+        self.daemon_lib_ver()
+        self.hv_ver()
+
+        for feature in _support_dict:
+            if feature in _conn_features:
+                self.check(feature, self._conn)
+
+# Name of the support cache in _util.get_conn_cache
+_conn_cache_name = "support_cache"
+
+# Features checked with check_conn_support, usable by prime()
+_conn_features = [SUPPORT_CONN_STORAGE, SUPPORT_CONN_FINDPOOLSOURCES,
+                  SUPPORT_CONN_NODEDEV, SUPPORT_CONN_KEYMAP_AUTODETECT,
+                  SUPPORT_CONN_GETHOSTNAME, SUPPORT_CONN_DOMAIN_VIDEO,
+                  SUPPORT_CONN_NETWORK, SUPPORT_CONN_INTERFACE,
+                  SUPPORT_CONN_MAXVCPUS_XML, SUPPORT_CONN_STREAM,
+                  SUPPORT_STREAM_UPLOAD]
+
+def _get_support_cache(conn):
+    return _util.get_conn_cache(conn, _conn_cache_name, _SupportCache)
+
 def _split_function_name(function):
     if not function:
         return (None, None)
@@ -392,13 +525,12 @@ def _split_function_name(function):
     else:
         return (output[0], output[1])
 
-def _check_support(conn, feature, data=None):
+def _check_support_uncached(cache, feature, data):
     """
     Attempt to determine if a specific libvirt feature is support given
     the passed connection.
 
-    @param conn: Libvirt connection to check feature on
-    @type  conn: virConnect
+    @param cache: _SupportCache of the libvirt connection to check on
     @param feature: Feature type to check support for
     @type  feature: One of the SUPPORT_* flags
     @param data: Option libvirt object to use in feature checking
@@ -410,15 +542,12 @@ def _check_support(conn, feature, data=None):
     support_info = _support_dict[feature]
     key_list = support_info.keys()
 
-    if not isinstance(conn, libvirt.virConnect):
-        raise ValueError(_("'conn' must be a virConnect instance."))
-
     def get_value(key):
         if key in key_list:
             key_list.remove(key)
         return support_info.get(key)
 
-    uri = conn.getURI()
+    uri = cache.uri()
     drv_type = _util.get_uri_driver(uri)
     is_rhel6 = _get_rhel6()
     force_version = get_value("force_version") or False
@@ -440,10 +569,10 @@ def _check_support(conn, feature, data=None):
     args = get_value("args")
     flag = get_value("flag")
 
-    actual_lib_ver = _local_lib_ver()
-    actual_daemon_ver = _daemon_lib_ver(conn, uri, force_version,
+    actual_lib_ver = cache.local_lib_ver()
+    actual_daemon_ver = _daemon_lib_ver(cache, force_version,
                                         minimum_libvirt_version)
-    actual_drv_ver = _hv_ver(conn, uri)
+    actual_drv_ver = cache.hv_ver()
 
     # Make sure there are no keys left in the key_list. This will
     # ensure we didn't mistype anything above, or in the support_dict
@@ -549,6 +678,11 @@ def _check_support(conn, feature, data=None):
 
     return True
 
+def _check_support(conn, feature, data=None):
+    if not isinstance(conn, libvirt.virConnect):
+        raise ValueError(_("'conn' must be a virConnect instance."))
+    return _get_support_cache(conn).check(feature, data)
+
 # Public API below
 
 def is_error_nosupport(err):
@@ -573,6 +707,22 @@ def support_threading():
 def support_openauth():
     return bool(_local_lib_ver() >= 4000)
 
+def invalidate_support_cache(conn):
+    """
+    Forget all cached support results and version info for the passed
+    connection, for example after the daemon was upgraded
+    """
+    cache = _util.get_conn_cache(conn, _conn_cache_name)
+    if cache is not None:
+        cache.invalidate()
+
+def prime_support_cache(conn):
+    """
+    Fetch all version info for the passed connection up front and run
+    every connection level support check, so later checks are free
+    """
+    _get_support_cache(conn).prime()
+
 def check_conn_support(conn, feature):
     return _check_support(conn, feature, conn)
 
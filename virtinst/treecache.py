@@ -0,0 +1,210 @@
+#
+# Persistent cache of install tree detection results
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+"""
+Opt-in on disk cache of which Distro class matched an install tree, and
+the state detection left it in (os_type/os_variant, kernel and initrd
+paths, parsed .treeinfo), so installing from a known tree skips all the
+distro probes.
+
+Entries are keyed by the normalized location URI, arch, guest type and
+distro hint. They are checked for freshness against a validator (see
+ImageFetcher._cacheValidator) of the tree's .treeinfo, or of its kernel
+if it has none: trees where neither can be validated aren't cached.
+"""
+
+import os
+import re
+import logging
+import ConfigParser
+import StringIO
+
+import _diskcache
+import _util
+
+try:
+    from ast import literal_eval as _literal_eval
+except ImportError:
+    # python < 2.6, we can't safely restore values
+    _literal_eval = None
+
+CACHE_DIR = os.path.expanduser("~/.cache/virtinst/trees")
+DEFAULT_TTL = 7 * 24 * 60 * 60
+
+# Environment variable which enables the cache. Value is the TTL in
+# seconds, or 'yes' for the default
+ENV_VAR = "VIRTINST_TREE_CACHE"
+
+_section = "treecache"
+_attr_section = "attrs"
+
+# Store attributes set by detection that we save. Anything else comes
+# from the Distro constructor, or is cached separately (treeinfo)
+_cached_attrs = ["os_type", "os_variant", "uses_treeinfo",
+                 "_kernel_paths", "_valid_kernel_path", "_valid_iso_path",
+                 "_prefix", "_boot_iso_paths", "_hvm_kernel_paths",
+                 "_xen_kernel_paths"]
+
+def ttl_from_env():
+    """
+    Return the cache TTL requested in the environment, or None if the
+    cache isn't enabled
+    """
+    if not _literal_eval:
+        return None
+    return _diskcache.ttl_from_env(ENV_VAR, DEFAULT_TTL)
+
+def normalize_uri(uri):
+    """
+    Return a canonical form of an install location, so trivially
+    different spellings share an entry
+    """
+    uri = uri.strip()
+    if uri.startswith("nfs://"):
+        uri = "nfs:" + uri[6:]
+    match = re.match(r"^([a-zA-Z]+)://([^/]*)(.*)$", uri)
+    if match:
+        scheme, host, path = match.groups()
+        uri = "%s://%s%s" % (scheme.lower(), host.lower(), path)
+    elif not uri.startswith("nfs:"):
+        uri = os.path.abspath(uri)
+
+    while uri.endswith("/") and not uri.endswith("//"):
+        uri = uri[:-1]
+    return uri
+
+def _entry_path(cachedir, baseuri, arch, typ, distro):
+    key = "%s\n%s\n%s\n%s" % (normalize_uri(baseuri), arch, typ,
+                               distro or "")
+    return os.path.join(cachedir or CACHE_DIR,
+                        _util.sha1(key).hexdigest() + ".conf")
+
+def _freshness_file(store):
+    """
+    File in the tree whose validator tells whether the entry for store
+    is still good
+    """
+    if store.treeinfo:
+        return ".treeinfo"
+    for attr in ["_kernel_paths", "_valid_kernel_path"]:
+        paths = getattr(store, attr, None)
+        if paths:
+            return paths[0]
+    return None
+
+def _safe_attrs(store):
+    """
+    Instance attributes of store in _cached_attrs that survive a repr()
+    round trip
+    """
+    ret = {}
+    for key in _cached_attrs:
+        if key not in store.__dict__:
+            continue
+        val = store.__dict__[key]
+        try:
+            if _literal_eval(repr(val)) != val:
+                continue
+        except (ValueError, SyntaxError):
+            continue
+        ret[key] = repr(val)
+    return ret
+
+def load(fetcher, baseuri, arch, typ, distro=None, cachedir=None, ttl=None):
+    """
+    Look up a cached detection result for the tree, detected with the
+    passed distro hint
+
+    @returns: (Distro class name, dict of instance attributes,
+               ConfigParser for .treeinfo or None), or None
+    """
+    if ttl is None:
+        ttl = ttl_from_env()
+    if ttl is None:
+        return None
+
+    path = _entry_path(cachedir, baseuri, arch, typ, distro)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        conf = _diskcache.read_config(path)
+        if not _diskcache.check_age(conf, _section, ttl):
+            logging.debug("Ignoring tree cache %s: expired" % path)
+            return None
+
+        validator = fetcher._cacheValidator(conf.get(_section, "check_file"))
+        if not validator or validator != conf.get(_section, "validator"):
+            logging.debug("Ignoring tree cache %s: tree changed" % path)
+            return None
+
+        attrs = {}
+        for key, val in conf.items(_attr_section):
+            if key in _cached_attrs:
+                attrs[key] = _literal_eval(val)
+
+        treeinfo = None
+        if conf.has_option(_section, "treeinfo"):
+            treeinfo = ConfigParser.SafeConfigParser()
+            treeinfo.readfp(StringIO.StringIO(
+                            _literal_eval(conf.get(_section, "treeinfo"))))
+
+        classname = conf.get(_section, "class")
+    except Exception, e:
+        logging.debug("Error reading tree cache %s: %s" % (path, e))
+        return None
+
+    logging.debug("Using cached detection result %s for %s" %
+                  (classname, baseuri))
+    return classname, attrs, treeinfo
+
+def save(fetcher, store, baseuri, arch, typ, distro=None, cachedir=None):
+    """
+    Record the detection result store for the tree, detected with the
+    passed distro hint. Errors are logged and ignored.
+    """
+    if ttl_from_env() is None:
+        return
+
+    path = _entry_path(cachedir, baseuri, arch, typ, distro)
+    try:
+        check_file = _freshness_file(store)
+        validator = check_file and fetcher._cacheValidator(check_file)
+        if not validator:
+            logging.debug("Not caching detection result for %s, can't "
+                          "validate it" % baseuri)
+            return
+
+        conf = _diskcache.new_config()
+        conf.add_section(_section)
+        conf.add_section(_attr_section)
+        _diskcache.set_timestamp(conf, _section)
+        conf.set(_section, "uri", normalize_uri(baseuri))
+        conf.set(_section, "class", store.__class__.__name__)
+        conf.set(_section, "check_file", check_file)
+        conf.set(_section, "validator", validator)
+        if store.treeinfo:
+            buf = StringIO.StringIO()
+            store.treeinfo.write(buf)
+            conf.set(_section, "treeinfo", repr(buf.getvalue()))
+        for key, val in _safe_attrs(store).items():
+            conf.set(_attr_section, key, val)
+
+        _diskcache.write_config(path, conf)
+    except Exception, e:
+        logging.debug("Error writing tree cache %s: %s" % (path, e))
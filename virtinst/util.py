@@ -253,13 +253,10 @@ def get_host_network_devices():
 def get_max_vcpus(conn, type=None):
     """@conn libvirt connection to poll for max possible vcpus
        @type optional guest type (kvm, etc.)"""
+    cache = support._get_support_cache(conn)
     if type is None:
-        type = conn.getType()
-    try:
-        m = conn.getMaxVcpus(type.lower())
-    except libvirt.libvirtError:
-        m = 32
-    return m
+        type = cache.conn_type()
+    return cache.max_vcpus(type.lower())
 
 def get_phy_cpus(conn):
     """Get number of physical CPUs."""
@@ -382,7 +379,7 @@ def pygrub_path(conn=None):
     # FIXME: This should be removed/deprecated when capabilities are
     #        fixed to provide bootloader info
     if conn:
-        cap = CapabilitiesParser.parse(conn.getCapabilities())
+        cap = CapabilitiesParser.get_conn_caps(conn)
         if (cap.host.arch == "i86pc"):
             return "/usr/lib/xen/bin/pygrub"
         else:
@@ -487,6 +484,12 @@ def get_xml_path(xml, path=None, func=None):
     Return the content from the passed xml xpath, or return the result
     of a passed function (receives xpathContext as its only arg)
     """
+    if path:
+        return virtinst._util.get_xml_paths(xml, [path])[0]
+    elif not func:
+        raise ValueError(_("'path' or 'func' is required."))
+
+    # func may modify the document, so don't hand it a cached one
     doc = None
     ctx = None
     result = None
@@ -494,21 +497,7 @@ def get_xml_path(xml, path=None, func=None):
     try:
         doc = libxml2.parseDoc(xml)
         ctx = doc.xpathNewContext()
-
-        if path:
-            ret = ctx.xpathEval(path)
-            if ret != None:
-                if type(ret) == list:
-                    if len(ret) >= 1:
-                        result = ret[0].content
-                else:
-                    result = ret
-
-        elif func:
-            result = func(ctx)
-
-        else:
-            raise ValueError(_("'path' or 'func' is required."))
+        result = func(ctx)
     finally:
         if doc:
             doc.freeDoc()